@@ -0,0 +1,9 @@
+"""
+	Benchmarks for the packet codec, the root's NetworkGraph, the Peer hot paths and end-to-end broadcasts.
+
+	Run every suite from the repository root and keep the JSON report for later comparison:
+
+		python -m benchmarks --output bench.json
+		python -m benchmarks --compare bench.json
+
+"""
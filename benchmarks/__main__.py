@@ -0,0 +1,62 @@
+import argparse
+import os
+import sys
+
+from benchmarks import bench_broadcast, bench_graph, bench_ingress, bench_packet, bench_peer
+from benchmarks.common import write_report, compare_reports
+
+SUITES = {
+	'packet': bench_packet.run,
+	'graph': bench_graph.run,
+	'peer': bench_peer.run,
+	'broadcast': bench_broadcast.run,
+	'ingress': bench_ingress.run,
+}
+
+
+def parse_int_list(value):
+	return [int(part) for part in value.split(',') if part]
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Run the network benchmarks.')
+	parser.add_argument('--suite', default=','.join(SUITES),
+						help='comma separated suites to run (default: %(default)s)')
+	parser.add_argument('--quick', action='store_true', help='smaller sizes, for a fast sanity run')
+	parser.add_argument('--graph-sizes', type=parse_int_list, help='NetworkGraph sizes, e.g. 1000,10000')
+	parser.add_argument('--depths', type=parse_int_list, help='broadcast tree depths, e.g. 1,2,3')
+	parser.add_argument('--messages', type=int, help='messages per broadcast case')
+	parser.add_argument('--output', help='write the JSON report here instead of stdout')
+	parser.add_argument('--compare', help='JSON report of an earlier run to check for regressions')
+	parser.add_argument('--threshold', type=float, default=0.1,
+						help='allowed relative throughput drop when comparing (default: %(default)s)')
+	args = parser.parse_args(argv)
+
+	# Peers keep running (and printing) in background threads until the process exits.
+	report_stream = sys.stdout
+	sys.stdout = open(os.devnull, 'w')
+
+	results = []
+	for name in args.suite.split(','):
+		if name not in SUITES:
+			parser.error(f'unknown suite {name!r}')
+		print(f'running {name} benchmarks', file=sys.stderr)
+		if name == 'graph':
+			results += bench_graph.run(args.quick, sizes=args.graph_sizes)
+		elif name == 'broadcast':
+			results += bench_broadcast.run(args.quick, depths=args.depths, messages=args.messages)
+		else:
+			results += SUITES[name](args.quick)
+
+	write_report(results, args.output, report_stream)
+
+	if args.compare:
+		regressions = compare_reports(args.compare, results, args.threshold)
+		for line in regressions:
+			print('REGRESSION ' + line, file=sys.stderr)
+		return 1 if regressions else 0
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,139 @@
+import threading
+import time
+
+from src.Packet import PacketType
+from src.Peer import Peer
+
+from benchmarks.common import BenchmarkResult, quiet, free_port
+
+LOCALHOST = '127.000.000.001'
+TREE_DEPTHS = [1, 2]
+JOIN_TIMEOUT = 60
+DELIVERY_TIMEOUT = 60
+
+
+class LoopbackTree:
+	def __init__(self, depth):
+		"""
+		A root and a full binary tree of clients below it, all running in this process over loopback TCP.
+
+		:param depth: Number of client levels under the root.
+		:type depth: int
+		"""
+		self.depth = depth
+		self.arrivals = {}  # {(peer address, message body): arrival time}
+		self.root = self.__start_peer(is_root=True)
+		self.clients = []
+		self.leaves = []
+
+	def __start_peer(self, is_root, root_address=None):
+		peer = Peer(LOCALHOST, free_port(), is_root=is_root, root_address=root_address)
+		handle_packet = peer.handle_packet
+
+		def recording_handle_packet(packet):
+			if packet.type == PacketType.MESSAGE:
+				self.arrivals[(peer.address, packet.get_message_body())] = time.perf_counter()
+			handle_packet(packet)
+
+		peer.handle_packet = recording_handle_packet
+		threading.Thread(target=peer.run, daemon=True).start()
+		return peer
+
+	def build(self):
+		"""
+		Join the clients level by level; A parent must be connected before it accepts Join packets.
+
+		:return: Seconds it took to build the whole tree.
+		:rtype: float
+		"""
+		start = time.perf_counter()
+		peers = {self.root.address: self.root}
+		for level in range(1, self.depth + 1):
+			joining = []
+			for _ in range(2 ** level):
+				client = self.__start_peer(is_root=False, root_address=self.root.address)
+				client.user_interface.put('Register')
+				client.user_interface.put('Advertise')
+				joining.append(client)
+			deadline = time.time() + JOIN_TIMEOUT
+			while not all(self.__is_joined(client, peers) for client in joining):
+				if time.time() > deadline:
+					raise RuntimeError(f'level {level} did not join in {JOIN_TIMEOUT}s')
+				time.sleep(0.1)
+			for client in joining:
+				peers[client.address] = client
+			self.clients += joining
+			self.leaves = joining
+		return time.perf_counter() - start
+
+	@staticmethod
+	def __is_joined(client, peers):
+		parent = peers.get(client.client_predecessor_address)
+		return client.is_client_connected and parent is not None and client.address in parent.successors_address
+
+	def broadcast(self, bodies):
+		"""
+		Inject 'bodies' at the root and wait until every client has received all of them.
+
+		:return: Injection time and the number of deliveries that never arrived.
+		:rtype: tuple
+		"""
+		injected = time.perf_counter()
+		for body in bodies:
+			self.root.user_interface.put(f'SendMessage {body}')
+		expected = [(client.address, body) for client in self.clients for body in bodies]
+		deadline = time.time() + DELIVERY_TIMEOUT
+		while time.time() < deadline:
+			if all(key in self.arrivals for key in expected):
+				break
+			time.sleep(0.01)
+		lost = sum(1 for key in expected if key not in self.arrivals)
+		return injected, lost
+
+
+def percentile(values, fraction):
+	values = sorted(values)
+	if not values:
+		return None
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(quick=False, depths=None, messages=None):
+	depths = depths or (TREE_DEPTHS[:1] if quick else TREE_DEPTHS)
+	messages = messages or (5 if quick else 20)
+	results = []
+	with quiet():
+		for depth in depths:
+			tree = LoopbackTree(depth)
+			build_time = tree.build()
+			params = {'depth': depth, 'peers': len(tree.clients) + 1}
+
+			latencies = []
+			lost = 0
+			for i in range(messages):
+				body = f'latency-{depth}-{i}'
+				injected, missing = tree.broadcast([body])
+				lost += missing
+				latencies += [tree.arrivals[(leaf.address, body)] - injected for leaf in tree.leaves
+							  if (leaf.address, body) in tree.arrivals]
+			results.append(BenchmarkResult('broadcast.latency', params, messages / sum(latencies) if latencies else 0,
+										   sum(latencies) / len(latencies) if latencies else 0, messages, {
+												'p50_s': percentile(latencies, 0.5),
+												'p99_s': percentile(latencies, 0.99),
+												'max_s': max(latencies, default=None),
+												'lost': lost,
+												'build_s': build_time,
+											}))
+
+			bodies = [f'burst-{depth}-{i}' for i in range(messages)]
+			injected, lost = tree.broadcast(bodies)
+			finished = max((tree.arrivals[(client.address, body)] for client in tree.clients for body in bodies
+							if (client.address, body) in tree.arrivals), default=injected)
+			elapsed = finished - injected
+			results.append(BenchmarkResult('broadcast.throughput', params, messages / elapsed if elapsed else 0,
+										   elapsed / messages, messages, {
+												'deliveries_per_sec': messages * len(tree.clients) / elapsed
+												if elapsed else 0,
+												'lost': lost,
+											}))
+	return results
@@ -0,0 +1,76 @@
+import time
+
+from src.tools.ArrayGraph import ArrayGraph
+from src.tools.NetworkGraph import NetworkGraph, GraphNode
+from src.tools.helpers import peer_id, peer_id_from_parts
+
+from benchmarks.common import measure, measure_once, quiet, BenchmarkResult
+
+GRAPH_SIZES = [1000, 10000, 100000]
+ROOT_ADDRESS = peer_id('010.255.255.255', '05000')
+
+
+def node_address(i):
+	"""
+	A unique peer ID for the i'th node.
+
+	:rtype: int
+	"""
+	return peer_id_from_parts(10, (i >> 16) & 255, (i >> 8) & 255, i & 255, 5001 + (i >> 24))
+
+
+def build_graph(size, graph_class=NetworkGraph):
+	"""
+	Build a complete tree of 'size' nodes in BFS order, the same shape the root creates when peers join one by one.
+
+	:param graph_class: NetworkGraph or another graph backend like ArrayGraph.
+
+	:return: The graph and the address of every non-root node in insertion order.
+	:rtype: tuple
+	"""
+	graph = graph_class(GraphNode(ROOT_ADDRESS))
+	addresses = [ROOT_ADDRESS]
+	for i in range(1, size):
+		address = node_address(i)
+		graph.add_node(address, addresses[(i - 1) // 2])
+		addresses.append(address)
+	return graph, addresses[1:]
+
+
+def run(quick=False, sizes=None):
+	sizes = sizes or (GRAPH_SIZES[:1] if quick else GRAPH_SIZES)
+	results = []
+	# The NumPy backend is only measured where NumPy is installed; Its results are told apart by 'backend'.
+	backends = [(NetworkGraph, {})] + ([(ArrayGraph, {'backend': 'numpy'})] if ArrayGraph.available() else [])
+	with quiet():
+		for (graph_class, backend), size in [(backend, size) for backend in backends for size in sizes]:
+			params = dict(backend, nodes=size)
+
+			start = time.perf_counter()
+			graph, addresses = build_graph(size, graph_class)
+			elapsed = time.perf_counter() - start
+			results.append(BenchmarkResult('graph.add_node', params, (size - 1) / elapsed, elapsed / (size - 1),
+										   size - 1))
+
+			sender = peer_id('011.000.000.001', '05000')
+			if size > 20000:
+				results.append(measure_once('graph.find_live_node', params, lambda: graph.find_live_node(sender), 1))
+			else:
+				results.append(measure('graph.find_live_node', params, lambda: graph.find_live_node(sender)))
+
+			leaf = addresses[-1]
+			leaf_parent = graph.find_node(leaf).parent.address
+
+			def remove_and_restore_leaf():
+				graph.remove_node(leaf)
+				graph.add_node(leaf, leaf_parent)
+
+			results.append(measure('graph.remove_node', dict(params, subtree='leaf'), remove_and_restore_leaf))
+
+			# Removing a child of the root turns off (and walks) half of the tree.
+			subtree_root = addresses[0]
+			result = measure_once('graph.remove_node', dict(params, subtree='half'),
+								  lambda: graph.remove_node(subtree_root), 1)
+			result.extra['subtree_nodes'] = len(addresses) // 2
+			results.append(result)
+	return results
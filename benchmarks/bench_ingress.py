@@ -0,0 +1,89 @@
+import multiprocessing
+import pickle
+import socket
+import threading
+import time
+
+from src.Packet import Packet, PacketFactory
+from src.Stream import Stream
+
+from benchmarks.common import BenchmarkResult, measure, quiet, free_port
+
+LOCALHOST = '127.000.000.001'
+WORKERS = [0, 1, 2, 4]
+SENDERS = 8
+PACKETS_PER_SENDER = 5000
+BATCH_SIZE = 256
+RECEIVE_TIMEOUT = 120
+
+
+def run_sender(port, count, buf, start):
+	"""
+	Body of one sender process: one connection to the root, 'count' Reunion Hellos as fast as it can; The ACKs are
+	read by a thread so that neither side blocks on a full socket buffer.
+	"""
+	sock = socket.create_connection(('127.0.0.1', port))
+	threading.Thread(target=lambda: [sock.recv(65536) for _ in iter(int, 1)], daemon=True).start()
+	start.wait()
+	for _ in range(count):
+		sock.sendall(buf)
+	time.sleep(RECEIVE_TIMEOUT)
+
+
+def measure_root_ingress(workers, senders, packets_per_sender):
+	"""
+	Packets per second the root's main loop takes out of its Stream while 'senders' processes flood it.
+
+	:rtype: BenchmarkResult
+	"""
+	port = free_port()
+	stream = Stream(LOCALHOST, port, ingress_processes=workers, send_threads=workers)
+	buf = PacketFactory.new_reunion_packet('REQ', stream.peer_id, [stream.peer_id]).get_buf()
+	context = multiprocessing.get_context('spawn')
+	start = context.Event()
+	processes = [context.Process(target=run_sender, args=(port, packets_per_sender, buf, start), daemon=True)
+				 for _ in range(senders)]
+	for process in processes:
+		process.start()
+	# Let every sender connect before the clock starts.
+	time.sleep(1)
+	total = senders * packets_per_sender
+	received = 0
+	began = time.perf_counter()
+	start.set()
+	deadline = time.time() + RECEIVE_TIMEOUT
+	while received < total and time.time() < deadline:
+		batch = stream.read_in_batch()
+		if not batch:
+			time.sleep(0.0005)
+		received += sum(len(packets) for packets in batch.values())
+	elapsed = time.perf_counter() - began
+	for process in processes:
+		process.terminate()
+	if stream.ingress_workers is not None:
+		stream.ingress_workers.stop()
+	return BenchmarkResult('ingress.root', {'workers': workers, 'senders': senders}, received / elapsed,
+						   elapsed / received if received else float('inf'), received,
+						   extra={'cpus': multiprocessing.cpu_count()})
+
+
+def run(quick=False):
+	results = []
+	with quiet():
+		# What the owner pays per batch: decoding the packets itself against taking them from the workers, as
+		# pickled Packets or as compact records.
+		buf = PacketFactory.new_reunion_packet('REQ', 0, [0] * 4).get_buf()
+		buffers = [buf] * BATCH_SIZE
+		pickled = pickle.dumps([Packet(buf) for _ in range(BATCH_SIZE)])
+		records = pickle.dumps(PacketFactory.encode_records([Packet(buf) for _ in range(BATCH_SIZE)]))
+		results.append(measure('ingress.owner_batch', {'format': 'decode', 'packets': BATCH_SIZE},
+							   lambda: PacketFactory.parse_batch(buffers)))
+		results.append(measure('ingress.owner_batch', {'format': 'pickled_packets', 'packets': BATCH_SIZE},
+							   lambda: pickle.loads(pickled)))
+		results.append(measure('ingress.owner_batch', {'format': 'records', 'packets': BATCH_SIZE},
+							   lambda: PacketFactory.parse_records(*pickle.loads(records))))
+
+		for workers in WORKERS[:2] if quick else WORKERS:
+			results.append(measure_root_ingress(workers, SENDERS // 2 if quick else SENDERS,
+												PACKETS_PER_SENDER // 5 if quick else PACKETS_PER_SENDER))
+	return results
@@ -0,0 +1,48 @@
+from src.Packet import PacketFactory
+from src.tools.helpers import peer_id
+
+from benchmarks.common import measure
+
+SOURCE = peer_id('192.168.001.001', '05335')
+MESSAGE_SIZES = [16, 256, 1024, 4096]
+REUNION_ENTRIES = [1, 4, 8]
+
+
+def packet_cases(quick=False):
+	"""
+	Every case is (params, factory) where factory builds a fresh Packet of that shape.
+
+	:rtype: list
+	"""
+	cases = [
+		({'type': 'REGISTER', 'kind': 'REQ', 'body_size': 23},
+		 lambda: PacketFactory.new_register_packet('REQ', SOURCE, SOURCE)),
+		({'type': 'REGISTER', 'kind': 'RES', 'body_size': 6},
+		 lambda: PacketFactory.new_register_packet('RES', SOURCE)),
+		({'type': 'ADVERTISE', 'kind': 'REQ', 'body_size': 3},
+		 lambda: PacketFactory.new_advertise_packet('REQ', SOURCE)),
+		({'type': 'ADVERTISE', 'kind': 'RES', 'body_size': 23},
+		 lambda: PacketFactory.new_advertise_packet('RES', SOURCE, SOURCE)),
+		({'type': 'JOIN', 'kind': '-', 'body_size': 4},
+		 lambda: PacketFactory.new_join_packet(SOURCE)),
+	]
+	for size in MESSAGE_SIZES[:2] if quick else MESSAGE_SIZES:
+		message = 'x' * size
+		cases.append(({'type': 'MESSAGE', 'kind': '-', 'body_size': size},
+					  lambda message=message: PacketFactory.new_message_packet(message, SOURCE)))
+	for entries in REUNION_ENTRIES:
+		path = [SOURCE] * entries
+		for kind in ('REQ', 'RES'):
+			cases.append(({'type': 'REUNION', 'kind': kind, 'body_size': 5 + 20 * entries},
+						  lambda kind=kind, path=path: PacketFactory.new_reunion_packet(kind, SOURCE, path)))
+	return cases
+
+
+def run(quick=False):
+	repeat = 1 if quick else 3
+	results = []
+	for params, factory in packet_cases(quick):
+		buf = factory().get_buf()
+		results.append(measure('packet.encode', params, lambda factory=factory: factory().get_buf(), repeat))
+		results.append(measure('packet.decode', params, lambda buf=buf: PacketFactory.parse_buffer(buf), repeat))
+	return results
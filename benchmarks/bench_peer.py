@@ -0,0 +1,35 @@
+from src.Packet import PacketFactory
+from src.Peer import Peer
+
+from benchmarks.common import measure, quiet, free_port
+
+LOCALHOST = '127.000.000.001'
+HELLO_ENTRIES = [1, 4, 8]
+MESSAGE_SIZES = [16, 1024]
+
+
+def run(quick=False):
+	results = []
+	with quiet():
+		root = Peer(LOCALHOST, free_port(), is_root=True)
+		client = Peer(LOCALHOST, free_port(), is_root=False, root_address=root.address)
+		client.client_predecessor_address = client.root_address
+		parent_node = client.stream.nodes[client.root_address]
+
+		def drain():
+			parent_node.out_buff.clear()
+
+		for size in MESSAGE_SIZES:
+			packet = PacketFactory.new_message_packet('x' * size, root.address)
+			results.append(measure('peer.change_header', {'type': 'MESSAGE', 'body_size': size},
+								   lambda packet=packet: client.change_header(packet)))
+
+		for entries in HELLO_ENTRIES[:1] if quick else HELLO_ENTRIES:
+			path = [root.address] * entries
+			hello = PacketFactory.new_reunion_packet('REQ', root.address, path)
+			results.append(measure('peer.change_header', {'type': 'REUNION', 'entries': entries},
+								   lambda hello=hello: client.change_header(hello)))
+			results.append(measure('peer.forward_hello', {'entries': entries},
+								   lambda hello=hello: client.forward_hello(hello), setup=drain))
+		drain()
+	return results
@@ -0,0 +1,175 @@
+import contextlib
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+import timeit
+
+
+class BenchmarkResult:
+	def __init__(self, name, params, ops_per_sec, seconds_per_op, iterations, extra=None):
+		"""
+
+		:param name: Dotted benchmark name, e.g. 'packet.encode'.
+		:param params: Parameters that identify this case, e.g. {'type': 'MESSAGE', 'body_size': 256}.
+		:param ops_per_sec: Best measured throughput.
+		:param seconds_per_op: Best measured time for one operation.
+		:param iterations: Number of operations behind the measurement.
+		:param extra: Any other numbers worth keeping (latency percentiles, ...).
+
+		:type name: str
+		:type params: dict
+		:type ops_per_sec: float
+		:type seconds_per_op: float
+		:type iterations: int
+		:type extra: dict
+		"""
+		self.name = name
+		self.params = params
+		self.ops_per_sec = ops_per_sec
+		self.seconds_per_op = seconds_per_op
+		self.iterations = iterations
+		self.extra = extra or {}
+
+	def key(self):
+		"""
+
+		:return: A stable identifier for comparing the same case between two runs.
+		:rtype: str
+		"""
+		params = ','.join(f'{k}={self.params[k]}' for k in sorted(self.params))
+		return f'{self.name}[{params}]'
+
+	def to_dict(self):
+		return {
+			'name': self.name,
+			'params': self.params,
+			'ops_per_sec': self.ops_per_sec,
+			'seconds_per_op': self.seconds_per_op,
+			'iterations': self.iterations,
+			'extra': self.extra,
+		}
+
+
+def measure(name, params, func, repeat=3, setup=None):
+	"""
+	Time 'func' with timeit's autorange and keep the best of 'repeat' rounds.
+
+	:param name: Benchmark name.
+	:param params: Case parameters.
+	:param func: Callable without arguments; one call is one operation.
+	:param repeat: Number of rounds.
+	:param setup: Optional callable that is run (untimed) before each round.
+
+	:return: The measurement.
+	:rtype: BenchmarkResult
+	"""
+	timer = timeit.Timer(func)
+	if setup:
+		setup()
+	number, _ = timer.autorange()
+	best = None
+	for _ in range(repeat):
+		if setup:
+			setup()
+		elapsed = timer.timeit(number)
+		if best is None or elapsed < best:
+			best = elapsed
+	per_op = best / number
+	return BenchmarkResult(name, params, 1 / per_op if per_op else float('inf'), per_op, number)
+
+
+def measure_once(name, params, func, count):
+	"""
+	Time a single call of 'func' that performs 'count' operations; For slow cases where autorange is too expensive.
+
+	:rtype: BenchmarkResult
+	"""
+	start = time.perf_counter()
+	func()
+	elapsed = time.perf_counter() - start
+	per_op = elapsed / count
+	return BenchmarkResult(name, params, 1 / per_op if per_op else float('inf'), per_op, count)
+
+
+@contextlib.contextmanager
+def quiet():
+	"""
+	The network code prints on every step; Keep that out of the benchmark output.
+	"""
+	with open(os.devnull, 'w') as sink, contextlib.redirect_stdout(sink):
+		yield sink
+
+
+def free_port():
+	"""
+
+	:return: A TCP port on the loopback interface that is currently free.
+	:rtype: int
+	"""
+	with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+		sock.bind(('127.0.0.1', 0))
+		return sock.getsockname()[1]
+
+
+def run_metadata():
+	try:
+		commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+								cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+	except OSError:
+		commit = ''
+	return {
+		'timestamp': time.time(),
+		'python': sys.version.split()[0],
+		'implementation': platform.python_implementation(),
+		'platform': platform.platform(),
+		'commit': commit,
+	}
+
+
+def write_report(results, path=None, stream=None):
+	"""
+	Write all results as one JSON document; To 'stream' (default stdout) when 'path' is None.
+
+	:type results: list
+	:type path: str
+	"""
+	report = {'meta': run_metadata(), 'results': [r.to_dict() for r in results]}
+	data = json.dumps(report, indent=2, sort_keys=True)
+	if path is None:
+		print(data, file=stream or sys.stdout)
+	else:
+		with open(path, 'w') as f:
+			f.write(data + '\n')
+
+
+def compare_reports(baseline_path, results, threshold):
+	"""
+	Compare the current results with a previously written report.
+
+	:param baseline_path: Path of an earlier JSON report.
+	:param results: Current results.
+	:param threshold: Allowed relative throughput drop, e.g. 0.1 for 10%.
+
+	:return: Human readable lines for every case that became slower than the threshold allows.
+	:rtype: list
+	"""
+	with open(baseline_path) as f:
+		baseline = json.load(f)
+	old = {}
+	for entry in baseline['results']:
+		old[BenchmarkResult(entry['name'], entry['params'], entry['ops_per_sec'], entry['seconds_per_op'],
+							entry['iterations']).key()] = entry['ops_per_sec']
+
+	regressions = []
+	for result in results:
+		before = old.get(result.key())
+		if not before:
+			continue
+		change = (result.ops_per_sec - before) / before
+		if change < -threshold:
+			regressions.append(f'{result.key()}: {before:.1f} -> {result.ops_per_sec:.1f} ops/s ({change:+.1%})')
+	return regressions
@@ -1,6 +1,9 @@
+import argparse
 import threading
 
 from src.Peer import Peer
+from src.PeerHost import PeerHost
+from src.tools.helpers import parse_peer_list
 
 
 def is_ip_correct(ip):
@@ -28,12 +31,87 @@ def is_port_ok(port):
 	return True
 
 
+def parse_fan_out(value):
+	fan_out = int(value)
+	if not 1 <= fan_out <= 99:
+		raise argparse.ArgumentTypeError(f'{fan_out} is not in 1..99; Advertise Requests carry it in two digits')
+	return fan_out
+
+
+def start_host(parts_of_command, args):
+	"""
+	host IP-address first-port count [<Root-Ip-address> <Root-port>]
+	Runs 'count' peers on consecutive ports in this process. Without a root address the first one is the root.
+	Commands look like '<port> <command>' or 'all <command>'.
+	"""
+	if len(parts_of_command) != 4 and len(parts_of_command) != 6:
+		print('WRONG COMMAND')
+		return
+	ip = parts_of_command[1]
+	if ip == '_': ip = '127.000.000.001'
+	first_port = parts_of_command[2]
+	try:
+		count = int(parts_of_command[3])
+	except ValueError:
+		count = 0
+	if not is_ip_correct(ip) or not is_port_ok(first_port) or count < 1 or int(first_port) + count > 65536:
+		print('WRONG_COMMAND')
+		return
+
+	host = PeerHost()
+	ports = range(int(first_port), int(first_port) + count)
+	if len(parts_of_command) == 6:
+		root_ip = parts_of_command[4]
+		if root_ip == '_': root_ip = '127.000.000.001'
+		root_port = parts_of_command[5]
+		if not is_ip_correct(root_ip) or not is_port_ok(root_port):
+			print('WRONG_COMMAND')
+			return
+		root_address = (root_ip, int(root_port))
+	else:
+		root_address = (ip, ports[0])
+		host.add_peer(ip, ports[0], is_root=True, fan_out=args.fan_out)
+		ports = ports[1:]
+	for port in ports:
+		host.add_peer(ip, port, is_root=False, root_address=root_address, fan_out=args.fan_out)
+	run_thread = threading.Thread(target=host.run)
+	run_thread.start()
+	host.start_user_interface(args.commands, args.control_port)
+	# A script returns when it is done; Keep the main thread until the peers stop: once it exits the interpreter
+	# starts shutting down and refuses new futures to the threads of the peers.
+	run_thread.join()
+
+
 if __name__ == "__main__":
-	print('Type   add client/root IP-address port <Root-Ip-address> <Root-port>')
-	command = str(input())
+	parser = argparse.ArgumentParser(description='Start a root or client peer, or a host of many peers.')
+	parser.add_argument('command', nargs='*', help='add client/root IP-address port <Root-Ip-address> <Root-port>'
+												   ' (for a root: the root it is a sub-root of)'
+												   ' | host IP-address first-port count [<Root-Ip-address> <Root-port>]')
+	parser.add_argument('--commands', help="read peer commands from this file ('-' for stdin) instead of the prompt")
+	parser.add_argument('--control-port', type=int, help='also accept peer commands on this local TCP port')
+	parser.add_argument('--root-workers', type=int, help='root only: receive and decode packets in this many processes')
+	parser.add_argument('--fan-out', type=parse_fan_out, help='most children this peer takes (for the root: the network default)')
+	parser.add_argument('--state-dir', help='root only: keep the root state in this directory and restore it on start')
+	parser.add_argument('--datagrams', action='store_true', default=None,
+						help='send Reunion packets as UDP datagrams to neighbours that accept them')
+	parser.add_argument('--sub-roots', type=parse_peer_list,
+						help='root only: spread new peers over these sub-roots, e.g. 127.0.0.1:5001,127.0.0.1:5002')
+	parser.add_argument('--standby-for', type=lambda address: parse_peer_list(address)[0],
+						help='root only: mirror this root (e.g. 127.0.0.1:5000) and take over when it dies')
+	parser.add_argument('--standbys', type=parse_peer_list,
+						help='root only: roots that may mirror this one as hot standbys, e.g. 127.0.0.1:5001')
+	args = parser.parse_args()
+
+	if args.command:
+		command = ' '.join(args.command)
+	else:
+		print('Type   add client/root IP-address port <Root-Ip-address> <Root-port>')
+		command = str(input())
 
 	parts_of_command = command.split()
-	if parts_of_command[0] != 'add':
+	if parts_of_command and parts_of_command[0] == 'host':
+		start_host(parts_of_command, args)
+	elif not parts_of_command or parts_of_command[0] != 'add':
 		print('WRONG COMMAND')
 	elif len(parts_of_command) != 4 and len(parts_of_command) != 6:
 		print('WRONG COMMAND')
@@ -56,15 +134,30 @@ if __name__ == "__main__":
 						print('WRONG_COMMAND')
 					else:
 						client = Peer(ip, int(port), is_root=False,
-									  root_address=(root_ip, int(root_port)))
-						threading.Thread(target = client.run).start()
-						client.start_user_interface()
+									  root_address=(root_ip, int(root_port)), fan_out=args.fan_out,
+									  datagrams=args.datagrams)
+						run_thread = threading.Thread(target=client.run)
+						run_thread.start()
+						client.start_user_interface(args.commands, args.control_port)
+						run_thread.join()
 			elif parts_of_command[1] == 'root':
-				if len(parts_of_command) != 4:
-					print('WRONG COMMAND')
+				upper_root_address = None
+				if len(parts_of_command) == 6:
+					upper_ip = parts_of_command[4]
+					if upper_ip == '_': upper_ip = '127.000.000.001'
+					upper_port = parts_of_command[5]
+					if is_ip_correct(upper_ip) and is_port_ok(upper_port):
+						upper_root_address = (upper_ip, int(upper_port))
+				if len(parts_of_command) == 6 and upper_root_address is None:
+					print('WRONG_COMMAND')
 				else:
-					root = Peer(ip, int(port), is_root=True)
-					threading.Thread(target=root.run).start()
-					root.start_user_interface()
+					root = Peer(ip, int(port), is_root=True, root_address=upper_root_address,
+								root_workers=args.root_workers, state_dir=args.state_dir, fan_out=args.fan_out,
+								datagrams=args.datagrams, sub_roots=args.sub_roots, standby_for=args.standby_for,
+								allowed_standbys=args.standbys)
+					run_thread = threading.Thread(target=root.run)
+					run_thread.start()
+					root.start_user_interface(args.commands, args.control_port)
+					run_thread.join()
 			else:
 				print('WRONG COMMAND')
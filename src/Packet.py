@@ -26,9 +26,22 @@
         3: Join
         4: Message
         5: Reunion
+        6: Leave
+        7: Sync
+        8: Replicate
                 e.g: type = '2' => Advertise packet.
+
+        The high byte of this field holds flags (see PacketFlag); The low byte is the type itself.
+            0x01: Fragment - the body is one piece of a chunked Message.
+            0x02: Zlib - the body is zlib compressed.
+            0x04: LZMA - the body is lzma (xz) compressed.
+            0x08: Accepts compression - the sender can read compressed bodies; Peers only send compressed
+                  packets to neighbours whose packets carried this flag.
+            0x10: Accepts datagrams - the sender also listens for UDP datagrams on its server port; Peers only send
+                  Reunion packets as datagrams to neighbours whose packets carried this flag.
+            0x20: Sequenced - the body of a Message starts with its origin and sequence number (see Message).
     Length:
-        This field shows the character numbers for Body of the packet.
+        This field shows the number of bytes in the UTF-8 encoded Body of the packet.
 
     Server IP/Port:
         We need this field for response packet in non-blocking mode.
@@ -72,10 +85,28 @@
                 |                  RES (3 Chars)                  |
                 |-------------------------------------------------|
                 |                  ACK (3 Chars)                  |
+                |-------------------------------------------------|
+                |     Rejoin Token (32 Hex Chars) (Optional)      |
                 |_________________________________________________|
                 
                 For now only should just send an 'ACK' from the root to inform a node that it
                 has been registered in the root if the 'Register Request' was successful.
+                The rejoin token lets the node advertise again without registering again (see RejoinTokens).
+
+            Redirect (Response of a federation root):
+
+                                 ** Body Format **
+                 _________________________________________________
+                |                  RES (3 Chars)                  |
+                |-------------------------------------------------|
+                |                  RED (3 Chars)                  |
+                |-------------------------------------------------|
+                |           Sub-root IP/Port (20 Chars)           |
+                |_________________________________________________|
+
+                A root with sub-roots does not keep every peer itself; It answers the Register (or Advertise)
+                Request of a peer that belongs to a sub-root with the address of that sub-root, and the peer
+                registers and advertises there instead.
                 
         Advertise:
             Request:
@@ -83,9 +114,16 @@
                                 ** Body Format **
                  ________________________________________________
                 |                  REQ (3 Chars)                 |
+                |------------------------------------------------|
+                |            Capacity (2 Chars) (Optional)       |
+                |------------------------------------------------|
+                |    Rejoin Token (32 Hex Chars) (Optional)      |
                 |________________________________________________|
                 
                 Nodes for finding the IP/Port of their neighbour peer must send this packet to the root.
+                The capacity is the number of children the sender takes ('00' if it does not say).
+                A node that has a rejoin token from its Register Response adds it (after the capacity); If the root
+                has forgotten the node meanwhile, the token registers it again.
 
             Response:
 
@@ -96,20 +134,40 @@
                 |              Server IP (15 Chars)              |
                 |------------------------------------------------|
                 |             Server Port (5 Chars)              |
+                |------------------------------------------------|
+                |       Backup IP/Port (20 Chars) (Optional)     |
+                |------------------------------------------------|
+                |                     ...                        |
                 |________________________________________________|
                 
                 Root will response Advertise Request packet with sending IP/Port of the requester peer in this packet.
+                The backups are the nodes (grandparent first) the requester may join on its own if its new parent
+                dies; It tells the root by its next Reunion Hello, whose path shows the new parent.
                 
         Join:
 
                                 ** Body Format **
                  ________________________________________________
                 |                 JOIN (4 Chars)                 |
+                |------------------------------------------------|
+                |     Replaced IP/Port (20 Chars) (Optional)     |
+                |------------------------------------------------|
+                |            SYNC (4 Chars) (Optional)           |
+                |------------------------------------------------|
+                |             Origin 1 (12 Hex Chars)            |
+                |------------------------------------------------|
+                |       High-watermark 1 (16 Hex Chars)          |
+                |------------------------------------------------|
+                |                     ...                        |
                 |________________________________________________|
             
             New node after getting Advertise Response from root must send this packet to the specified peer
             to tell him that they should connect together; When receiving this packet we should update our
             Client Dictionary in the Stream object.
+            A node that joins a backup parent names its dead parent; If that is a successor of the receiver, it is
+            replaced by the sender.
+            A node that has received Messages before (i.e. it rejoins) adds the highest sequence number it has seen
+            from every origin; The receiver answers with a Sync packet of the Messages it has above them.
 
 
             
@@ -120,6 +178,34 @@
                 |________________________________________________|
 
             The message that want to broadcast to hole network. Right now this type only includes a plain text.
+
+            Sequenced (Message with the Sequenced flag):
+                                ** Body Format **
+                 ________________________________________________
+                |             Origin (12 Hex Chars)              |
+                |------------------------------------------------|
+                |         Sequence Number (16 Hex Chars)         |
+                |------------------------------------------------|
+                |     Message or Fragment (#Length - 28 Chars)   |
+                |________________________________________________|
+
+            Every peer numbers the Messages it broadcasts; Peers drop the ones they have seen already and keep the
+            most recent ones for the delta sync of rejoining children (see BroadcastLog).
+
+            Fragment (Message with the Fragment flag):
+                                ** Body Format **
+                 ________________________________________________
+                |            Message ID (16 Hex Chars)           |
+                |------------------------------------------------|
+                |               Index (6 Chars)                  |
+                |------------------------------------------------|
+                |            Number of Fragments (6 Chars)       |
+                |------------------------------------------------|
+                |          Payload (up to 1900 Bytes)            |
+                |________________________________________________|
+
+            Messages that do not fit in one packet are split into fragments which are broadcast one by one and
+            reassembled by every receiver (see MessageAssembler).
         
         Reunion:
             Hello:
@@ -155,31 +241,84 @@
                  ________________________________________________
                 |                  RES (3 Chars)                 |
                 |------------------------------------------------|
-                |           Number of Entries (2 Chars)          |
+                |              Hop Index (2 Chars)               |
                 |------------------------------------------------|
-                |                 IPN (15 Chars)                 |
-                |------------------------------------------------|
-                |                PortN (5 Chars)                 |
+                |             Peer ID 1 (12 Hex Chars)           |
                 |------------------------------------------------|
                 |                     ...                        |
                 |------------------------------------------------|
-                |                 IP1 (15 Chars)                 |
+                |        Peer ID N - the target (12 Hex Chars)   |
+                |________________________________________________|
+
+                Root in an answer to the Reunion Hello message will send this packet to the target node.
+                The path is taken from the root's NetworkGraph and starts at the root's child; Every peer on it only
+                reads the entry after its own Hop Index, increases the index and sends the packet on. The packet is
+                the same size on every hop.
+
+        Leave:
+
+                                ** Body Format **
+                 ________________________________________________
+                |                LEAVE (5 Chars)                 |
+                |________________________________________________|
+
+            A node that got a new parent from the root (e.g. when the root rebalances the tree) sends this packet to
+            its old parent, which then removes it from its successors.
+
+        Sync:
+
+                                ** Body Format **
+                 ________________________________________________
+                |             Origin 1 (12 Hex Chars)            |
                 |------------------------------------------------|
-                |                Port1 (5 Chars)                 |
+                |        Sequence Number 1 (16 Hex Chars)        |
                 |------------------------------------------------|
-                |                 IP0 (15 Chars)                 |
+                |              Flags 1 (2 Hex Chars)             |
                 |------------------------------------------------|
-                |                Port0 (5 Chars)                 |
+                |               Length 1 (8 Chars)               |
+                |------------------------------------------------|
+                |          Message 1 (#Length 1 Chars)           |
+                |------------------------------------------------|
+                |                     ...                        |
                 |________________________________________________|
 
-                Root in an answer to the Reunion Hello message will send this packet to the target node.
-                In this packet, all the nodes (IP, port) exist in order by path traversal to target.
+            The answer to a Join with high-watermarks: every Message the child has missed, in one packet. The child
+            handles each of them like a Sequenced Message from the sender.
+
+        Replicate:
+            Request:
+
+                                ** Body Format **
+                 ________________________________________________
+                |                  REQ (3 Chars)                 |
+                |________________________________________________|
+
+                A standby root asks the root to replicate its state to it; It sends this packet again every reunion
+                interval as its heartbeat, and the root's ACKs are the root's heartbeat.
+
+            Snapshot and Log:
+
+                                ** Body Format **
+                 ________________________________________________
+                |              SNP or LOG (3 Chars)              |
+                |------------------------------------------------|
+                |       Records (2 Hex Chars per Byte)           |
+                |________________________________________________|
+
+                The root answers a new standby with a Snapshot of its whole state and then sends it every change in
+                Log packets; The records are those of the RootStore snapshot and log files.
             
     
 """
+import lzma
+import os
+import zlib
+from array import array
+from itertools import accumulate
 from struct import *
 
-from src.tools.helpers import ip_parts_integer, ip_int_parts_to_15byte
+from src.tools.helpers import peer_address, peer_hex, peer_id_from_parts, peer_id_parts, peer_string, \
+	parse_peer_string, to_peer_id
 
 
 class PacketType:
@@ -188,11 +327,66 @@ class PacketType:
 	JOIN = 3
 	MESSAGE = 4
 	REUNION = 5
+	LEAVE = 6
+	SYNC = 7
+	REPLICATE = 8
+
+	@staticmethod
+	def get_name(type):
+		"""
+
+		:return: Name of the packet type, like 'REUNION'.
+		:rtype: str
+		"""
+		for name, value in vars(PacketType).items():
+			if value == type and name.isupper():
+				return name
+		return str(type)
+
+
+class PacketFlag:
+	"""
+	Flags live in the high byte of the header type field.
+	"""
+	FRAGMENT = 0x01
+	ZLIB = 0x02
+	LZMA = 0x04
+	ACCEPTS_COMPRESSION = 0x08
+	ACCEPTS_DATAGRAMS = 0x10
+	SEQUENCED = 0x20
+
+	COMPRESSION = ZLIB | LZMA
+
+	@staticmethod
+	def compression_for(name):
+		"""
+
+		:param name: 'zlib', 'lzma' or 'none'.
+		:return: The compression flag, or 0 for no compression.
+		:rtype: int
+		"""
+		return {'zlib': PacketFlag.ZLIB, 'lzma': PacketFlag.LZMA}.get(name.lower(), 0)
 
 
+COMPRESSORS = {
+	PacketFlag.ZLIB: (zlib.compress, zlib.decompress),
+	PacketFlag.LZMA: (lzma.compress, lzma.decompress),
+}
+
 
 VERSION = 1
 pack_header_format = 'h h i h h h h i ' # version - type - length - ip_1 - ip_2 - ip_3 - ip_4 - port
+# Compiled once; Packets are decoded by the thousand during Hello storms.
+HEADER = Struct(pack_header_format)
+HEADER_SIZE = HEADER.size
+MAX_FRAGMENT_PAYLOAD = 1900  # Keeps every fragment packet inside one 2048 byte TCPServer read.
+FRAGMENT_HEADER_SIZE = 28
+# A Reunion Hello Back path entry is a peer ID in 12 hex characters.
+HELLOBACK_ENTRY_SIZE = 12
+# Origin (12 hex characters) and sequence number (16 hex characters) of a Sequenced Message.
+SEQUENCE_HEADER_SIZE = 28
+# Origin, sequence number, flags (2 hex characters) and length (8 characters) of a Message in a Sync packet.
+SYNC_ENTRY_HEADER_SIZE = 38
 
 
 class Packet:
@@ -203,21 +397,51 @@ class Packet:
 		:param buf: Input buffer was just decoded.
 		:type buf: bytes
 		"""
-		self.length = self.__get_body_length(buf)
-		pack_format = pack_header_format + f'{self.length}s'
-		self.version, self.type, _, ip_1, ip_2, ip_3, ip_4, port, self.body = unpack(pack_format, buf)
+		self.version, type, self.length, ip_1, ip_2, ip_3, ip_4, port = HEADER.unpack_from(buf)
+		if len(buf) != HEADER_SIZE + self.length:
+			raise error(f'a packet of {len(buf)} bytes can not have a body of {self.length} bytes')
+
+		self.type = type & 0xff
+		self.flags = type >> 8
+		if self.flags & PacketFlag.COMPRESSION:
+			# Kept as it is on the wire; Only inflated when somebody reads the body.
+			self._payload = bytes(buf[HEADER_SIZE:])
+			self._body = None
+		else:
+			self._payload = None
+			self._body = str(buf[HEADER_SIZE:], 'utf-8')
+		self.source_id = peer_id_from_parts(ip_1, ip_2, ip_3, ip_4, port)
+		# Reunion packets are passed on hop by hop; Their buffer is kept to be patched and sent on as it is (see
+		# set_helloback_hop and get_buf).
+		self._buf = bytearray(buf) if self.type == PacketType.REUNION else None
+
+	@staticmethod
+	def get_type_of(buf):
+		"""
 
-		self.body = self.body.decode('utf-8')
-		self.source_ip = ip_int_parts_to_15byte(ip_1, ip_2, ip_3, ip_4)
-		self.source_port = str(port).zfill(5)
+		:param buf: An encoded packet.
+		:return: Its type, without decoding the rest of it.
+		:rtype: int
+		"""
+		return unpack_from('h', buf, 2)[0] & 0xff
 
-	def __get_body_length(self, buf):
+	@staticmethod
+	def get_frame_size(buf, length):
 		"""
-		:param buf: the input buffer for initiating packet
-		:return: length of packet's body
+		Size of the packet at the start of a receive buffer, for splitting a TCP stream into packets.
+
+		:param buf: The receive buffer.
+		:param length: Number of bytes received into it so far.
+
+		:type buf: bytearray
+		:type length: int
+
+		:return: Header plus body size; None while the header has not fully arrived.
 		:rtype: int
 		"""
-		return unpack('i', buf[4:8])[0]
+		if length < HEADER_SIZE:
+			return None
+		return HEADER_SIZE + unpack_from('i', buf, 4)[0]
 
 
 	def get_version(self):
@@ -244,6 +468,23 @@ class Packet:
 		"""
 		return self.length
 
+	@property
+	def body(self):
+		if self._body is None:
+			if self._payload is None:
+				self._body = str(self._buf[HEADER_SIZE:], 'utf-8')
+			else:
+				decompress = COMPRESSORS[self.flags & PacketFlag.COMPRESSION][1]
+				self._body = decompress(self._payload).decode('utf-8')
+		return self._body
+
+	@body.setter
+	def body(self, body):
+		self._body = body
+		self._payload = None
+		self._buf = None
+		self.flags &= ~PacketFlag.COMPRESSION
+
 	def get_body(self):
 		"""
 
@@ -252,6 +493,47 @@ class Packet:
 		"""
 		return self.body
 
+	def is_compressed(self):
+		return bool(self.flags & PacketFlag.COMPRESSION)
+
+	def get_compressed(self, compression, threshold=0):
+		"""
+		A compressed copy of this packet, or the packet itself when compressing is not worth it.
+
+		:param compression: PacketFlag.ZLIB or PacketFlag.LZMA.
+		:param threshold: Bodies shorter than this many bytes are not compressed.
+
+		:type compression: int
+		:type threshold: int
+
+		:rtype: Packet
+		"""
+		if self.is_compressed() or self.type != PacketType.MESSAGE:
+			return self
+		data = self.body.encode()
+		if len(data) < threshold:
+			return self
+		payload = COMPRESSORS[compression][0](data)
+		if len(payload) >= len(data):
+			return self
+		packet = Packet(self.get_buf())
+		packet.flags |= compression
+		packet._payload = payload
+		packet._body = self._body
+		return packet
+
+	def get_decompressed(self):
+		"""
+
+		:return: A plain copy of a compressed packet.
+		:rtype: Packet
+		"""
+		if not self.is_compressed():
+			return self
+		packet = Packet(self.get_buf())
+		packet.body = self.body
+		return packet
+
 	def get_buf(self):
 		"""
 		In this function, we will make our final buffer that represents the Packet with the Struct class methods.
@@ -259,11 +541,23 @@ class Packet:
 		:return The parsed packet to the network format.
 		:rtype: bytes
 		"""
-		self.length = len(self.body)
-		pack_format = pack_header_format + f'{self.length}s'
-		ip_1, ip_2, ip_3, ip_4 = ip_parts_integer(self.source_ip)
-		return pack(pack_format, self.version, self.type, self.length, ip_1, ip_2, ip_3, ip_4, int(self.source_port),
-					self.body.encode())
+		if self._buf is not None:
+			# Only the header may have changed (source, flags); The body is sent on as it is.
+			HEADER.pack_into(self._buf, 0, self.version, self.type | (self.flags << 8), self.length,
+							 *peer_id_parts(self.source_id))
+			return bytes(self._buf)
+		body = self._payload if self._payload is not None else self._body.encode()
+		self.length = len(body)
+		return HEADER.pack(self.version, self.type | (self.flags << 8), self.length, *peer_id_parts(self.source_id)) + \
+			body
+
+	@property
+	def source_ip(self):
+		return peer_address(self.source_id)[0]
+
+	@property
+	def source_port(self):
+		return peer_address(self.source_id)[1]
 
 	def get_source_server_ip(self):
 		"""
@@ -287,7 +581,15 @@ class Packet:
 		:return: Server address; The format is like ('192.168.001.001', '05335').
 		:rtype: tuple
 		"""
-		return self.source_ip, self.source_port
+		return peer_address(self.source_id)
+
+	def get_source_id(self):
+		"""
+
+		:return: Peer ID of the sender of the packet.
+		:rtype: int
+		"""
+		return self.source_id
 
 	def is_reunion_hello(self):
 		return self.type == PacketType.REUNION and self.body.startswith('REQ')
@@ -296,7 +598,199 @@ class Packet:
 		return self.type == PacketType.REUNION and self.body.startswith('RES')
 
 	def get_first_address_hello_packet(self):
-		return (self.body[5:20], self.body[20:25])
+		return parse_peer_string(self.body[5:25])
+
+	def get_last_address_hello_packet(self):
+		return parse_peer_string(self.body[-20:])
+
+	def get_hello_path(self):
+		"""
+
+		:return: Peer IDs on the path of a Reunion Hello, from the node that sent it up to the root's child.
+		:rtype: list
+		"""
+		return [parse_peer_string(self.body[i:i + 20]) for i in range(5, len(self.body) - 19, 20)]
+
+	def get_parent_address_hello_packet(self):
+		"""
+
+		:return: Peer ID of the parent of the node that sent a Reunion Hello; None if its parent is the root.
+		:rtype: int
+		"""
+		if int(self.body[3:5]) < 2:
+			return None
+		return parse_peer_string(self.body[25:45])
+
+	def get_helloback_hop(self):
+		"""
+
+		:return: Index of the receiver in the path of a Reunion Hello Back.
+		:rtype: int
+		"""
+		return int(self.body[3:5])
+
+	def set_helloback_hop(self, hop):
+		"""
+		Point a received Reunion Hello Back at its next hop: the fixed-width hop index is patched in the kept buffer
+		and the body is not rebuilt.
+
+		:param hop: Index of the next receiver in the path.
+		:type hop: int
+
+		:return:
+		"""
+		if self._buf is None:
+			self.body = 'RES' + str(hop).zfill(2) + self.body[5:]
+			return
+		self._buf[HEADER_SIZE + 3:HEADER_SIZE + 5] = b'%02d' % hop
+		# Decoded again from the buffer if anybody reads it.
+		self._body = None
+
+	def get_helloback_path_length(self):
+		return (len(self.body) - 5) // HELLOBACK_ENTRY_SIZE
+
+	def get_helloback_address(self, index):
+		"""
+
+		:param index: Index of an entry of the path of a Reunion Hello Back.
+		:return: Peer ID of that entry.
+		:rtype: int
+		"""
+		start = 5 + index * HELLOBACK_ENTRY_SIZE
+		return int(self.body[start:start + HELLOBACK_ENTRY_SIZE], 16)
+
+	def get_redirect_address(self):
+		"""
+
+		:return: Peer ID of the sub-root in a Register Response that redirects; None for any other Register packet.
+		:rtype: int
+		"""
+		if not self.body.startswith('RESRED') or len(self.body) < 26:
+			return None
+		return parse_peer_string(self.body[6:26])
+
+	def is_register_refusal(self):
+		"""
+
+		:return: Whether this is a Register Response that tells the receiver to register again.
+		:rtype: bool
+		"""
+		return self.type == PacketType.REGISTER and self.body == 'RESNAK'
+
+	def get_advertised_neighbour(self):
+		"""
+
+		:return: Peer ID of the new parent in an Advertise Response.
+		:rtype: int
+		"""
+		return parse_peer_string(self.body[3:23])
+
+	def get_advertised_backups(self):
+		"""
+
+		:return: Peer IDs of the backup parents in an Advertise Response.
+		:rtype: list
+		"""
+		return [parse_peer_string(self.body[i:i + 20]) for i in range(23, len(self.body) - 19, 20)]
+
+	def get_replaced_address(self):
+		"""
+
+		:return: Peer ID of the dead parent named in a Join packet, or None.
+		:rtype: int
+		"""
+		if len(self.body) < 24 or self.body.startswith('SYNC', 4):
+			return None
+		return parse_peer_string(self.body[4:24])
+
+	def get_join_watermarks(self):
+		"""
+
+		:return: {origin: high-watermark} of a Join packet; None if the sender did not ask for a delta sync.
+		:rtype: dict
+		"""
+		start = self.body.find('SYNC', 4)
+		if start < 0:
+			return None
+		return {int(self.body[i:i + 12], 16): int(self.body[i + 12:i + 28], 16)
+				for i in range(start + 4, len(self.body) - 27, 28)}
+
+	def get_synced_messages(self):
+		"""
+
+		:return: [(origin, sequence number, flags, body), ...] of a Sync packet.
+		:rtype: list
+		"""
+		body = self.body
+		messages = []
+		offset = 0
+		while offset + SYNC_ENTRY_HEADER_SIZE <= len(body):
+			length = int(body[offset + 30:offset + 38])
+			start = offset + SYNC_ENTRY_HEADER_SIZE
+			messages.append((int(body[offset:offset + 12], 16), int(body[offset + 12:offset + 28], 16),
+							 int(body[offset + 28:offset + 30], 16), body[start:start + length]))
+			offset = start + length
+		return messages
+
+	def get_replicated_records(self):
+		"""
+
+		:return: The RootStore records of a Replicate Snapshot or Log packet.
+		:rtype: bytes
+		"""
+		return bytes.fromhex(self.body[3:])
+
+	def get_advertised_capacity(self):
+		"""
+
+		:return: The number of children the sender of an Advertise Request takes, or None if it did not say.
+		:rtype: int
+		"""
+		capacity = self.body[3:5]
+		return (int(capacity) or None) if capacity.isdigit() else None
+
+	def get_rejoin_token(self):
+		"""
+
+		:return: The rejoin token of a Register Response or an Advertise Request; None if it has none.
+		:rtype: str
+		"""
+		if self.type == PacketType.REGISTER:
+			token = self.body[6:] if self.body.startswith('RESACK') else ''
+		else:
+			token = self.body[5:] if self.body.startswith('REQ') else ''
+		return token or None
+
+	def is_fragment(self):
+		return self.type == PacketType.MESSAGE and self.flags & PacketFlag.FRAGMENT
+
+	def is_sequenced(self):
+		return self.type == PacketType.MESSAGE and self.flags & PacketFlag.SEQUENCED
+
+	def get_sequence(self):
+		"""
+
+		:return: (origin, sequence number) of a Sequenced Message.
+		:rtype: tuple
+		"""
+		return int(self.body[:12], 16), int(self.body[12:SEQUENCE_HEADER_SIZE], 16)
+
+	def get_message_body(self):
+		"""
+
+		:return: The body of a Message without its sequence header.
+		:rtype: str
+		"""
+		return self.body[SEQUENCE_HEADER_SIZE:] if self.flags & PacketFlag.SEQUENCED else self.body
+
+	def get_fragment(self):
+		"""
+
+		:return: (message id, index, number of fragments, payload) of a fragment packet.
+		:rtype: tuple
+		"""
+		body = self.get_message_body()
+		return body[:16], int(body[16:22]), int(body[22:28]), body[FRAGMENT_HEADER_SIZE:]
 
 
 class PacketFactory:
@@ -305,12 +799,10 @@ class PacketFactory:
 	"""
 
 	@staticmethod
-	def __new_packet(version, type, length, source_ip, source_port, body):
-		ip_1, ip_2, ip_3, ip_4 = ip_parts_integer(source_ip)
-		port = int(source_port)
-		packet_format = pack_header_format + f'{length}s'
+	def __new_packet(version, type, length, source, body, flags=0):
 		body = bytes(body, encoding='utf-8')
-		buf = pack(packet_format, version, type, length, ip_1, ip_2, ip_3, ip_4, port, body)
+		length = len(body)
+		buf = HEADER.pack(version, type | (flags << 8), length, *peer_id_parts(to_peer_id(source))) + body
 		packet = Packet(buf)
 		return packet
 
@@ -327,120 +819,372 @@ class PacketFactory:
 		packet = Packet(buffer)
 		return packet
 
+	@staticmethod
+	def parse_batch(buffers):
+		"""
+		Decode a whole drained batch of buffers and group the packets by type, so that the handlers can take every
+		packet of a type at once (see Peer.handle_packets).
+
+		Warnings:
+			1. Undecodable buffers are dropped; One bad neighbour must not lose the packets of the others.
+
+		:param buffers: Received buffers, each holding one packet.
+		:type buffers: list
+
+		:return: {packet type: [Packet, ...]}; The packets of every type stay in order of arrival.
+		:rtype: dict
+		"""
+		batch = {}
+		buffers = [buf for buf in buffers if len(buf) >= HEADER_SIZE]
+		# One pass over all headers: cut out, joined and unpacked by one iter_unpack. The bodies are decoded as one
+		# string when they are all ASCII (Reunion Hellos and most others are), then every body is a slice of it.
+		headers = HEADER.iter_unpack(b''.join([buf[:HEADER_SIZE] for buf in buffers]))
+		bodies = b''.join([buf[HEADER_SIZE:] for buf in buffers])
+		bodies = bodies.decode('ascii') if bodies.isascii() else None
+		end = 0
+		for buf, (version, type, length, ip_1, ip_2, ip_3, ip_4, port) in zip(buffers, headers):
+			start = end
+			end += len(buf) - HEADER_SIZE
+			if len(buf) != HEADER_SIZE + length:
+				print(f'Dropping an undecodable buffer: a packet of {len(buf)} bytes can not have a body of {length} '
+					  f'bytes')
+				continue
+			packet = Packet.__new__(Packet)
+			packet.version = version
+			packet.type = type & 0xff
+			packet.flags = type >> 8
+			packet.length = length
+			packet.source_id = ip_1 << 40 | ip_2 << 32 | ip_3 << 24 | ip_4 << 16 | port
+			packet._payload = None
+			if packet.flags & PacketFlag.COMPRESSION:
+				# Kept as it is on the wire; Only inflated when somebody reads the body.
+				packet._payload = bytes(buf[HEADER_SIZE:])
+				packet._body = None
+			elif bodies is not None:
+				packet._body = bodies[start:end]
+			else:
+				try:
+					packet._body = str(buf[HEADER_SIZE:], 'utf-8')
+				except UnicodeDecodeError as e:
+					print('Dropping an undecodable buffer: ' + repr(e))
+					continue
+			packet._buf = bytearray(buf) if packet.type == PacketType.REUNION else None
+			packets = batch.get(packet.type)
+			if packets is None:
+				packets = batch[packet.type] = []
+			packets.append(packet)
+		return batch
+
+	@staticmethod
+	def encode_records(packets):
+		"""
+		Decoded packets in a form that is cheap to pickle and to turn into Packets again (see parse_records): a few
+		flat arrays and one string instead of an object per packet; For the ingress workers.
+
+		:param packets: Decoded packets.
+		:type packets: list
+
+		:return: (version | type << 16 | flags << 24 and source ID of every packet as uint64s, body size in characters
+				 and on the wire of every packet as uint32s, the plain bodies joined, the compressed payloads joined)
+		:rtype: tuple
+		"""
+		fields = array('Q')
+		sizes = array('I')
+		bodies = []
+		payloads = []
+		for packet in packets:
+			fields.append(packet.version | packet.type << 16 | packet.flags << 24)
+			fields.append(packet.source_id)
+			if packet.is_compressed():
+				payloads.append(packet._payload)
+				sizes.append(0)
+				sizes.append(len(packet._payload))
+			else:
+				bodies.append(packet.body)
+				sizes.append(len(packet.body))
+				sizes.append(packet.length)
+		return fields.tobytes(), sizes.tobytes(), ''.join(bodies), b''.join(payloads)
+
+	@staticmethod
+	def parse_records(fields, sizes, bodies, payloads):
+		"""
+		The packets of encode_records again; Nothing is decoded, only the fields are set.
+
+		:return: The packets in the order they were encoded.
+		:rtype: list
+		"""
+		fields = array('Q', fields)
+		sizes = array('I', sizes)
+		body_ends = list(accumulate(sizes[0::2]))
+		body_starts = [0] + body_ends[:-1]
+		payload_start = 0
+		packets = []
+		for meta, source_id, length, start, end in zip(fields[0::2], fields[1::2], sizes[1::2], body_starts,
+														 body_ends):
+			packet = Packet.__new__(Packet)
+			packet.version = meta & 0xffff
+			packet.type = meta >> 16 & 0xff
+			packet.flags = meta >> 24
+			packet.source_id = source_id
+			packet.length = length
+			packet._buf = None
+			if packet.flags & PacketFlag.COMPRESSION:
+				packet._body = None
+				packet._payload = payloads[payload_start:payload_start + length]
+				payload_start += length
+			else:
+				packet._body = bodies[start:end]
+				packet._payload = None
+			packets.append(packet)
+		return packets
+
 	@staticmethod
 	def new_reunion_packet(type, source_address, nodes_array):
 		"""
 		:param type: Reunion Hello (REQ) or Reunion Hello Back (RES)
-		:param source_address: IP/Port address of the packet sender.
-		:param nodes_array: [(ip0, port0), (ip1, port1), ...] It is the path to the 'destination'.
+		:param source_address: Peer ID (or IP/Port address) of the packet sender.
+		:param nodes_array: [peer id 0, peer id 1, ...] The path of the Hello, from the node that sent it towards the
+							root; A Hello Back goes the other way (see new_helloback_packet).
 
 		:type type: str
-		:type source_address: tuple
+		:type source_address: int
 		:type nodes_array: list
 
 		:return New reunion packet.
 		:rtype Packet
 		"""
-		source_ip, source_port = source_address
 		number_of_entries = str(len(nodes_array)).zfill(2)
-		addresses = [ip + port for ip, port in nodes_array]
+		addresses = [peer_string(to_peer_id(node)) for node in nodes_array]
 
 		if type == 'REQ':
 			full_body_string = 'REQ' + number_of_entries + ''.join(addresses)
 		elif type == 'RES':
-			addresses.reverse()
-			full_body_string = 'RES' + number_of_entries + ''.join(addresses)
+			return PacketFactory.new_helloback_packet(source_address, [to_peer_id(node) for node in nodes_array[::-1]])
 		else:
 			full_body_string = ''
 
-		return PacketFactory.__new_packet(VERSION, PacketType.REUNION, len(full_body_string), source_ip, source_port,
+		return PacketFactory.__new_packet(VERSION, PacketType.REUNION, len(full_body_string), source_address,
+										  body=full_body_string)
+
+	@staticmethod
+	def new_helloback_packet(source_address, path, hop=0):
+		"""
+		:param source_address: Peer ID of the packet sender.
+		:param path: [peer id 1, ..., target peer id] The tree path from the root's child down to the target.
+		:param hop: Index of the receiver in 'path'.
+
+		:type source_address: int
+		:type path: list
+		:type hop: int
+
+		:return New Reunion Hello Back packet.
+		:rtype Packet
+		"""
+		full_body_string = 'RES' + str(hop).zfill(2) + ''.join(peer_hex(node) for node in path)
+		return PacketFactory.__new_packet(VERSION, PacketType.REUNION, len(full_body_string), source_address,
 										  body=full_body_string)
 
 	@staticmethod
-	def new_advertise_packet(type, source_server_address, neighbour=None):
+	def new_advertise_packet(type, source_server_address, neighbour=None, capacity=None, backups=(), token=None):
 		"""
 		:param type: Type of Advertise packet
-		:param source_server_address Server address of the packet sender.
-		:param neighbour: The neighbour for advertise response packet; The format is like ('192.168.001.001', '05335').
+		:param source_server_address Peer ID (or server address) of the packet sender.
+		:param neighbour: Peer ID of the neighbour for advertise response packet.
+		:param capacity: For a request: the number of children the sender takes (1 to 99).
+		:param backups: For a response: Peer IDs of the backup parents.
+		:param token: For a request: the sender's rejoin token from its Register Response.
 
 		:type type: str
-		:type source_server_address: tuple
-		:type neighbour: tuple
+		:type source_server_address: int
+		:type neighbour: int
+		:type capacity: int
+		:type backups: list
+		:type token: str
 
 		:return New advertise packet.
 		:rtype Packet
 
 		"""
 
-		server_ip, server_port = source_server_address
 		if type == 'REQ':
-			body = 'REQ'
+			body = 'REQ' + (str(capacity or 0).zfill(2) if capacity or token else '') + (token or '')
 		elif type == 'RES':
 			if neighbour is None:
 				return None
-			neighbour_ip, neighbour_port = neighbour
-			body = 'RES' + neighbour_ip + neighbour_port
+			body = 'RES' + peer_string(to_peer_id(neighbour)) + ''.join(peer_string(backup) for backup in backups)
 		else:
 			body = ''
 
-		return PacketFactory.__new_packet(VERSION, PacketType.ADVERTISE, len(body), server_ip, server_port, body)
+		return PacketFactory.__new_packet(VERSION, PacketType.ADVERTISE, len(body), source_server_address, body)
 
 	@staticmethod
-	def new_join_packet(source_server_address):
+	def new_join_packet(source_server_address, replaced=None, watermarks=None):
 		"""
-		:param source_server_address: Server address of the packet sender.
+		:param source_server_address: Peer ID (or server address) of the packet sender.
+		:param replaced: Peer ID of the dead parent of the sender, when it joins a backup parent.
+		:param watermarks: {origin: highest sequence number seen} to ask for a delta sync of the missed Messages.
 
-		:type source_server_address: tuple
+		:type source_server_address: int
+		:type replaced: int
+		:type watermarks: dict
 
 		:return New join packet.
 		:rtype Packet
 
 		"""
-		body = 'JOIN'
-		return PacketFactory.__new_packet(VERSION, PacketType.JOIN, len(body), source_server_address[0],
-										  source_server_address[1], body)
+		body = 'JOIN' + (peer_string(replaced) if replaced else '')
+		if watermarks is not None:
+			body += 'SYNC' + ''.join(peer_hex(origin) + format(sequence, '016x')
+									 for origin, sequence in watermarks.items())
+		return PacketFactory.__new_packet(VERSION, PacketType.JOIN, len(body), source_server_address, body)
 
 	@staticmethod
-	def new_register_packet(type, source_server_address, address=(None, None)):
+	def new_leave_packet(source_server_address):
+		"""
+		:param source_server_address: Peer ID (or server address) of the packet sender.
+
+		:type source_server_address: int
+
+		:return New leave packet.
+		:rtype Packet
+
+		"""
+		body = 'LEAVE'
+		return PacketFactory.__new_packet(VERSION, PacketType.LEAVE, len(body), source_server_address, body)
+
+	@staticmethod
+	def new_register_packet(type, source_server_address, address=None, redirect=None, token=None, refused=False):
 		"""
 		:param type: Type of Register packet
-		:param source_server_address: Server address of the packet sender.
-		:param address: If 'type' is 'request' we need an address; The format is like ('192.168.001.001', '05335').
+		:param source_server_address: Peer ID (or server address) of the packet sender.
+		:param address: If 'type' is 'request' we need an address; A peer ID.
+		:param redirect: For a response: Peer ID of the sub-root the receiver should register at instead.
+		:param token: For a response: the receiver's rejoin token.
+		:param refused: For a response: the receiver is not registered (e.g. the root has restarted without its state)
+						and has to register again.
 
 		:type type: str
-		:type source_server_address: tuple
-		:type address: tuple
+		:type source_server_address: int
+		:type address: int
+		:type redirect: int
+		:type token: str
+		:type refused: bool
 
 		:return New Register packet.
 		:rtype Packet
 
 		"""
-		source_ip, source_port = source_server_address
 		if type == 'REQ':
-			body ='REQ' + address[0] + address[1]
+			body ='REQ' + peer_string(to_peer_id(address))
+		elif type == 'RES' and refused:
+			body = 'RESNAK'
 		elif type == 'RES':
-			body = 'RESACK'
+			body = 'RESRED' + peer_string(to_peer_id(redirect)) if redirect is not None else 'RESACK' + (token or '')
 		else:
 			body = ''
 
-		return PacketFactory.__new_packet(VERSION, PacketType.REGISTER, len(body), source_ip, source_port, body)
+		return PacketFactory.__new_packet(VERSION, PacketType.REGISTER, len(body), source_server_address, body)
 
 	@staticmethod
-	def new_message_packet(message, source_server_address):
+	def new_message_packet(message, source_server_address, origin=None, sequence=None, flags=0):
 		"""
 		Packet for sending a broadcast message to the whole network.
 
 		:param message: Our message
-		:param source_server_address: Server address of the packet sender.
+		:param source_server_address: Peer ID (or server address) of the packet sender.
+		:param origin: Peer ID of the peer that broadcast the message first; With 'sequence', makes a Sequenced
+					   Message.
+		:param sequence: Sequence number of the message at its origin.
+		:param flags: Other packet flags, e.g. Fragment when 'message' is a fragment body.
 
 		:type message: str
-		:type source_server_address: tuple
+		:type source_server_address: int
+		:type origin: int
+		:type sequence: int
+		:type flags: int
 
 		:return: New Message packet.
 		:rtype: Packet
 		"""
 		body = message
-		return PacketFactory.__new_packet(VERSION, PacketType.MESSAGE, len(body), source_server_address[0],
-										  source_server_address[1], body)
+		if origin is not None:
+			body = peer_hex(origin) + format(sequence, '016x') + body
+			flags |= PacketFlag.SEQUENCED
+		return PacketFactory.__new_packet(VERSION, PacketType.MESSAGE, len(body), source_server_address, body,
+										  flags=flags)
+
+	@staticmethod
+	def new_message_packets(message, source_server_address, origin=None, sequence=None):
+		"""
+		Like new_message_packet, but messages that do not fit in one packet are split into Fragment packets.
+		The packets are generated lazily so a big message is never held as packets all at once.
+
+		:param message: Our message
+		:param source_server_address: Peer ID (or server address) of the packet sender.
+		:param origin: Peer ID of the origin for Sequenced Messages.
+		:param sequence: Iterator of sequence numbers (e.g. itertools.count); Every packet takes the next one.
 
+		:type message: str
+		:type source_server_address: int
+		:type origin: int
+		:type sequence: iterator
+
+		:return: Message packets in sending order.
+		:rtype: generator
+		"""
+		data = message.encode('utf-8')
+		if len(data) <= MAX_FRAGMENT_PAYLOAD:
+			yield PacketFactory.new_message_packet(message, source_server_address, origin,
+												   next(sequence) if origin is not None else None)
+			return
+
+		pieces = []
+		start = 0
+		while start < len(data):
+			end = min(start + MAX_FRAGMENT_PAYLOAD, len(data))
+			# Never cut a multi-byte character in half.
+			while end < len(data) and data[end] & 0xc0 == 0x80:
+				end -= 1
+			pieces.append((start, end))
+			start = end
+
+		message_id = os.urandom(8).hex()
+		total = str(len(pieces)).zfill(6)
+		for index, (start, end) in enumerate(pieces):
+			body = message_id + str(index).zfill(6) + total + data[start:end].decode('utf-8')
+			yield PacketFactory.new_message_packet(body, source_server_address, origin,
+												   next(sequence) if origin is not None else None,
+												   flags=PacketFlag.FRAGMENT)
 
+	@staticmethod
+	def new_sync_packet(source_server_address, entries):
+		"""
+		:param source_server_address: Peer ID (or server address) of the packet sender.
+		:param entries: The missed Messages, as BroadcastLog LogEntry objects.
+
+		:type source_server_address: int
+		:type entries: list
+
+		:return: New Sync packet.
+		:rtype: Packet
+		"""
+		body = ''.join(peer_hex(entry.origin) + format(entry.sequence, '016x') + format(entry.flags, '02x') +
+					   str(len(entry.body)).zfill(8) + entry.body for entry in entries)
+		return PacketFactory.__new_packet(VERSION, PacketType.SYNC, len(body), source_server_address, body)
+
+	@staticmethod
+	def new_replicate_packet(type, source_server_address, records=b''):
+		"""
+		:param type: REQ (from a standby root), SNP (a snapshot) or LOG (changes).
+		:param source_server_address: Peer ID (or server address) of the packet sender.
+		:param records: RootStore snapshot records for SNP or log records for LOG.
+
+		:type type: str
+		:type source_server_address: int
+		:type records: bytes
+
+		:return: New Replicate packet.
+		:rtype: Packet
+		"""
+		body = type + records.hex()
+		return PacketFactory.__new_packet(VERSION, PacketType.REPLICATE, len(body), source_server_address, body)
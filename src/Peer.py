@@ -1,7 +1,19 @@
 from src.Stream import Stream
-from src.Packet import Packet, PacketFactory, PacketType
+from src.Packet import Packet, PacketFactory, PacketType, PacketFlag
 from src.UserInterface import UserInterface
-from src.tools.NetworkGraph import NetworkGraph, GraphNode
+from src.tools.NetworkGraph import NetworkGraph, GraphNode, HelloTimes
+from src.tools.ArrayGraph import ArrayGraph, ArrayHelloTimes
+from src.tools.MessageAssembler import MessageAssembler
+from src.tools.Admission import AdmissionQueue
+from src.tools.BroadcastLog import BroadcastLog
+from src.tools.HashRing import HashRing
+from src.tools.Profiler import Profiler
+from src.tools.RejoinTokens import RejoinTokens
+from src.tools.RootStore import RootStore
+from src.tools.helpers import parse_peer_list, parse_peer_string, peer_address, peer_id, peer_string, to_peer_id
+import itertools
+import os
+import sys
 import time
 import threading
 
@@ -14,7 +26,9 @@ import threading
 
 
 class Peer:
-	def __init__(self, server_ip, server_port, is_root=False, root_address=None):
+	def __init__(self, server_ip, server_port, is_root=False, root_address=None, threaded=True, server_loop=None,
+				 root_workers=None, state_dir=None, fan_out=None, datagrams=None, sub_roots=None, standby_for=None,
+				 allowed_standbys=None):
 		"""
 		The Peer object constructor.
 
@@ -34,19 +48,55 @@ class Peer:
 		:param server_ip: Server IP address for this Peer that should be pass to Stream.
 		:param server_port: Server Port address for this Peer that should be pass to Stream.
 		:param is_root: Specify that is this Peer root or not.
-		:param root_address: Root IP/Port address if we are a client.
+		:param root_address: Root peer ID (or IP/Port address) if we are a client; For a root, the root above it if it
+							 is a sub-root of a federation.
+		:param threaded: Run the reunion daemon in a thread of its own; PeerHost drives Peers without any threads.
+		:param server_loop: Serve our TCPServer from this shared ServerLoop instead of a thread of its own.
+		:param root_workers: For the root only: number of worker processes that receive and decode packets
+							 (default P2P_ROOT_WORKERS or 0, i.e. everything on this process).
+		:param state_dir: For the root only: keep the root state in this directory and restore it on start
+						  (default P2P_STATE_DIR, or nothing is kept).
+		:param fan_out: Most children (successors) this Peer takes, 1 to 99; It is told to the root in Advertise
+						Requests and the root's value is the default for the whole network (default P2P_FAN_OUT or 2).
+		:param datagrams: Send and receive Reunion packets as UDP datagrams with neighbours that do the same
+						  (default P2P_DATAGRAMS=1, otherwise off).
+		:param sub_roots: For the root only: peer IDs (or IP/Port addresses) of its sub-roots; New peers are spread over
+						  them by consistent hashing (default P2P_SUB_ROOTS like '127.0.0.1:5001,127.0.0.1:5002', or
+						  none, i.e. the root keeps every peer itself).
+		:param standby_for: For a root only: peer ID (or IP/Port address) of the root this one is a hot standby of; It
+							mirrors that root's state and takes its place when it dies (default P2P_STANDBY_FOR, or
+							none).
+		:param allowed_standbys: For a root only: peer IDs (or IP/Port addresses) of the roots that may mirror our state
+								 as hot standbys (default P2P_STANDBYS like '127.0.0.1:5001', or none).
 
 		:type server_ip: str
 		:type server_port: int
 		:type is_root: bool
-		:type root_address: tuple
+		:type root_address: int
+		:type threaded: bool
+		:type server_loop: ServerLoop
+		:type root_workers: int
+		:type state_dir: str
+		:type fan_out: int
+		:type datagrams: bool
+		:type sub_roots: list
+		:type standby_for: int
+		:type allowed_standbys: list
 		"""
 		if root_address:
-			root_address = (root_address[0], str(root_address[1]).zfill(5))
-		server_port = str(server_port).zfill(5)
+			root_address = to_peer_id(root_address)
 		self.is_root = is_root
 		self.is_client_connected = False
-		self.client_predecessor_address = tuple()
+		self.client_predecessor_address = None
+		self.client_backup_parents = []  # Peer IDs the root handed out; We join them if our parent dies.
+		self.client_parent_is_backup = False
+		self.client_is_advertising = False  # An Advertise Request of ours has not been answered yet.
+		self.client_last_advertise_time = 0
+		# Seconds we wait for an Advertise Response before we ask again; Doubles after every try up to the maximum.
+		self.client_advertise_retry_min = 5
+		self.client_advertise_retry_max = 60
+		self.client_advertise_retry = self.client_advertise_retry_min
+		self.client_rejoin_token = None  # From the root's Register Response; Sent with our Advertise Requests.
 		self.successors_address = []
 		self.client_is_waiting_for_helloback = False
 		self.register_node = None
@@ -55,29 +105,155 @@ class Peer:
 		self.client_timeout_threshold = 10
 		self.root_timeout_threshold = 10
 		self.client_last_hello_time = 0
-		self.nodes_for_root = {}  # {(address) : last_time_hello_came}
-		self.address = (server_ip, server_port)
-		self.stream = Stream(server_ip, server_port)
-		self.user_interface = UserInterface()
+		self.client_last_forward_time = 0  # When we last forwarded a Hello of our sub-tree.
+		self.nodes_for_root = HelloTimes()  # {peer id : last_time_hello_came}
+		self.message_assembler = MessageAssembler()
+		self.broadcast_log = BroadcastLog()
+		# Starts from the clock so that a restarted Peer does not reuse its old sequence numbers.
+		self.message_sequence = itertools.count(time.time_ns() // 1000)
+		self.fan_out = fan_out or int(os.environ.get('P2P_FAN_OUT', '2'))
+		if not 1 <= self.fan_out <= 99:
+			# Advertise Requests carry it in two digits.
+			raise ValueError(f'fan_out must be 1 to 99, not {self.fan_out}')
+		# Peers are known by their peer IDs (see tools.helpers); Addresses are only formatted for packets and prints.
+		self.address = peer_id(server_ip, server_port)
+		self.profiler = Profiler.from_environment()
+		if root_workers is None:
+			root_workers = int(os.environ.get('P2P_ROOT_WORKERS', '0'))
+		if not is_root or server_loop is not None:
+			root_workers = 0
+		if datagrams is None:
+			datagrams = os.environ.get('P2P_DATAGRAMS', '0') == '1'
+		# Peers of the same host talk through Unix domain sockets unless P2P_UNIX_SOCKETS=0.
+		unix_sockets = os.environ.get('P2P_UNIX_SOCKETS', '1') == '1'
+		self.stream = Stream(server_ip, server_port, profiler=self.profiler, server_loop=server_loop,
+							 ingress_processes=root_workers, send_threads=root_workers, datagrams=datagrams,
+							 unix_sockets=unix_sockets)
+		# Message compression (P2P_COMPRESSION=zlib or lzma, otherwise off); Only used towards neighbours whose packets
+		# carry PacketFlag.ACCEPTS_COMPRESSION. Off by default: peers that do not know the flags can't read the type of
+		# packets that carry them.
+		self.compression = PacketFlag.compression_for(os.environ.get('P2P_COMPRESSION', 'none'))
+		self.compression_threshold = 256
+		self.compression_neighbours = set()
+		self.stream.accepts_compression = bool(self.compression)
+		# Reunion packets go as datagrams to the neighbours whose packets carry PacketFlag.ACCEPTS_DATAGRAMS.
+		self.datagram_neighbours = set()
+		self.threaded = threaded
+		self.reunion_daemon_started = False
+		self.loop_interval = 2
+		self.reunion_interval = 4
+		self.wakeup_event = threading.Event()
+		self.user_interface = UserInterface(on_command=self.wake_up)
 
 		if self.is_root:
-			graph_node_root = GraphNode(self.address)
-			self.network_graph = NetworkGraph(graph_node_root)
-			reunion_thread = threading.Thread(target=self.run_reunion_daemon)
-			reunion_thread.start()
+			self.admission = AdmissionQueue()
+			# Moving sub-trees closer to the root after churn; At most rebalance_moves moves per rebalance_interval.
+			self.rebalance_interval = 10
+			self.rebalance_moves = 2
+			self.rebalance_threshold = 2
+			self.rebalance_cooldown = 60
+			self.last_rebalance_time = time.time()
+			# P2P_GRAPH_BACKEND=numpy keeps the root state in NumPy arrays too, for networks of very many peers.
+			self.graph_class, self.hello_times_class = NetworkGraph, HelloTimes
+			if os.environ.get('P2P_GRAPH_BACKEND', 'python') == 'numpy':
+				if ArrayGraph.available():
+					self.graph_class, self.hello_times_class = ArrayGraph, ArrayHelloTimes
+					self.nodes_for_root = ArrayHelloTimes()
+				else:
+					print('NumPy is not installed; Using the plain NetworkGraph')
+			# A federation: the root sends new peers to its live sub-roots and passes Messages between them.
+			if sub_roots is None:
+				sub_roots = parse_peer_list(os.environ.get('P2P_SUB_ROOTS', ''))
+			self.sub_roots = HashRing([to_peer_id(sub_root) for sub_root in sub_roots]) if sub_roots else None
+			self.redirected = []  # Peers we have just sent to a sub-root; Their connections are closed after sending.
+			self.upper_root_address = root_address
+			# A hot standby mirrors the state of another root (the primary) until it takes over.
+			if standby_for is None and os.environ.get('P2P_STANDBY_FOR'):
+				standby_for = parse_peer_list(os.environ['P2P_STANDBY_FOR'])[0]
+			self.standby_for = to_peer_id(standby_for) if standby_for else None
+			if allowed_standbys is None:
+				allowed_standbys = parse_peer_list(os.environ.get('P2P_STANDBYS', ''))
+			# Only these roots get our state; A standby takes its primary too, for when it stands by for us after a
+			# take over.
+			self.allowed_standbys = {to_peer_id(standby) for standby in allowed_standbys}
+			if self.standby_for is not None:
+				self.allowed_standbys.add(self.standby_for)
+			self.deposed_root = None  # The primary we have taken over from, until it stands by for us.
+			self.standby_synced = False
+			self.standby_timeout = 6
+			self.standbys = []  # Peer IDs of our own standby roots.
+			self.replication_buffer = []  # Log records of the changes not sent to the standbys yet.
+			self.replication_lock = threading.Lock()
+			self.root_store = RootStore(state_dir) if state_dir else RootStore.from_environment()
+			self.rejoin_tokens = RejoinTokens.from_environment(self.root_store)
+			if self.standby_for is not None:
+				self.network_graph = self.graph_class(GraphNode(self.standby_for, self.fan_out))
+			elif self.root_store is not None:
+				self.__restore_root_state()
+			else:
+				graph_node_root = GraphNode(self.address, self.fan_out)
+				self.network_graph = self.graph_class(graph_node_root)
+			self.start_reunion_daemon()
+			if self.upper_root_address:
+				print("Set upper root address! " + str(peer_address(self.upper_root_address)))
+				self.__greet_upper_root()
+			if self.standby_for is not None:
+				print("Standing by for the root " + str(peer_address(self.standby_for)))
+				self.__watch_primary()
 		else:
 			self.root_address = root_address
-			print("Set root address! " + str(self.root_address))
+			# A sub-root may get us later; Back to this one if the sub-root is gone.
+			self.client_first_root_address = root_address
+			print("Set root address! " + str(peer_address(self.root_address)))
 			self.stream.add_node(self.root_address, True)
 
-	def start_user_interface(self):
+	def __restore_root_state(self):
+		"""
+		Load the saved NetworkGraph and nodes_for_root and reconnect to the nodes they contain, so the network can go
+		on with its Reunion Hellos instead of advertising again.
+
+		:return:
+		"""
+		self.network_graph, nodes_for_root = self.root_store.load(self.address, self.fan_out, self.graph_class)
+		self.nodes_for_root = self.hello_times_class(nodes_for_root)
+		for address in self.nodes_for_root:
+			self.stream.add_node(address)
+		self.successors_address = [child.address for child in self.network_graph.root.get_children()]
+		self.root_store.snapshot(self.network_graph, self.nodes_for_root)
+
+	def start_user_interface(self, script=None, control_port=None):
 		"""
 		For starting UserInterface thread.
 
+		Without a script, commands are read interactively; When stdin is not a terminal (a pipe or a file), it is
+		read as a script instead.
+
+		:param script: Path of a command file ('-' for stdin) for non-interactive mode.
+		:param control_port: Also accept commands on this local TCP port.
+
+		:type script: str
+		:type control_port: int
+
 		:return:
 		"""
 		print('Starting User Interface')
-		self.user_interface.run()
+		if control_port is not None:
+			port = self.user_interface.start_control_socket(control_port)
+			print(f'Accepting commands on 127.0.0.1:{port}')
+		if script is None and not sys.stdin.isatty():
+			script = '-'
+		if script is not None:
+			self.user_interface.run_script(script)
+		else:
+			self.user_interface.run()
+
+	def wake_up(self):
+		"""
+		Make the main loop run its next iteration now instead of at the end of its sleep.
+
+		:return:
+		"""
+		self.wakeup_event.set()
 
 	def handle_user_interface_buffer(self):
 		"""
@@ -86,31 +262,70 @@ class Peer:
 			1. Register:  With this command, the client send a Register Request packet to the root of the network.
 			2. Advertise: Send an Advertise Request to the root of the network for finding first hope.
 			3. SendMessage: The following string will be added to a new Message packet and broadcast through the network.
+			   Long messages are split into Fragment packets.
+			4. Profile: 'Profile on|off|cprofile|sample|stats|reset|dump <path-prefix>' controls the built-in profiler.
 
 		Warnings:
 			1. Ignore irregular commands from the user.
-			2. Don't forget to clear our UserInterface buffer.
+			2. Drain the UserInterface queue with get_commands; Input threads keep adding to it meanwhile.
 		:return:
 		"""
-		for message in self.user_interface.buffer:
+		for message in self.user_interface.get_commands():
 			print('handling : ' + message)
-			if message == 'Register':
+			if message in ('Register', 'Advertise') and self.is_root:
+				continue
+			elif message == 'Register':
 				reg_packet = PacketFactory.new_register_packet("REQ", self.address, self.address)
 				self.send_packet(reg_packet, self.root_address)
 				self.stream.send_out_buf_messages(only_register=True)
 			elif message == 'Advertise':
-				advertise_packet = PacketFactory.new_advertise_packet(type="REQ", source_server_address=self.address)
+				advertise_packet = PacketFactory.new_advertise_packet(type="REQ", source_server_address=self.address,
+																	  capacity=self.fan_out,
+																	  token=self.client_rejoin_token)
 				self.send_advertise_packet(advertise_packet)
 				self.stream.send_out_buf_messages(only_register=True)
 			elif message.startswith('SendMessage'):
-				to_be_sent = message.split()[1]
-				message_packet = PacketFactory.new_message_packet(message=to_be_sent,
-																  source_server_address=self.address)
-				self.send_broadcast_packet(message_packet)
+				parts = message.split(maxsplit=1)
+				if len(parts) < 2:
+					continue
+				for message_packet in PacketFactory.new_message_packets(message=parts[1],
+																		source_server_address=self.address,
+																		origin=self.address,
+																		sequence=self.message_sequence):
+					self.__log_message(message_packet)
+					self.send_broadcast_packet(message_packet)
+			elif message.startswith('Profile'):
+				self.handle_profile_command(message.split()[1:])
 			else:
 				continue
 
-		self.user_interface.buffer.clear()
+	def handle_profile_command(self, arguments):
+		"""
+		Control the profiler from the user interface.
+
+		:param arguments: The words after 'Profile'.
+		:type arguments: list
+
+		:return:
+		"""
+		if not arguments:
+			print('Profile on|off|cprofile|sample|stats|reset|dump <path-prefix>')
+		elif arguments[0] == 'on':
+			self.profiler.enable()
+		elif arguments[0] == 'off':
+			self.profiler.disable()
+		elif arguments[0] == 'cprofile':
+			self.profiler.enable(cprofile=True)
+		elif arguments[0] == 'sample':
+			self.profiler.start_sampling()
+		elif arguments[0] == 'reset':
+			self.profiler.reset()
+		elif arguments[0] == 'stats':
+			print('\n'.join(self.profiler.summary()))
+		elif arguments[0] == 'dump':
+			prefix = arguments[1] if len(arguments) > 1 else f'profile-{peer_address(self.address)[1]}'
+			for path in self.profiler.dump(prefix):
+				print('Profile written to ' + path)
 
 	def run(self):
 		"""
@@ -122,6 +337,7 @@ class Peer:
 			3. Parse user_interface_buffer to make message packets.  ---- done
 			4. Send packets stored in nodes buffer of our Stream object. ---- done
 			5. ** sleep the current thread for 2 seconds ** -------- done
+			   A new user command wakes the loop up early.
 
 		Warnings:
 			1. At first check reunion daemon condition; Maybe we have a problem in this time
@@ -132,44 +348,81 @@ class Peer:
 		"""
 
 		while True:
+			self.run_once()
+			self.wakeup_event.wait(self.loop_interval)
+			self.wakeup_event.clear()
+
+	def run_once(self):
+		"""
+		One iteration of the main loop; 'run' calls it every loop_interval seconds (or sooner when woken up) and
+		PeerHost calls it whenever this Peer has work to do.
+
+		:return:
+		"""
+		with self.profiler.loop('Peer.run'):
 			if not self.is_root:
 				if self.is_client_connected:
-					input_buffer = self.stream.read_in_buf()
-					for buf in input_buffer:
-						packet = Packet(buf)
+					for packet in self.stream.read_in_packets():
 						print('gonna print a received packet! ')
 						print(packet.__dict__)
 						self.handle_packet(packet)
-					self.stream.clear_in_buff()  # TODO buffer messages that use unvailable addreses
+					self.stream.clear_in_buff()
+					self.message_assembler.expire()
 					unavailable_addreses = self.stream.send_out_buf_messages()
 					if self.root_address in unavailable_addreses:
 						self.is_client_connected = False
+					if self.client_predecessor_address in unavailable_addreses:
+						self.__fail_over()
 					for add in unavailable_addreses:
 						if add in self.successors_address:
 							self.successors_address.remove(add)
 				else:
-					input_buffer = self.stream.read_in_buf()
-					for buf in input_buffer:
-						packet = Packet(buf)
+					for packet in self.stream.read_in_packets():
 						if packet.type == PacketType.ADVERTISE:
 							self.__handle_advertise_packet(packet)
+						elif packet.type == PacketType.REGISTER:
+							self.__handle_register_packet(packet)
 					self.stream.clear_in_buff()
+					self.__retry_advertise()
 				self.handle_user_interface_buffer()
 			else:
-				input_buffer = self.stream.read_in_buf()
-				for buf in input_buffer:
-					packet = Packet(buf)
-					print('gonna print a received packet! ')
-					print(packet.__dict__)
-					self.handle_packet(packet)
+				for packets in self.stream.read_in_batch().values():
+					for packet in packets:
+						print('gonna print a received packet! ')
+						print(packet.__dict__)
+					self.handle_packets(packets)
+				if self.standby_for is None:
+					self.__admit_pending()
+					self.__rebalance()
+				self.__replicate()
 
 				self.stream.clear_in_buff()
+				self.message_assembler.expire()
 				self.handle_user_interface_buffer()
 				unavailable_addreses = self.stream.send_out_buf_messages()
 				for add in unavailable_addreses:
 					if add in self.successors_address:
 						self.successors_address.remove(add)
-			time.sleep(2)
+				for address in self.redirected:
+					node = self.stream.nodes.get(address)
+					if node is not None and address not in self.nodes_for_root:
+						# It talks to its sub-root from now on.
+						self.stream.remove_node(node)
+				self.redirected.clear()
+
+	def start_reunion_daemon(self):
+		"""
+		Start the reunion daemon thread once; Later Advertise Responses (after a Reunion failure) reuse it.
+		Without threads, the owner (PeerHost) calls run_reunion_once itself.
+
+		:return:
+		"""
+		if self.reunion_daemon_started:
+			return
+		self.reunion_daemon_started = True
+		if self.threaded:
+			reunion_thread = threading.Thread(target=self.run_reunion_daemon, daemon=True)
+			reunion_thread.start()
 
 	def run_reunion_daemon(self):
 		"""
@@ -194,49 +447,104 @@ class Peer:
 			   Request packet and send it through your register_connection to the root; Don't forget to send this packet
 			   here, because in the Reunion Failure mode our main loop will not work properly and everything will be got stock!
 			   --- done
+			5. A Hello is only sent when no Hello of our sub-tree went up through us since our last one, and any
+			   packet from our parent counts as a Hello Back; The root counts a Hello for every node on its path.
 
 		:return:
 		"""
 		while True:
+			self.run_reunion_once()
+			time.sleep(self.reunion_interval)
 
+	def run_reunion_once(self):
+		"""
+		One iteration of the reunion daemon; See run_reunion_daemon.
+
+		:return:
+		"""
+		with self.profiler.loop('Peer.reunion'):
+			for peer in self.stream.spool.expire():
+				print(f'{peer_address(peer)} did not come back; dropping its spooled messages')
 			if self.is_root:
+				if self.standby_for is not None:
+					# Nothing is ours to sweep until we take over.
+					self.__watch_primary()
+					return
 				now = time.time()
+				if self.standbys:
+					self.standbys = [standby for standby in self.standbys
+									 if now - self.stream.get_last_heard(standby) <= self.root_timeout_threshold]
+				if self.deposed_root is not None:
+					self.__fence_deposed_root()
 				to_be_deleted = []
-				for peer_address, latest_reunion_msg in self.nodes_for_root.items():
-					passed_time = now - latest_reunion_msg
-					if passed_time > self.root_timeout_threshold:
-						print("I've waited more than enough! where is my hello from " + str(peer_address))
-						to_be_deleted.append(peer_address)
-						self.network_graph.turn_off_node(peer_address)
-
-				for peer_address in to_be_deleted:
-					self.nodes_for_root.pop(
-						peer_address)
-					self.network_graph.remove_node(peer_address)
-					if peer_address in self.successors_address:
-						self.successors_address.remove(peer_address)
+				for peer in self.nodes_for_root.older_than(now - self.root_timeout_threshold):
+					if peer in self.successors_address and \
+							now - self.stream.get_last_heard(peer) <= self.root_timeout_threshold:
+						# Our children show up by any traffic, not only by their Hellos.
+						continue
+					print("I've waited more than enough! where is my hello from " + str(peer_address(peer)))
+					to_be_deleted.append(peer)
+					self.network_graph.turn_off_node(peer)
+
+				for peer in to_be_deleted:
+					self.__forget_node(peer)
+				self.__greet_upper_root()
+				if self.root_store is not None:
+					self.root_store.maybe_snapshot(self.network_graph, self.nodes_for_root)
 			else:
 				if self.client_predecessor_address:
+					if self.client_is_waiting_for_helloback and \
+							self.stream.last_received.get(self.client_predecessor_address, 0) > self.client_last_hello_time:
+						# Any packet from our parent is as good as the Hello Back; Under heavy Message traffic the
+						# Hello Back may be stuck behind the Messages.
+						self.client_is_waiting_for_helloback = False
 					if not self.client_is_waiting_for_helloback:
-						reunion_packet = PacketFactory.new_reunion_packet("REQ", self.address, [self.address])
-						print("created hello packet! gonna send it! ")
-						self.forward_hello(packet=reunion_packet, is_mine=True)
+						if self.client_last_forward_time > self.client_last_hello_time:
+							# A Hello of our sub-tree has gone up through us since our last turn; It has told the root
+							# about us too. We wait for nothing: when the sub-tree goes quiet, our next turn sends our
+							# own Hello.
+							print("link is busy, skipping my hello")
+						else:
+							reunion_packet = PacketFactory.new_reunion_packet("REQ", self.address, [self.address])
+							print("created hello packet! gonna send it! ")
+							self.forward_hello(packet=reunion_packet, is_mine=True)
+							self.client_is_waiting_for_helloback = True
 						self.client_last_hello_time = time.time()
-						self.client_is_waiting_for_helloback = True
-					elif time.time() - self.client_last_hello_time >= self.client_timeout_threshold:
+					elif time.time() - self.client_last_hello_time < self.client_timeout_threshold:
+						if self.client_predecessor_address in self.datagram_neighbours:
+							# Datagrams may be lost; Say Hello again through TCP, which also finds a dead parent.
+							reunion_packet = PacketFactory.new_reunion_packet("REQ", self.address, [self.address])
+							self.stream.add_message_to_out_buff(self.client_predecessor_address, reunion_packet)
+					else:
 						print("I've waited more than enough! where is my helloback ")
 						self.client_is_waiting_for_helloback = False
+						if self.__fail_over():
+							return
 						self.is_client_connected = False
 						self.client_predecessor_address = None
-						adv_pckt = PacketFactory.new_advertise_packet("REQ", self.address)
+						# The token gets us registered again if the root has forgotten us meanwhile.
+						adv_pckt = PacketFactory.new_advertise_packet("REQ", self.address, capacity=self.fan_out,
+																	  token=self.client_rejoin_token)
 						self.send_advertise_packet(adv_pckt)
 
-			time.sleep(4)
-
 	def send_packet(self, packet, address):
 		packet = self.change_header(packet)
 		self.stream.add_message_to_out_buff(address, packet)
 
+	def send_reunion_packet(self, packet, address):
+		"""
+		Send a Reunion packet as a datagram when the neighbour takes them, so it does not wait behind Messages in the
+		TCP out buffer; Otherwise like any other packet.
+
+		:type packet: Packet
+		:type address: int
+
+		:return:
+		"""
+		if address in self.datagram_neighbours and self.stream.send_datagram(address, packet):
+			return
+		self.stream.add_message_to_out_buff(address, packet)
+
 	def send_broadcast_packet(self, broadcast_packet):
 		"""
 
@@ -250,30 +558,61 @@ class Peer:
 
 		:return:
 		"""
-		sender_address = broadcast_packet.get_source_server_address()
+		sender_address = broadcast_packet.get_source_id()
 		broadcast_packet = self.change_header(broadcast_packet)
 
 		if self.is_root and broadcast_packet.type != PacketType.REUNION:
-			for address in self.successors_address:
-				if address != sender_address:
-					self.stream.add_message_to_out_buff(address, broadcast_packet)
+			all_addreses = self.__with_spooled(self.successors_address + self.__get_federation_links())
+			addresses = [address for address in all_addreses if address != sender_address]
+			for address, packet in self.__encode_for_neighbours(broadcast_packet, addresses):
+				self.stream.add_message_to_out_buff(address, packet)
 		elif self.is_root and broadcast_packet.type == PacketType.REUNION:
-			dest_addr = broadcast_packet.body[-20:]
-			dest_addr = (dest_addr[:15], dest_addr[15:])
+			dest_addr = broadcast_packet.get_helloback_address(0)
 			if dest_addr in self.successors_address:
-				print('Finally sending hello back to ' + str(dest_addr))
-				self.stream.add_message_to_out_buff(dest_addr, broadcast_packet)
+				print('Finally sending hello back to ' + str(peer_address(dest_addr)))
+				self.send_reunion_packet(broadcast_packet, dest_addr)
 		elif broadcast_packet.type == PacketType.MESSAGE:
-			all_addreses = [self.client_predecessor_address] + self.successors_address
-			for address in all_addreses:
-				if address != sender_address:
-					print('Going to broadcast a Message! ' + ' with body ' + str(
-						broadcast_packet.get_body()))
-					self.stream.add_message_to_out_buff(address,
-														broadcast_packet)
+			all_addreses = self.__with_spooled([self.client_predecessor_address] + self.successors_address)
+			addresses = [address for address in all_addreses if address != sender_address]
+			for address, packet in self.__encode_for_neighbours(broadcast_packet, addresses):
+				print(f'Going to broadcast a Message! with {packet.get_length()} bytes body')
+				self.stream.add_message_to_out_buff(address, packet)
 		else:
 			return
 
+	def __with_spooled(self, addresses):
+		# Neighbours we have lost get their Messages in the spool until they are back or it expires.
+		return addresses + [address for address in self.stream.spool.get_peers() if address not in addresses]
+
+	def __encode_for_neighbours(self, packet, addresses):
+		"""
+		Choose the compressed or the plain form of a Message for every neighbour.
+		An already compressed packet is passed through as it is and only inflated for neighbours that can't read it.
+
+		:param packet: The packet that should be sent.
+		:param addresses: Neighbour addresses.
+
+		:type packet: Packet
+		:type addresses: list
+
+		:return: [(address, packet), ...]
+		:rtype: list
+		"""
+		compressed = plain = None
+		result = []
+		for address in addresses:
+			if address in self.compression_neighbours and (self.compression or packet.is_compressed()):
+				if compressed is None:
+					compressed = packet
+					if self.compression:
+						compressed = packet.get_compressed(self.compression, self.compression_threshold)
+				result.append((address, compressed))
+			else:
+				if plain is None:
+					plain = packet.get_decompressed()
+				result.append((address, plain))
+		return result
+
 	def handle_packet(self, packet):
 		"""
 
@@ -287,32 +626,81 @@ class Peer:
 		:type packet Packet
 
 		"""
-		if packet.type == PacketType.REGISTER:
-			self.__handle_register_packet(packet)
-		elif packet.type == PacketType.MESSAGE:
-			self.__handle_message_packet(packet)
-		elif packet.type == PacketType.ADVERTISE:
-			self.__handle_advertise_packet(packet)
-		elif packet.type == PacketType.JOIN:
-			self.__handle_join_packet(packet)
-		elif packet.type == PacketType.REUNION:
-			self.__handle_reunion_packet(packet)
-		else:
+		self.__note_neighbour_flags(packet)
+		section = 'handle_packet.' + PacketType.get_name(packet.type) if self.profiler.enabled else None
+		with self.profiler.section(section):
+			if self.is_root and packet.type == PacketType.REGISTER and self.sub_roots is not None and \
+					packet.get_source_id() in self.sub_roots.members:
+				self.__handle_sub_root_register(packet)
+			elif self.is_root and packet.type in (PacketType.REGISTER, PacketType.ADVERTISE):
+				# Admitted in batches by __admit_pending.
+				self.admission.offer(packet)
+			elif packet.type == PacketType.REGISTER:
+				self.__handle_register_packet(packet)
+			elif packet.type == PacketType.MESSAGE:
+				self.__handle_message_packet(packet)
+			elif packet.type == PacketType.ADVERTISE:
+				self.__handle_advertise_packet(packet)
+			elif packet.type == PacketType.JOIN:
+				self.__handle_join_packet(packet)
+			elif packet.type == PacketType.REUNION:
+				self.__handle_reunion_packet(packet)
+			elif packet.type == PacketType.LEAVE:
+				self.__handle_leave_packet(packet)
+			elif packet.type == PacketType.SYNC:
+				self.__handle_sync_packet(packet)
+			elif packet.type == PacketType.REPLICATE:
+				self.__handle_replicate_packet(packet)
+			else:
+				return
+
+	def handle_packets(self, packets):
+		"""
+		handle_packet for all the packets of one type from a batch (see Stream.read_in_batch); The root answers a whole
+		batch of Reunion Hellos together.
+
+		:param packets: Arrived packets of the same type.
+		:type packets: list
+
+		:return:
+		"""
+		if not (self.is_root and packets[0].type == PacketType.REUNION):
+			for packet in packets:
+				self.handle_packet(packet)
 			return
+		if self.standby_for is not None:
+			# Not a root of anybody until we take over; Senders that still take us for one (after we have stepped down)
+			# time out and advertise again at their root.
+			return
+		for packet in packets:
+			self.__note_neighbour_flags(packet)
+		with self.profiler.section('handle_packet.REUNION' if self.profiler.enabled else None):
+			now = time.time()
+			for packet in packets:
+				self.__handle_hello(packet, now)
+
+	def __note_neighbour_flags(self, packet):
+		if packet.flags & PacketFlag.ACCEPTS_COMPRESSION:
+			self.compression_neighbours.add(packet.get_source_id())
+		else:
+			self.compression_neighbours.discard(packet.get_source_id())
+		if packet.flags & PacketFlag.ACCEPTS_DATAGRAMS:
+			self.datagram_neighbours.add(packet.get_source_id())
+		else:
+			self.datagram_neighbours.discard(packet.get_source_id())
 
 	def __check_registered(self, source_address):
 		"""
 		If the Peer is the root of the network, we need to find that is a node registered or not.
 
-		:param source_address: Unknown IP/Port address.
-		:type source_address: tuple
+		:param source_address: Unknown peer ID.
+		:type source_address: int
 
 		:return:
 		"""
 		if not self.is_root:
 			return False
-		node = self.network_graph.find_node(source_address[0], source_address[1])
-		return not node is None
+		return source_address in self.nodes_for_root
 
 	def __handle_advertise_packet(self, packet):
 		"""
@@ -344,20 +732,21 @@ class Peer:
 		:return:
 		"""
 		if self.is_root:
-			sender_address = packet.get_source_server_address()
-			neighbour = self.__get_neighbour(sender_address)
-			self.network_graph.add_node(sender_address[0], sender_address[1], neighbour.address)
-			print("Someone has requested a neighbour")
-			print(f'gave {neighbour.address} to {sender_address} as a neighbour')
-			if self.__check_registered(sender_address) and neighbour is not None:
-				adv_packet = PacketFactory.new_advertise_packet("RES", self.address, neighbour=neighbour.address)
-				self.send_packet(adv_packet, sender_address)
+			self.__give_neighbours([packet])
 		elif packet.body.startswith('RES'):
-			reunion_thread = threading.Thread(target=self.run_reunion_daemon)
-			reunion_thread.start()
-			join_pckt = PacketFactory.new_join_packet(self.address)
-			self.client_predecessor_address = (packet.body[-20:-5], packet.body[-5:])
-			print("I've found a father! " + str(self.client_predecessor_address))
+			self.start_reunion_daemon()
+			self.client_is_advertising = False
+			self.client_advertise_retry = self.client_advertise_retry_min
+			join_pckt = PacketFactory.new_join_packet(self.address, watermarks=self.__get_sync_watermarks())
+			old_predecessor = self.client_predecessor_address
+			self.client_predecessor_address = packet.get_advertised_neighbour()
+			self.client_backup_parents = packet.get_advertised_backups()
+			self.client_parent_is_backup = False
+			if old_predecessor and old_predecessor != self.client_predecessor_address:
+				# The root moved us; Our old parent should free our place and our next Hello takes the new path.
+				self.send_packet(PacketFactory.new_leave_packet(self.address), old_predecessor)
+				self.client_is_waiting_for_helloback = False
+			print("I've found a father! " + str(peer_address(self.client_predecessor_address)))
 			self.stream.add_node(self.client_predecessor_address)
 			self.send_packet(join_pckt, self.client_predecessor_address)
 			self.is_client_connected = True
@@ -374,28 +763,339 @@ class Peer:
 
 		Warnings:
 			1. Don't forget to ignore Register Request packets when you are a non-root peer.
+			2. A non-root peer follows a Register Response that redirects it to a sub-root, registers again when its
+			   root refuses it, and keeps the rejoin token of any other Register Response.
 
 		:param packet: Arrived register packet
 		:type packet Packet
 		:return:
 		"""
 		if not self.is_root:
+			redirect = packet.get_redirect_address()
+			if redirect is not None and redirect != self.root_address:
+				self.__follow_redirect(redirect, register=redirect != packet.get_source_id())
+			elif packet.is_register_refusal() and packet.get_source_id() == self.root_address:
+				self.__register_again()
+			elif packet.get_rejoin_token() is not None:
+				self.client_rejoin_token = packet.get_rejoin_token()
 			return
 		else:
-			sender = packet.get_source_server_address()
-			if sender not in self.nodes_for_root:
-				self.stream.add_node(sender)
-				self.nodes_for_root.update({sender: time.time()})
-			else:
+			self.__register([packet.get_source_id()])
+
+	def __register_again(self):
+		"""
+		Our root does not know us and our rejoin token (if any) did not help, e.g. a new root without the old one's
+		secret; Register again and repeat the Advertise Request that it has refused.
+
+		:return:
+		"""
+		print('Our root does not know us; Registering again')
+		self.client_rejoin_token = None
+		self.send_packet(PacketFactory.new_register_packet("REQ", self.address, self.address), self.root_address)
+		if self.client_is_advertising:
+			self.send_packet(PacketFactory.new_advertise_packet("REQ", self.address, capacity=self.fan_out),
+							 self.root_address)
+		self.stream.send_out_buf_messages(only_register=True)
+
+	def __follow_redirect(self, root, register=True):
+		"""
+		The root has sent us to another root: one of its sub-roots, or itself when it is a standby root that has taken
+		over from ours. Register there (unless it has our registration already) and, if our Advertise Request went
+		unanswered, advertise there too.
+
+		:param root: Peer ID of the new root.
+		:param register: Whether we have to register at the new root.
+
+		:type root: int
+		:type register: bool
+
+		:return:
+		"""
+		print('Our root is ' + str(peer_address(root)) + ' from now on')
+		old_root = self.stream.nodes.get(self.root_address)
+		if old_root is not None and old_root.register:
+			self.stream.remove_node(old_root)
+		self.root_address = root
+		if not register:
+			# Our old root is gone for good.
+			self.client_first_root_address = root
+		if root not in self.stream.nodes:
+			self.stream.add_node(root, True)
+		if register:
+			self.send_packet(PacketFactory.new_register_packet("REQ", self.address, self.address), root)
+		if self.client_is_advertising:
+			self.send_packet(PacketFactory.new_advertise_packet("REQ", self.address, capacity=self.fan_out,
+																token=self.client_rejoin_token), root)
+		self.stream.send_out_buf_messages(only_register=True)
+
+	def __handle_sub_root_register(self, packet):
+		"""
+		A sub-root of ours says it is alive; It sends a Register Request every reunion interval (see
+		__greet_upper_root). Keep a connection to it for the Messages that cross between the partitions.
+
+		:param packet: Arrived register packet from a sub-root.
+		:type packet Packet
+
+		:return:
+		"""
+		sub_root = packet.get_source_id()
+		if sub_root not in self.stream.nodes:
+			print('Sub-root ' + str(peer_address(sub_root)) + ' is up')
+			self.stream.add_node(sub_root)
+
+	def __is_live_sub_root(self, sub_root):
+		return time.time() - self.stream.get_last_heard(sub_root) <= self.root_timeout_threshold
+
+	def __get_federation_links(self):
+		"""
+
+		:return: The roots we pass Messages to besides our successors: the root above us and our live sub-roots.
+		:rtype: list
+		"""
+		links = [self.upper_root_address] if self.upper_root_address else []
+		if self.sub_roots is not None:
+			links += [sub_root for sub_root in self.sub_roots.members if self.__is_live_sub_root(sub_root)]
+		return links
+
+	def __greet_upper_root(self):
+		"""
+		As a sub-root, tell the root above us that we are alive; Called every reunion interval.
+
+		:return:
+		"""
+		if not self.upper_root_address:
+			return
+		if self.upper_root_address not in self.stream.nodes and self.stream.add_node(self.upper_root_address) is None:
+			return
+		self.send_packet(PacketFactory.new_register_packet("REQ", self.address, self.address), self.upper_root_address)
+
+	def __log_change(self, operation, address, parent_address=0, capacity=0):
+		"""
+		Record a change of the root state in our RootStore and for our standby roots.
+
+		:param operation: RootStore.REGISTER, RootStore.ADD or RootStore.REMOVE.
+		:param address: Peer ID of the node.
+		:param parent_address: Peer ID of its new parent, for RootStore.ADD.
+		:param capacity: Its capacity, for RootStore.ADD.
+
+		:return:
+		"""
+		if self.root_store is not None:
+			self.root_store.log_change(operation, address, parent_address, capacity)
+		if self.standbys:
+			with self.replication_lock:
+				self.replication_buffer.append(RootStore.encode_change(operation, address, parent_address, capacity))
+
+	def __replicate(self):
+		"""
+		Send the changes of the root state since the last call to our standby roots, in one Log packet.
+
+		:return:
+		"""
+		if not self.standbys:
+			return
+		with self.replication_lock:
+			records, self.replication_buffer = self.replication_buffer, []
+		if records:
+			packet = PacketFactory.new_replicate_packet('LOG', self.address, b''.join(records))
+			for standby in self.standbys:
+				self.send_packet(packet, standby)
+
+	def __handle_replicate_packet(self, packet):
+		"""
+		Request:
+			A standby root subscribes, or says that it is still there; A new one gets a Snapshot of our state and our
+			Log packets (see __replicate) from then on.
+
+		Snapshot and Log:
+			We are the standby of the sender; Mirror its state.
+
+		Fence:
+			Our standby has taken over from us (see __fence_deposed_root); Step down.
+
+		Warnings:
+			1. Changes are idempotent, so a Log that overlaps the Snapshot does no harm.
+			2. Only the roots in allowed_standbys are served; The Snapshot and Logs go to the address of the peer ID
+			   in the request, whatever connection it came on.
+
+		:param packet: Arrived replicate packet.
+		:type packet Packet
+
+		:return:
+		"""
+		source = packet.get_source_id()
+		if packet.body.startswith('REQ'):
+			if source not in self.allowed_standbys:
+				print('Ignoring the Replicate Request of ' + str(peer_address(source)) + '; It is not one of our standbys')
+				return
+			if source == self.deposed_root:
+				# It stands by for us now.
+				self.deposed_root = None
+			if self.standby_for is not None or source in self.standbys:
 				return
+			if source not in self.stream.nodes and self.stream.add_node(source, True) is None:
+				return
+			print('Replicating the root state to the standby ' + str(peer_address(source)))
+			self.standbys.append(source)
+			records = RootStore.encode_state(self.network_graph, dict(self.nodes_for_root))
+			self.send_packet(PacketFactory.new_replicate_packet('SNP', self.address, records), source)
+		elif source == self.standby_for and packet.body.startswith('SNP'):
+			self.network_graph = self.graph_class(GraphNode(self.standby_for, self.fan_out))
+			self.nodes_for_root = self.hello_times_class()
+			RootStore.apply_state(packet.get_replicated_records(), self.network_graph, self.nodes_for_root)
+			self.standby_synced = True
+			print(f'Mirroring the root state of {len(self.nodes_for_root)} nodes')
+		elif source == self.standby_for and packet.body.startswith('LOG'):
+			RootStore.apply_changes(packet.get_replicated_records(), self.network_graph, self.nodes_for_root)
+		elif packet.body.startswith('FEN') and source in self.allowed_standbys and self.standby_for is None:
+			self.__step_down(source)
+
+	def __watch_primary(self):
+		"""
+		As a standby root, send our heartbeat to the primary root and take over once we have not heard from it (not even
+		an ACK) for standby_timeout seconds.
+
+		:return:
+		"""
+		primary = self.standby_for
+		if self.standby_synced and time.time() - self.stream.get_last_heard(primary) > self.standby_timeout:
+			self.__take_over()
+			return
+		if primary in self.stream.nodes or self.stream.add_node(primary, True) is not None:
+			self.send_packet(PacketFactory.new_replicate_packet('REQ', self.address), primary)
+			self.stream.send_out_buf_messages(only_register=True)
+
+	def __take_over(self):
+		"""
+		The primary root is gone; Become the root with the mirrored state. The graph is re-rooted at us and every node
+		gets a full timeout. Every registered node is told that we are its root now by a Register Response that
+		redirects to us, its sender, so it does not register again, and the primary's children get us as their
+		parent.
+
+		Warnings:
+			1. A primary that we could not hear but is still alive (a network partition) stays a root until it hears
+			   from us again; Then it steps down (see __fence_deposed_root). Until then both roots admit nodes.
+
+		:return:
+		"""
+		primary = self.standby_for
+		print('The root ' + str(peer_address(primary)) + ' is gone; Taking over')
+		self.standby_for = None
+		self.deposed_root = primary
+		records = RootStore.encode_state(self.network_graph, dict(self.nodes_for_root))
+		self.network_graph = self.graph_class(GraphNode(self.address, self.fan_out))
+		nodes_for_root = {}
+		RootStore.apply_state(records, self.network_graph, nodes_for_root, root_alias=primary)
+		self.nodes_for_root = self.hello_times_class(dict.fromkeys(nodes_for_root, time.time()))
+		node = self.stream.nodes.get(primary)
+		if node is not None:
+			self.stream.remove_node(node)
+		self.stream.add_nodes([address for address in self.nodes_for_root if address not in self.stream.nodes])
+		self.successors_address = [child.address for child in self.network_graph.root.get_children()]
+		redirect_packet = PacketFactory.new_register_packet("RES", self.address, redirect=self.address)
+		for address in self.nodes_for_root:
+			self.send_packet(redirect_packet, address)
+		for address in self.successors_address:
+			self.send_packet(PacketFactory.new_advertise_packet("RES", self.address, neighbour=self.address), address)
+		if self.root_store is not None:
+			self.root_store.snapshot(self.network_graph, self.nodes_for_root)
+		self.wake_up()
+
+	def __fence_deposed_root(self):
+		"""
+		Tell the primary we have taken over from that we are the root now, every reunion interval until it stands by
+		for us; If it was only cut off from us it must not stay a second root of the network.
+
+		:return:
+		"""
+		primary = self.deposed_root
+		if primary in self.stream.nodes or self.stream.add_node(primary, True) is not None:
+			self.send_packet(PacketFactory.new_replicate_packet('FEN', self.address), primary)
+			self.stream.send_out_buf_messages(only_register=True)
+
+	def __step_down(self, new_root):
+		"""
+		Our standby has taken over while it could not hear us. Send our registered nodes to it, drop our state and
+		stand by for it from now on.
+
+		Warnings:
+			1. The RootStore keeps our old state; Restart a deposed root with --standby-for, or it is a root again.
+
+		:param new_root: Peer ID of the root that has taken over.
+		:type new_root: int
+
+		:return:
+		"""
+		print(str(peer_address(new_root)) + ' has taken over; Standing by for it')
+		redirect_packet = PacketFactory.new_register_packet("RES", self.address, redirect=new_root)
+		for address in self.nodes_for_root:
+			self.send_packet(redirect_packet, address)
+		self.standby_for = new_root
+		self.standby_synced = False
+		self.standbys = []
+		with self.replication_lock:
+			self.replication_buffer = []
+		self.network_graph = self.graph_class(GraphNode(new_root, self.fan_out))
+		self.nodes_for_root = self.hello_times_class()
+		self.successors_address = []
+		self.wake_up()
+
+	def __redirect_to_sub_roots(self, packets):
+		"""
+		Send the senders of Register and Advertise Requests that belong to a live sub-root (by the consistent hashing
+		of their peer IDs) there, with a Register Response that redirects.
+
+		Warnings:
+			1. Peers that are registered here already stay, and so does a peer without a live sub-root.
+
+		:param packets: Register and Advertise Request packets.
+		:type packets: list
+
+		:return: Peer IDs of the redirected senders.
+		:rtype: set
+		"""
+		redirected = set()
+		if self.sub_roots is None:
+			return redirected
+		for sender in dict.fromkeys(packet.get_source_id() for packet in packets):
+			if sender in self.nodes_for_root:
+				continue
+			sub_root = self.sub_roots.get(sender, self.__is_live_sub_root)
+			if sub_root is None:
+				continue
+			redirected.add(sender)
+			if sender not in self.stream.nodes and self.stream.add_node(sender, True) is None:
+				continue
+			print(f'Sending {peer_address(sender)} to the sub-root {peer_address(sub_root)}')
+			self.send_packet(PacketFactory.new_register_packet("RES", self.address, redirect=sub_root), sender)
+			self.redirected.append(sender)
+		return redirected
+
+	def __register(self, senders):
+		"""
+		Register every sender that is not registered yet; Their connections are opened in parallel, unless we still
+		have one (e.g. to a node we have evicted that rejoins with its token).
+
+		:param senders: Addresses that sent a Register Request.
+		:type senders: list
+
+		:return:
+		"""
+		new_senders = [sender for sender in dict.fromkeys(senders) if sender not in self.nodes_for_root]
+		self.stream.add_nodes([sender for sender in new_senders if sender not in self.stream.nodes])
+		for sender in new_senders:
+			self.nodes_for_root.update({sender: time.time()})
+			self.__log_change(RootStore.REGISTER, sender)
 
 	def __handle_message_packet(self, packet):
 		"""
 		Only broadcast message to the other nodes.
+		Fragments are forwarded as soon as they arrive and reassembled on the side for our own delivery.
 
 		Warnings:
 			1. Do not forget to ignore messages from unknown sources.
 			2. Make sure that you are not sending a message to a register_connection.
+			3. A Sequenced Message we have seen before is dropped; It may come again from a spool or a delta sync.
 
 		:param packet: Arrived message packet
 
@@ -403,8 +1103,69 @@ class Peer:
 
 		:return:
 		"""
+		if not self.__log_message(packet):
+			return
+		if packet.is_fragment():
+			message = self.message_assembler.add_fragment(*packet.get_fragment())
+			if message is not None:
+				self.deliver_message(message)
+		else:
+			self.deliver_message(packet.get_message_body())
 		self.send_broadcast_packet(packet)
 
+	def __log_message(self, packet):
+		"""
+
+		:param packet: A Message packet.
+		:type packet: Packet
+
+		:return: False if it is a Sequenced Message that is already in our BroadcastLog.
+		:rtype: bool
+		"""
+		if not packet.is_sequenced():
+			return True
+		origin, sequence = packet.get_sequence()
+		return self.broadcast_log.add(origin, sequence, packet.flags & PacketFlag.FRAGMENT, packet.get_message_body())
+
+	def __get_sync_watermarks(self):
+		"""
+
+		:return: Our high-watermarks for the delta sync of a Join; None if we have never seen a Message, i.e. we are new
+				 to the network and do not need the old ones.
+		:rtype: dict
+		"""
+		return self.broadcast_log.get_watermarks() or None
+
+	def __handle_sync_packet(self, packet):
+		"""
+		The Messages we missed while we were away; Handle each of them as if it had just arrived from the sender, so
+		they are delivered and passed on to our sub-tree too.
+
+		:param packet: Arrived sync packet.
+		:type packet Packet
+
+		:return:
+		"""
+		messages = packet.get_synced_messages()
+		print(f'Catching up on {len(messages)} missed messages from {peer_address(packet.get_source_id())}')
+		for origin, sequence, flags, body in messages:
+			self.__handle_message_packet(PacketFactory.new_message_packet(body, packet.get_source_id(), origin,
+																		  sequence, flags=flags))
+
+	def deliver_message(self, message):
+		"""
+		A broadcast message has completely arrived at this Peer.
+
+		:param message: The whole message.
+		:type message: str
+
+		:return:
+		"""
+		if len(message) > 100:
+			print(f'Received a message of {len(message)} characters: {message[:100]}...')
+		else:
+			print('Received a message: ' + message)
+
 	def __handle_reunion_packet(self, packet):
 
 		"""
@@ -412,16 +1173,15 @@ class Peer:
 
 		Reunion Hello:
 			If you are root Peer you should answer with a new Reunion Hello Back packet.
-			At first extract all addresses in the packet body and append them in descending order to the new packet.
-			You should send the new packet to the first address in the arrived packet.
+			The Hello Back carries the tree path from our child down to the sender and is sent to its first entry.
 			If you are a non-root Peer append your IP/Port address to the end of the packet and send it to your parent.
 
 		Reunion Hello Back:
-			Check that you are the end node or not; If not only remove your IP/Port address and send the packet to the next
-			address, otherwise you received your response from the root and everything is fine.
+			Check that you are the end node or not; If not only increase the Hop Index and send the packet to the next
+			entry of the path, otherwise you received your response from the root and everything is fine.
 
 		Warnings:
-			1. Every time adding or removing an address from packet don't forget to update Entity Number field.
+			1. Every time adding an address to a Hello don't forget to update Entity Number field.
 			2. If you are the root, update last Reunion Hello arrival packet from the sender node and turn it on.
 			3. If you are the end node, update your Reunion mode from pending to acceptance.
 
@@ -430,14 +1190,10 @@ class Peer:
 		:return:
 		"""
 		if self.is_root:
-			sender_address = packet.get_first_address_hello_packet()
-			print('Hello from ' + str(sender_address))
-			self.nodes_for_root[sender_address] = time.time()
-			self.network_graph.turn_on_node(sender_address)
-			self.send_helloback(packet)
+			self.__handle_hello(packet, time.time())
 		else:
 			if packet.is_reunion_hello():
-				print('Forwarding Hello Packet from ' + str(packet.get_first_address_hello_packet()))
+				print('Forwarding Hello Packet from ' + str(peer_address(packet.get_first_address_hello_packet())))
 				self.forward_hello(packet)
 			else:
 				if not self.helloback_is_mine(packet):
@@ -446,47 +1202,296 @@ class Peer:
 					print('I received hello back!')
 					self.client_is_waiting_for_helloback = False
 
+	def __handle_hello(self, packet, now):
+		"""
+		The root's part of __handle_reunion_packet.
+
+		:param packet: Arrived Reunion Hello packet.
+		:param now: Arrival time of its batch.
+
+		:type packet: Packet
+		:type now: float
+
+		:return:
+		"""
+		sender_address = packet.get_first_address_hello_packet()
+		print('Hello from ' + str(peer_address(sender_address)))
+		self.nodes_for_root[sender_address] = now
+		self.network_graph.turn_on_node(sender_address)
+		# Every node on the path has just forwarded the Hello, so they are alive too.
+		for address in packet.get_hello_path()[1:]:
+			if address in self.nodes_for_root:
+				self.nodes_for_root[address] = now
+				self.network_graph.turn_on_node(address)
+		self.__follow_hello_path(packet)
+		self.send_helloback(packet)
+
 	def __handle_join_packet(self, packet):
 		"""
 		When a Join packet received we should add a new node to our nodes array.
 		In reality, there is a security level that forbids joining every node to our network.
+		A Join with high-watermarks is from a node that rejoins; Send it the Messages it has missed in one Sync packet.
 
 		:param packet: Arrived register packet.
 		:type packet Packet
 
 		:return:
 		"""
-		address = packet.get_source_server_address()
-		print(f'received join from {address}')
-		if address not in self.successors_address and len(self.successors_address) < 2:
+		address = packet.get_source_id()
+		print(f'received join from {peer_address(address)}')
+		replaced = packet.get_replaced_address()
+		if replaced in self.successors_address:
+			self.successors_address.remove(replaced)
+		if address not in self.successors_address and len(self.successors_address) < self.fan_out:
 			self.successors_address.append(address)
 		self.stream.add_node(address)
+		watermarks = packet.get_join_watermarks()
+		if watermarks is not None:
+			missing = self.broadcast_log.get_missing(watermarks)
+			if missing:
+				print(f'Sending {len(missing)} missed messages to {peer_address(address)}')
+				self.send_packet(PacketFactory.new_sync_packet(self.address, missing), address)
+
+	def __handle_leave_packet(self, packet):
+		"""
+		A successor of ours has got another parent; Free its place.
+
+		:param packet: Arrived leave packet.
+		:type packet Packet
+
+		:return:
+		"""
+		address = packet.get_source_id()
+		print(f'received leave from {peer_address(address)}')
+		if address in self.successors_address:
+			self.successors_address.remove(address)
+
+	def __forget_node(self, peer):
+		"""
+		Remove a dead node from the root state; Its sub-tree stays in the graph, turned off, until it reattaches.
+
+		:param peer: Peer ID of the node.
+		:type peer: int
+
+		:return:
+		"""
+		self.nodes_for_root.pop(peer, None)
+		self.network_graph.remove_node(peer)
+		self.__log_change(RootStore.REMOVE, peer)
+		if peer in self.successors_address:
+			self.successors_address.remove(peer)
+
+	def __fail_over(self):
+		"""
+		Our parent is gone; Join the first reachable backup parent right away, together with our whole sub-tree.
+		The root learns about the new parent from the path of our next Reunion Hello.
+
+		:return: Whether we have a new parent.
+		:rtype: bool
+		"""
+		old_predecessor = self.client_predecessor_address
+		while self.client_backup_parents:
+			backup = self.client_backup_parents.pop(0)
+			if backup == old_predecessor or backup in self.successors_address:
+				continue
+			if backup not in self.stream.nodes and self.stream.add_node(backup) is None:
+				continue
+			print('Parent is gone! joining the backup ' + str(peer_address(backup)))
+			if old_predecessor in self.stream.nodes:
+				# Maybe it was only too slow; It should free our place anyway.
+				self.send_packet(PacketFactory.new_leave_packet(self.address), old_predecessor)
+			# Only the parent the root gave us is a successor of a backup (the grandparent).
+			replaced = None if self.client_parent_is_backup else old_predecessor
+			self.client_predecessor_address = backup
+			self.client_parent_is_backup = True
+			self.stream.move_spool(old_predecessor, backup)
+			self.send_packet(PacketFactory.new_join_packet(self.address, replaced=replaced,
+														   watermarks=self.__get_sync_watermarks()), backup)
+			self.client_is_waiting_for_helloback = False
+			return True
+		return False
+
+	def __follow_hello_path(self, packet):
+		"""
+		A node that joined one of its backup parents shows its new parent only in the path of its Reunion Hellos;
+		Move it (with its sub-tree) under that parent in the NetworkGraph too.
+
+		:param packet: Arrived Reunion Hello packet.
+		:type packet: Packet
+
+		:return:
+		"""
+		sender_address = packet.get_first_address_hello_packet()
+		node = self.network_graph.find_node(sender_address)
+		parent_address = packet.get_parent_address_hello_packet() or self.address
+		if node is None:
+			# We have given it up already, but it is still there.
+			if self.network_graph.add_node(sender_address, parent_address):
+				print(f'{peer_address(sender_address)} is back under {peer_address(parent_address)}')
+				self.__log_change(RootStore.ADD, sender_address, parent_address,
+								  self.network_graph.find_node(sender_address).capacity)
+			return
+		if node.parent is not None and node.parent.address == parent_address:
+			return
+		if time.time() - node.last_moved < self.client_timeout_threshold:
+			# We have just moved it ourselves and its Hellos still take the old path.
+			return
+		old_parent = node.parent
+		if old_parent is not None and old_parent.parent is not None and old_parent.parent.address == parent_address:
+			# It went up to its grandparent; Its parent is gone and the place is its now.
+			self.__forget_node(old_parent.address)
+		if self.network_graph.add_node(sender_address, parent_address):
+			print(f'{peer_address(sender_address)} is now under {peer_address(parent_address)}')
+			self.__log_change(RootStore.ADD, sender_address, parent_address, node.capacity)
+
+	def __rebalance(self):
+		"""
+		Every rebalance_interval seconds let the NetworkGraph move a few deep sub-trees closer to the root and tell
+		each moved node its new parent with an Advertise Response packet.
+
+		:return:
+		"""
+		now = time.time()
+		if now - self.last_rebalance_time < self.rebalance_interval:
+			return
+		self.last_rebalance_time = now
+		with self.profiler.section('rebalance'):
+			moves = self.network_graph.rebalance(self.rebalance_moves, self.rebalance_threshold,
+												 self.rebalance_cooldown)
+		for node, parent in moves:
+			print(f'moving {peer_address(node.address)} under {peer_address(parent.address)}')
+			self.__log_change(RootStore.ADD, node.address, parent.address, node.capacity)
+			adv_packet = PacketFactory.new_advertise_packet("RES", self.address, neighbour=parent.address,
+															backups=self.network_graph.find_backup_parents(node.address))
+			self.send_packet(adv_packet, node.address)
+
+	def __admit_pending(self):
+		"""
+		Admit one batch of the waiting Register and Advertise requests: Registers first, so that the Advertises of the
+		same batch already have a connection to answer on, then all Advertises with one pass over the graph.
+		Every Register Request is answered with the sender's rejoin token; An Advertise Request with a valid token
+		registers its sender again if we have evicted it meanwhile.
 
-	def __get_neighbour(self, sender):
+		:return:
 		"""
-		Finds the best neighbour for the 'sender' from the network_nodes array.
+		batch = self.admission.take_batch()
+		if not batch:
+			return
+		batch = [packet for packet in batch if packet.body.startswith('REQ')]
+		redirected = self.__redirect_to_sub_roots(batch)
+		batch = [packet for packet in batch if packet.get_source_id() not in redirected]
+		registers = [packet.get_source_id() for packet in batch if packet.type == PacketType.REGISTER]
+		advertises = [packet for packet in batch if packet.type == PacketType.ADVERTISE]
+		rejoining = [packet.get_source_id() for packet in advertises if packet.get_source_id() not in self.nodes_for_root
+					 and self.rejoin_tokens.is_valid(packet.get_source_id(), packet.get_rejoin_token())]
+		for sender in rejoining:
+			print(f'{peer_address(sender)} rejoins with its token')
+		self.__register(registers + rejoining)
+		for sender in dict.fromkeys(registers):
+			self.send_packet(PacketFactory.new_register_packet("RES", self.address,
+															   token=self.rejoin_tokens.issue(sender)), sender)
+		self.__give_neighbours(advertises)
+		if self.admission.pending:
+			self.wake_up()
+
+	def __give_neighbours(self, packets):
+		"""
+		Finds the best neighbours for the senders of Advertise Request 'packets', adds them to the NetworkGraph and
+		answers each with an Advertise Response packet.
 		This function only will call when you are a root peer.
 
 		Code design suggestion:
-			1. Use your NetworkGraph find_live_node to find the best neighbour.
+			1. Use your NetworkGraph find_live_nodes to find the best neighbours in one pass.
+
+		Warnings:
+			1. Senders that have not registered (and have no valid rejoin token, see __admit_pending) are not placed;
+			   They get a Register Response that tells them to register again.
 
-		:param sender: Sender of the packet
-		:return: The specified neighbour for the sender; The format is like ('192.168.001.001', '05335').
+		:param packets: Advertise Request packets.
+		:type packets: list
+
+		:return:
 		"""
-		return self.network_graph.find_live_node(sender)
+		refusal = None
+		for packet in packets:
+			sender = packet.get_source_id()
+			if self.__check_registered(sender):
+				continue
+			print(f'{peer_address(sender)} has not registered; Telling it to register first')
+			if sender not in self.stream.nodes and self.stream.add_node(sender) is None:
+				continue
+			refusal = refusal or PacketFactory.new_register_packet("RES", self.address, refused=True)
+			self.send_packet(refusal, sender)
+		capacities = {packet.get_source_id(): packet.get_advertised_capacity() for packet in packets
+					  if self.__check_registered(packet.get_source_id())}
+		with self.profiler.section('find_live_node'):
+			placements = self.network_graph.find_live_nodes(list(capacities), capacities)
+		for sender_address, neighbour in placements:
+			self.__log_change(RootStore.ADD, sender_address, neighbour.address,
+							  self.network_graph.find_node(sender_address).capacity)
+			print("Someone has requested a neighbour")
+			print(f'gave {peer_address(neighbour.address)} to {peer_address(sender_address)} as a neighbour')
+			backups = self.network_graph.find_backup_parents(sender_address)
+			adv_packet = PacketFactory.new_advertise_packet("RES", self.address, neighbour=neighbour.address,
+															backups=backups)
+			self.send_packet(adv_packet, sender_address)
 
 	def send_helloback(self, packet):
+		"""
+		Answer a Reunion Hello with a Hello Back that is source-routed down the tree path of the NetworkGraph.
+
+		Warnings:
+			1. If the graph does not know the sender or its path does not match the Hello at both ends (e.g. right
+			   after a move), the path of the Hello itself is used.
+
+		:param packet: Arrived Reunion Hello packet.
+		:type packet: Packet
+
+		:return:
+		"""
 		if not self.is_root:
 			return
 		print('Sending Hello back')
-		packet.body = 'RES' + packet.body[3:]
-		packet.source_ip = self.address[0]
-		packet.source_port = self.address[1]
-		packet = Packet(packet.get_buf())
-		self.send_broadcast_packet(packet)
+		path = self.network_graph.get_path(packet.get_first_address_hello_packet())
+		parent_address = path[-2] if path and len(path) > 1 else None
+		if not path or path[0] != packet.get_last_address_hello_packet() or \
+				parent_address != packet.get_parent_address_hello_packet():
+			body = packet.body
+			path = [parse_peer_string(body[i:i + 20]) for i in range(len(body) - 20, 4, -20)]
+		self.send_broadcast_packet(PacketFactory.new_helloback_packet(self.address, path))
+
+	def __retry_advertise(self):
+		"""
+		An overloaded root drops join requests without answering them (see AdmissionQueue); Send our Advertise Request
+		again when it has waited client_advertise_retry seconds. If our Register Request was dropped too, the root
+		tells us to register again (see __register_again).
+
+		:return:
+		"""
+		if not self.client_is_advertising or \
+				time.time() - self.client_last_advertise_time < self.client_advertise_retry:
+			return
+		print('Our Advertise Request went unanswered; Sending it again')
+		self.client_advertise_retry = min(self.client_advertise_retry * 2, self.client_advertise_retry_max)
+		self.send_advertise_packet(PacketFactory.new_advertise_packet("REQ", self.address, capacity=self.fan_out,
+																	  token=self.client_rejoin_token))
 
 	def send_advertise_packet(self, advertise_packet):
 		print('Sending advertise packet!')
+		# The connection was dropped while the root was away (e.g. restarting); Connect again.
+		if self.root_address not in self.stream.nodes and self.stream.add_node(self.root_address, True) is None and \
+				self.root_address != self.client_first_root_address:
+			# Our sub-root is gone; The root we started with sends us to another one.
+			print('Sub-root ' + str(peer_address(self.root_address)) + ' is gone; Registering at the root again')
+			self.root_address = self.client_first_root_address
+			self.stream.add_node(self.root_address, True)
+			self.send_packet(PacketFactory.new_register_packet("REQ", self.address, self.address), self.root_address)
+		root = self.stream.nodes.get(self.root_address)
+		if root is not None and not root.register:
+			# The root was our parent too; Only register connections are flushed while we are not connected.
+			root.register = True
+		self.client_is_advertising = True
+		self.client_last_advertise_time = time.time()
 		self.send_packet(advertise_packet, self.root_address)
 		self.stream.send_out_buf_messages(only_register=True)
 
@@ -494,9 +1499,9 @@ class Peer:
 		"""
 		It checks if the address is in our neighbours array or not.
 
-		:param address: Unknown address
+		:param address: Unknown peer ID
 
-		:type address: tuple
+		:type address: int
 
 		:return: Whether is address in our neighbours or not.
 		:rtype: bool
@@ -504,38 +1509,37 @@ class Peer:
 		return address == self.client_predecessor_address or address in self.successors_address
 
 	def helloback_is_mine(self, packet):
-		first_address = packet.get_first_address_hello_packet()
-		return first_address == self.address
+		hop = packet.get_helloback_hop()
+		return hop == packet.get_helloback_path_length() - 1 and packet.get_helloback_address(hop) == self.address
 
 	def change_header(self, packet):
-		packet.source_ip, packet.source_port = self.address[0], self.address[1]
-		packet = Packet(packet.get_buf())
+		with self.profiler.section('change_header'):
+			packet.source_id = self.address
+			packet = Packet(packet.get_buf())
 		return packet
 
 	def forward_hello(self, packet, is_mine=False):
 		if is_mine:
-			self.stream.add_message_to_out_buff(self.client_predecessor_address, packet)
+			self.send_reunion_packet(packet, self.client_predecessor_address)
 		else:
 			print('Forwarding a Hello that is not mine')
+			self.client_last_forward_time = time.time()
 			packet = self.change_header(packet)
-			packet.body += str(self.address[0]) + str(self.address[1])
+			packet.body += peer_string(self.address)
 			new_number_of_elements = int(packet.body[3:5]) + 1
 			packet.body = 'REQ' + str(new_number_of_elements).zfill(2) + packet.body[5:]
 			packet = Packet(packet.get_buf())
-			self.stream.add_message_to_out_buff(self.client_predecessor_address, packet)
+			self.send_reunion_packet(packet, self.client_predecessor_address)
 
 	def forward_helloback(self, packet):
-		packet = self.change_header(packet)
-		packet.body = packet.body[:-20]
-		number_of_entries = str(int(packet.body[3:5]) - 1).zfill(2)
-		packet.body = 'RES' + number_of_entries + packet.body[5:]
-		packet = Packet(packet.get_buf())
-		fw_address = packet.body[-20:]
-		fw_address = (fw_address[:15], fw_address[15:])
-		if fw_address in self.successors_address:
-			self.stream.add_message_to_out_buff(fw_address, packet)
-		else:
+		hop = packet.get_helloback_hop() + 1
+		if hop >= packet.get_helloback_path_length():
 			return
+		fw_address = packet.get_helloback_address(hop)
+		if fw_address in self.successors_address:
+			packet.set_helloback_hop(hop)
+			packet.source_id = self.address
+			self.send_reunion_packet(packet, fw_address)
 
 
 def divide_string(string, n):
@@ -0,0 +1,163 @@
+import heapq
+import itertools
+import sys
+import threading
+import time
+
+from src.Peer import Peer
+from src.UserInterface import UserInterface
+from src.tools.helpers import peer_address
+from src.tools.simpletcp.serverloop import ServerLoop
+
+"""
+	PeerHost runs many Peers in one process without any per-Peer threads.
+
+	All TCPServers are served by one shared ServerLoop (one I/O thread) and every Peer is driven as a state machine
+	by one scheduler thread: a Peer's main loop iteration runs when its timer is due or as soon as data or a command
+	arrives for it, and its reunion iteration runs on its own timer.
+
+"""
+
+
+class PeerHost:
+	def __init__(self):
+		self.server_loop = ServerLoop()
+		self.peers = {}  # {port: Peer}
+		self.user_interface = UserInterface(on_command=self.wake_up)
+		self.__timers = []  # heap of (due time, sequence, function, peer)
+		self.__sequence = itertools.count()
+		self.__ready = []
+		self.__ready_set = set()
+		self.__lock = threading.Lock()
+		self.__wakeup_event = threading.Event()
+		# Serve the TCPServers right away; Clients connect to their root while they are being created.
+		threading.Thread(target=self.server_loop.run, daemon=True).start()
+
+	def add_peer(self, server_ip, server_port, is_root=False, root_address=None, fan_out=None):
+		"""
+		Create a Peer that shares this host's I/O loop and scheduler.
+
+		:param server_ip: Server IP address of the new Peer.
+		:param server_port: Server Port address of the new Peer.
+		:param is_root: Specify that is this Peer root or not.
+		:param root_address: Root IP/Port address if it is a client.
+		:param fan_out: Most children of the new Peer.
+
+		:return: The new Peer.
+		:rtype: Peer
+		"""
+		peer = Peer(server_ip, server_port, is_root=is_root, root_address=root_address, threaded=False,
+					server_loop=self.server_loop, fan_out=fan_out)
+		peer.stream.on_receive = lambda: self.notify(peer)
+		peer.user_interface.on_command = lambda: self.notify(peer)
+		with self.__lock:
+			self.peers[peer_address(peer.address)[1]] = peer
+			now = time.time()
+			self.__schedule(now + peer.loop_interval, self.__run_peer, peer)
+			self.__schedule(now + peer.reunion_interval, self.__run_reunion, peer)
+		self.wake_up()
+		return peer
+
+	def notify(self, peer):
+		"""
+		Something arrived for 'peer'; Run its main loop iteration as soon as possible. Safe to call from any thread.
+
+		:type peer: Peer
+		"""
+		with self.__lock:
+			if peer not in self.__ready_set:
+				self.__ready_set.add(peer)
+				self.__ready.append(peer)
+		self.__wakeup_event.set()
+
+	def wake_up(self):
+		self.__wakeup_event.set()
+
+	def start_user_interface(self, script=None, control_port=None):
+		"""
+		Read host commands like Peer.start_user_interface does.
+
+		:param script: Path of a command file ('-' for stdin) for non-interactive mode.
+		:param control_port: Also accept commands on this local TCP port.
+
+		:return:
+		"""
+		if control_port is not None:
+			port = self.user_interface.start_control_socket(control_port)
+			print(f'Accepting commands on 127.0.0.1:{port}')
+		if script is None and not sys.stdin.isatty():
+			script = '-'
+		if script is not None:
+			self.user_interface.run_script(script)
+		else:
+			self.user_interface.run()
+
+	def run(self):
+		"""
+		The scheduler loop; Every Peer action of the whole host runs on this thread.
+		The shared ServerLoop has one I/O thread of its own.
+
+		:return:
+		"""
+		while True:
+			self.__handle_commands()
+			with self.__lock:
+				ready, self.__ready = self.__ready, []
+				self.__ready_set.clear()
+			for peer in ready:
+				self.__run_safely(peer.run_once, peer)
+
+			now = time.time()
+			due = []
+			with self.__lock:
+				while self.__timers and self.__timers[0][0] <= now:
+					due.append(heapq.heappop(self.__timers))
+			for _, _, function, peer in due:
+				function(peer)
+
+			with self.__lock:
+				timeout = max(0.0, self.__timers[0][0] - time.time()) if self.__timers else None
+				if self.__ready:
+					timeout = 0
+			self.__wakeup_event.wait(timeout)
+			self.__wakeup_event.clear()
+
+	def __schedule(self, due, function, peer):
+		heapq.heappush(self.__timers, (due, next(self.__sequence), function, peer))
+
+	def __run_peer(self, peer):
+		self.__run_safely(peer.run_once, peer)
+		with self.__lock:
+			self.__schedule(time.time() + peer.loop_interval, self.__run_peer, peer)
+
+	def __run_reunion(self, peer):
+		if peer.reunion_daemon_started:
+			self.__run_safely(peer.run_reunion_once, peer)
+		with self.__lock:
+			self.__schedule(time.time() + peer.reunion_interval, self.__run_reunion, peer)
+
+	@staticmethod
+	def __run_safely(function, peer):
+		# One failing Peer must not stop the others.
+		try:
+			function()
+		except Exception as e:
+			print(f'Peer {peer_address(peer.address)} failed: {e!r}')
+
+	def __handle_commands(self):
+		"""
+		Host commands look like '<port> <Peer command>' or 'all <Peer command>', e.g. 'all Register'.
+
+		:return:
+		"""
+		for command in self.user_interface.get_commands():
+			target, _, peer_command = command.partition(' ')
+			if target == 'all':
+				peers = list(self.peers.values())
+			elif target.isdigit() and target.zfill(5) in self.peers:
+				peers = [self.peers[target.zfill(5)]]
+			else:
+				print('Unknown host command: ' + command)
+				continue
+			for peer in peers:
+				peer.user_interface.put(peer_command)
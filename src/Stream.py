@@ -1,11 +1,62 @@
+from src.tools.simpletcp.bufferpool import BufferPool
 from src.tools.simpletcp.tcpserver import TCPServer
+from src.tools.simpletcp.udpserver import UDPServer
+from src.Packet import Packet, PacketFactory, PacketFlag, PacketType
+from src.tools.IngressWorkers import IngressWorkers
 from src.tools.Node import Node
+from src.tools.helpers import peer_address, peer_hex, peer_id
+from src.tools.Profiler import Profiler
+from src.tools.Spool import Spool
+from concurrent.futures import ThreadPoolExecutor
+import os
+import socket
+import stat
+import tempfile
 import threading
+import time
+
+# Most connections add_nodes opens at the same time.
+CONNECT_THREADS = 8
+
+
+def unix_socket_directory():
+	"""
+
+	:return: Directory of the Unix domain sockets of our peers: P2P_UNIX_DIR, or a directory of the user's own in the
+			 temporary directory (see make_unix_socket_directory).
+	:rtype: str
+	"""
+	return os.environ.get('P2P_UNIX_DIR') or os.path.join(tempfile.gettempdir(), f'p2p-{os.getuid()}')
+
+
+def make_unix_socket_directory():
+	"""
+	Create the directory of our Unix domain sockets, only accessible by us; Any local user could connect to our
+	sockets (or put their own in their place) in a directory that others can write to.
+
+	:return:
+	"""
+	directory = unix_socket_directory()
+	os.makedirs(directory, mode=0o700, exist_ok=True)
+	status = os.lstat(directory)
+	if not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid() or status.st_mode & 0o077:
+		raise PermissionError(f'{directory} must be a directory of our own with mode 0700')
+
+
+def unix_socket_path(peer):
+	"""
+
+	:param peer: Peer ID.
+	:return: Where the peer listens for peers of the same host (see unix_socket_directory).
+	:rtype: str
+	"""
+	return os.path.join(unix_socket_directory(), f'p2p-{peer_hex(peer)}.sock')
 
 
 class Stream:
 
-	def __init__(self, ip, port):
+	def __init__(self, ip, port, profiler=None, server_loop=None, ingress_processes=0, send_threads=0,
+				 datagrams=False, unix_sockets=False):
 		"""
 		The Stream object constructor.
 
@@ -15,13 +66,32 @@ class Stream:
 
 		:param ip: 15 characters
 		:param port: 5 characters
+		:param profiler: Timers for the send path; Usually shared with the owning Peer.
+		:param server_loop: A shared ServerLoop to serve our TCPServer from, instead of a thread of its own.
+		:param ingress_processes: Receive and decode in this many worker processes instead of our TCPServer.
+		:param send_threads: Send the out buffers of different nodes in parallel with this many threads.
+		:param datagrams: Also receive UDP datagrams on our port; For Reunion packets, see send_datagram.
+		:param unix_sockets: Also listen on a Unix domain socket and use those of the nodes on our host instead of
+							 loopback TCP; The packets are the same.
 		"""
+		self.profiler = profiler or Profiler()
+		self.server_address = (ip, port)
+		self.ingress_workers = None
+		self.send_pool = ThreadPoolExecutor(send_threads) if send_threads else None
 
 		ip = Node.parse_ip(ip)
 		port = Node.parse_port(port)
+		self.peer_id = peer_id(ip, port)
+		self.unix_sockets = unix_sockets and hasattr(socket, 'AF_UNIX') and hasattr(os, 'getuid')
 		self.nodes = {}
+		self.last_received = {}  # {peer id: when its last packet arrived}
+		# Messages for nodes we could not reach; Replayed when they are added again.
+		self.spool = Spool()
+		self.accepts_compression = False
 
 		self._server_in_buf = []
+		# Called (from the server thread) after new data has been buffered.
+		self.on_receive = None
 
 		def callback(address, queue, data):
 			"""
@@ -29,15 +99,50 @@ class Stream:
 
 			:param address: Source address.
 			:param queue: Response queue.
-			:param data: The data received from the socket.
+			:param data: One packet received from the socket; A memoryview of a pooled buffer.
 			:return:
 			"""
 			queue.put(bytes('ACK', 'utf8'))
 			self._server_in_buf.append(data)
+			if self.on_receive:
+				self.on_receive()
 
-		self.tcp_server = TCPServer(ip, int(port), read_callback=callback)
-		t = threading.Thread(target=self.tcp_server.run)
-		t.start()
+		def datagram_callback(address, data):
+			self._server_in_buf.append(data)
+			if self.on_receive:
+				self.on_receive()
+
+		self.tcp_server = None
+		self.udp_server = None
+		self.unix_server = None
+		if ingress_processes:
+			self.ingress_workers = IngressWorkers(ip, int(port), ingress_processes)
+			self.ingress_workers.on_receive = lambda: self.on_receive and self.on_receive()
+			self.buffer_pool = BufferPool(2048)
+		else:
+			self.tcp_server = TCPServer(ip, int(port), read_callback=callback, frame_size=Packet.get_frame_size)
+			self.buffer_pool = self.tcp_server.server_socket.buffer_pool
+			if self.unix_sockets:
+				try:
+					make_unix_socket_directory()
+				except OSError as e:
+					print('Not listening on a Unix domain socket: ' + str(e))
+					self.unix_sockets = False
+			if self.unix_sockets:
+				# Frames of both servers are released to self.buffer_pool; They must share it.
+				self.unix_server = TCPServer(ip, int(port), read_callback=callback, frame_size=Packet.get_frame_size,
+											 unix_path=unix_socket_path(self.peer_id), buffer_pool=self.buffer_pool)
+		if datagrams:
+			self.udp_server = UDPServer(ip, int(port), datagram_callback, buffer_pool=self.buffer_pool)
+
+		for server in (self.tcp_server, self.unix_server, self.udp_server):
+			if server is None:
+				continue
+			if server_loop is not None:
+				server.attach(server_loop)
+			else:
+				t = threading.Thread(target=server.run, daemon=True)
+				t.start()
 
 	def get_server_address(self):
 		"""
@@ -45,33 +150,100 @@ class Stream:
 		:return: Our TCPServer address
 		:rtype: tuple
 		"""
+		if self.tcp_server is None:
+			return self.server_address[0], int(self.server_address[1])
 		return self.tcp_server.ip, self.tcp_server.port
 
 	def clear_in_buff(self):
 		"""
 		Discard any data in TCPServer input buffer.
+		Buffers returned by read_in_buf were already taken out, so nothing that arrived since is lost.
 
 		:return:
 		"""
-		self._server_in_buf.clear()
 
 	def add_node(self, server_address, set_register_connection=False):
 		"""
 		Will add new a node to our Stream.
 
-		:param server_address: New node TCPServer address.
+		:param server_address: Peer ID of the new node TCPServer.
 		:param set_register_connection: Shows that is this connection a register_connection or not.
 
-		:type server_address: tuple
+		:type server_address: int
 		:type set_register_connection: bool
 
 		:return:
 		"""
 		try:
-			self.nodes[server_address] = Node(server_address, set_register=set_register_connection)
-			return self.nodes[server_address]
+			node = Node(server_address, set_register=set_register_connection,
+						unix_path=self.__get_unix_path(server_address))
+			self.nodes[node.peer_id] = node
 		except:
 			return None
+		if self.spool.has(node.peer_id) and not set_register_connection:
+			node.out_buff.extend(self.spool.take(node.peer_id))
+			print(f'Replaying {len(node.out_buff)} spooled messages to {node.get_server_address()}')
+		return node
+
+	def move_spool(self, old_address, new_address):
+		"""
+		Send the messages spooled for 'old_address' to 'new_address' instead; e.g. to the backup parent that took the
+		place of a dead parent.
+
+		:type old_address: int
+		:type new_address: int
+
+		:return:
+		"""
+		buffers = self.spool.take(old_address)
+		node = self.nodes.get(new_address)
+		if buffers and node is not None:
+			node.out_buff.extend(buffers)
+			print(f'Replaying {len(buffers)} spooled messages to {node.get_server_address()}')
+
+	def __spool_out_buff(self, node):
+		# Only Messages are worth sending later; The rest is about a tree that will have changed by then.
+		if node.register:
+			return
+		self.spool.open(node.peer_id)
+		for buf in node.out_buff:
+			if Packet.get_type_of(buf) == PacketType.MESSAGE:
+				self.spool.append(node.peer_id, buf)
+		node.out_buff.clear()
+
+	def __get_unix_path(self, address):
+		"""
+
+		:param address: Peer ID of a node.
+		:return: Its Unix domain socket if it is on our host (same IP or loopback) and listens on one, otherwise None.
+		:rtype: str
+		"""
+		if not self.unix_sockets or not (address >> 40 == 127 or address >> 16 == self.peer_id >> 16):
+			return None
+		path = unix_socket_path(address)
+		return path if os.path.exists(path) else None
+
+	def add_nodes(self, server_addresses):
+		"""
+		add_node for many nodes; Their connections are opened in parallel.
+
+		:param server_addresses: Peer IDs of the new nodes.
+		:type server_addresses: list
+
+		:return:
+		"""
+		if len(server_addresses) < 2:
+			for server_address in server_addresses:
+				self.add_node(server_address)
+			return
+		# Plain threads rather than an executor: those refuse work once the main thread has exited.
+		for start in range(0, len(server_addresses), CONNECT_THREADS):
+			threads = [threading.Thread(target=self.add_node, args=(server_address,), daemon=True)
+					   for server_address in server_addresses[start:start + CONNECT_THREADS]]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
 
 	def remove_node(self, node):
 		"""
@@ -86,15 +258,14 @@ class Stream:
 		:return:
 		"""
 		node.close()
-		address = (node.server_ip, node.server_port)
-		self.nodes.pop(address)
+		self.nodes.pop(node.peer_id)
 
 	def add_message_to_out_buff(self, address, message):
 		"""
 		In this function, we will add the message to the output buffer of the node that has the input address.
 		Later we should use send_out_buf_messages to send these buffers into their sockets.
 
-		:param address: Node address that we want to send the message
+		:param address: Peer ID of the node that we want to send the message
 		:param message: Message we want to send
 
 		Warnings:
@@ -102,23 +273,118 @@ class Stream:
 
 		:return:
 		"""
+		if address not in self.nodes and self.spool.has(address):
+			if message.type == PacketType.MESSAGE:
+				self.spool.append(address, message.get_buf())
+			return
 		try:
+			if self.accepts_compression:
+				message.flags |= PacketFlag.ACCEPTS_COMPRESSION
+			if self.udp_server is not None:
+				message.flags |= PacketFlag.ACCEPTS_DATAGRAMS
 			self.nodes[address].add_message_to_out_buff(message)
 			print(
-				f'Add message with type = {message.type} from  {message.get_source_server_address()}  to  {address} out buffer.')
+				f'Add message with type = {message.type} from  {message.get_source_server_address()}  to  {peer_address(address)} out buffer.')
 		except Exception as e:
 			# desired_trace = traceback.format_exc(sys.exc_info())
 			print('Problem with sending message!' + message.body)
 
 
+	def send_datagram(self, address, message):
+		"""
+		Send a message right away as a UDP datagram instead of through the node's out buffer and TCP connection; It
+		does not wait behind other messages, but it may be lost.
+
+		:param address: Peer ID of the receiver.
+		:param message: Message we want to send.
+
+		:type address: int
+		:type message: Packet
+
+		:return: Whether it was sent; Always False when we do not use datagrams.
+		:rtype: bool
+		"""
+		if self.udp_server is None:
+			return False
+		if self.accepts_compression:
+			message.flags |= PacketFlag.ACCEPTS_COMPRESSION
+		message.flags |= PacketFlag.ACCEPTS_DATAGRAMS
+		ip, port = peer_address(address)
+		return self.udp_server.sendto(message.get_buf(), (ip, int(port)))
+
 	def read_in_buf(self):
 		"""
-		Only returns the input buffer of our TCPServer.
+		Take the input buffer of our TCPServer; Data that arrives afterwards goes to a fresh buffer.
 
 		:return: TCPServer input buffer.
 		:rtype: list
 		"""
-		return self._server_in_buf
+		in_buf, self._server_in_buf = self._server_in_buf, []
+		return in_buf
+
+	def read_in_packets(self):
+		"""
+		Take everything that arrived since the last call, decoded.
+
+		Warnings:
+			1. The ingress workers group their packets by type; Their packets of different types are not in order of
+			   arrival.
+
+		:return: Arrived packets in order of arrival (per connection).
+		:rtype: list
+		"""
+		packets = []
+		if self.ingress_workers is not None:
+			for worker_packets in self.ingress_workers.read_batch().values():
+				packets.extend(worker_packets)
+		# With ingress workers only datagrams are left here.
+		for buf in self.read_in_buf():
+			try:
+				packets.append(Packet(buf))
+			finally:
+				# The Packet has its own copy of everything; The buffer can take the next frame.
+				self.buffer_pool.release(buf)
+		if packets:
+			now = time.time()
+			for packet in packets:
+				self.last_received[packet.source_id] = now
+		return packets
+
+	def read_in_batch(self):
+		"""
+		Like read_in_packets, but the whole drained batch is decoded at once and grouped by packet type (see
+		PacketFactory.parse_batch); For the root, whose batches are mostly Reunion Hellos.
+
+		:return: {packet type: [Packet, ...]}
+		:rtype: dict
+		"""
+		buffers = self.read_in_buf()
+		try:
+			batch = PacketFactory.parse_batch(buffers)
+		finally:
+			for buf in buffers:
+				self.buffer_pool.release(buf)
+		if self.ingress_workers is not None:
+			for packet_type, packets in self.ingress_workers.read_batch().items():
+				batch.setdefault(packet_type, []).extend(packets)
+		now = time.time()
+		for packets in batch.values():
+			for packet in packets:
+				self.last_received[packet.source_id] = now
+		return batch
+
+	def get_last_heard(self, address):
+		"""
+		Every packet from a neighbour and every ACK of it shows that it is alive, not only Reunion packets.
+
+		:param address: Peer ID of the neighbour.
+		:type address: int
+
+		:return: When we last received a packet from it or it last ACKed one of ours; 0 if never.
+		:rtype: float
+		"""
+		node = self.nodes.get(address)
+		return max(self.last_received.get(address, 0), node.last_acked if node is not None else 0)
 
 	def send_messages_to_node(self, node):
 		"""
@@ -135,7 +401,8 @@ class Stream:
 		"""
 
 		try:
-			node.send_message()
+			with self.profiler.section('socket_send'):
+				node.send_message()
 		except Exception as e:
 			raise e
 
@@ -146,24 +413,40 @@ class Stream:
 		:return:
 		"""
 		nodes_to_be_removed = []
-		for node in self.nodes.values():
-
-			if only_register:
-				if node.register:
-					try:
-						self.send_messages_to_node(node)
-					except:
-						print('could not send to ' + str(node.get_server_address()))
+		with self.profiler.section('Stream.send_out_buf_messages'):
+			if self.send_pool is not None:
+				nodes = [node for node in self.nodes.values() if node.out_buff and (node.register or not only_register)]
+				for node, sent in zip(nodes, self.send_pool.map(self.__try_send_messages_to_node, nodes)):
+					if not sent:
 						nodes_to_be_removed.append(node)
-
 			else:
-				try:
-					self.send_messages_to_node(node)
-				except:
-					print('could not send to ' + str(node.get_server_address()))
-					nodes_to_be_removed.append(node)
+				for node in self.nodes.values():
+
+					if only_register:
+						if node.register:
+							try:
+								self.send_messages_to_node(node)
+							except:
+								print('could not send to ' + str(node.get_server_address()))
+								nodes_to_be_removed.append(node)
+
+					else:
+						try:
+							self.send_messages_to_node(node)
+						except:
+							print('could not send to ' + str(node.get_server_address()))
+							nodes_to_be_removed.append(node)
 
 		for node in nodes_to_be_removed:
-			self.nodes.pop(node.get_server_address())
+			self.nodes.pop(node.peer_id)
+			self.__spool_out_buff(node)
 
-		return [n.get_server_address() for n in nodes_to_be_removed]
+		return [n.peer_id for n in nodes_to_be_removed]
+
+	def __try_send_messages_to_node(self, node):
+		try:
+			self.send_messages_to_node(node)
+			return True
+		except:
+			print('could not send to ' + str(node.get_server_address()))
+			return False
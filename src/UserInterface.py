@@ -1,10 +1,50 @@
+import queue
+import socket
+import sys
 import threading
 import time
 
 
 class UserInterface(threading.Thread):
-    buffer = []
 
+    def __init__(self, on_command=None):
+        """
+        Commands are kept in a per-instance thread-safe queue; The Peer drains it in its main loop.
+
+        :param on_command: Called after every queued command, e.g. to wake up the Peer main loop.
+        :type on_command: function
+        """
+        super().__init__(daemon=True)
+        self.buffer = queue.Queue()
+        self.on_command = on_command
+
+    def put(self, message):
+        """
+        Queue a command for the Peer; Blank lines are ignored.
+
+        :param message: The command line.
+        :type message: str
+        """
+        message = message.strip()
+        if not message:
+            return
+        self.buffer.put(message)
+        if self.on_command:
+            self.on_command()
+
+    def get_commands(self):
+        """
+        Take every command that is queued right now without waiting for new ones.
+
+        :return: Commands in arrival order.
+        :rtype: list
+        """
+        commands = []
+        while True:
+            try:
+                commands.append(self.buffer.get_nowait())
+            except queue.Empty:
+                return commands
 
     def run(self):
         """
@@ -13,4 +53,57 @@ class UserInterface(threading.Thread):
         """
         while True:
             message = input("Write your command:\n")
-            self.buffer.append(message)
+            self.put(message)
+
+    def run_script(self, source):
+        """
+        Non-interactive mode: read one command per line from a file, a pipe or any iterable of lines.
+        Lines starting with '#' are comments and 'Sleep <seconds>' pauses the script.
+
+        :param source: A path, '-' for stdin, or an open file object.
+        """
+        if source == '-':
+            source = sys.stdin
+        if isinstance(source, str):
+            with open(source) as f:
+                self.run_script(f)
+            return
+        for line in source:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('Sleep'):
+                parts = line.split()
+                try:
+                    seconds = float(parts[1]) if len(parts) == 2 else -1
+                except ValueError:
+                    seconds = -1
+                if seconds < 0:
+                    print('Sleep needs a number of seconds: ' + line)
+                else:
+                    time.sleep(seconds)
+                continue
+            self.put(line)
+
+    def start_control_socket(self, port, host='127.0.0.1'):
+        """
+        Accept commands from local TCP clients, one command per line, e.g. `nc 127.0.0.1 <port>`.
+
+        :param port: Port of the control socket; 0 chooses a free one.
+        :param host: Only the loopback interface by default.
+
+        :return: The bound port.
+        :rtype: int
+        """
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, port))
+        server.listen(5)
+
+        def accept():
+            while True:
+                connection, _ = server.accept()
+                threading.Thread(target=self.run_script, args=(connection.makefile('r'),), daemon=True).start()
+
+        threading.Thread(target=accept, daemon=True).start()
+        return server.getsockname()[1]
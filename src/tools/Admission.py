@@ -0,0 +1,103 @@
+import time
+
+
+class TokenBucket:
+	def __init__(self, rate, burst):
+		"""
+
+		:param rate: Tokens added per second.
+		:param burst: Most tokens the bucket can hold.
+
+		:type rate: float
+		:type burst: int
+		"""
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.last_update = time.time()
+
+	def take(self, now):
+		"""
+		Take one token if there is any.
+
+		:param now: Current time.
+		:type now: float
+
+		:return: Whether a token was taken.
+		:rtype: bool
+		"""
+		self.tokens = min(self.burst, self.tokens + (now - self.last_update) * self.rate)
+		self.last_update = now
+		if self.tokens < 1:
+			return False
+		self.tokens -= 1
+		return True
+
+
+class AdmissionQueue:
+	def __init__(self, rate=1.0, burst=4, batch_size=64, max_pending=4096):
+		"""
+		Register and Advertise requests that wait for the root to admit them.
+
+		The root takes up to 'batch_size' requests per main loop iteration, so a join storm costs every iteration a
+		bounded amount of time and the Reunion Hellos are still answered in time.
+
+		Warnings:
+			1. Every source has a token bucket; Requests from a source that has no token left are dropped.
+			2. When 'max_pending' requests are waiting, new ones are dropped as well.
+
+		:param rate: Requests per second allowed for one source.
+		:param burst: Requests one source can send at once; A joining peer sends a Register and an Advertise.
+		:param batch_size: Requests admitted per main loop iteration.
+		:param max_pending: Requests allowed to wait.
+
+		:type rate: float
+		:type burst: int
+		:type batch_size: int
+		:type max_pending: int
+		"""
+		self.rate = rate
+		self.burst = burst
+		self.batch_size = batch_size
+		self.max_pending = max_pending
+		self.buckets = {}  # {source address: TokenBucket}
+		self.pending = []
+		self.dropped = 0
+
+	def offer(self, packet):
+		"""
+		Queue a Register or Advertise request unless its source is over its rate or the queue is full.
+
+		:type packet: Packet
+
+		:return: Whether the request was queued.
+		:rtype: bool
+		"""
+		now = time.time()
+		source = packet.get_source_server_address()
+		bucket = self.buckets.get(source)
+		if bucket is None:
+			if len(self.buckets) >= self.max_pending:
+				self.__forget_idle_sources(now)
+			bucket = self.buckets[source] = TokenBucket(self.rate, self.burst)
+		if len(self.pending) >= self.max_pending or not bucket.take(now):
+			self.dropped += 1
+			print('Dropping a join request from ' + str(source))
+			return False
+		self.pending.append(packet)
+		return True
+
+	def take_batch(self):
+		"""
+
+		:return: The oldest waiting requests, at most batch_size of them.
+		:rtype: list
+		"""
+		batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+		return batch
+
+	def __forget_idle_sources(self, now):
+		# A bucket that would be full again is the same as a new one.
+		full_after = self.burst / self.rate
+		for source in [source for source, bucket in self.buckets.items() if now - bucket.last_update >= full_after]:
+			self.buckets.pop(source)
@@ -0,0 +1,334 @@
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+from src.tools.NetworkGraph import GraphNode, HelloTimes, NetworkGraph
+
+
+class ArrayNode(GraphNode):
+	def __init__(self, graph, address, capacity=2):
+		"""
+		A GraphNode whose parent, depth, capacity, number of children and on/off state live in the columns of its
+		ArrayGraph (at index 'slot'), so the graph can sweep all nodes at once.
+
+		Warnings:
+			1. A node that has left the graph for good gives its slot back (slot None); It reads as off and at
+			   depth -1 from then on.
+
+		:param graph: The graph that holds the columns.
+		:param address: Peer ID of the node.
+		:param capacity: Most children the node takes.
+
+		:type graph: ArrayGraph
+		:type address: int
+		:type capacity: int
+		"""
+		self.graph = graph
+		self.slot = graph.allocate_slot(self)
+		self._parent = None
+		super().__init__(address, capacity)
+		# Not in the tree until add_node puts it there.
+		self.is_on = False
+		self.depth = -1
+
+	@property
+	def parent(self):
+		return self._parent
+
+	@parent.setter
+	def parent(self, parent):
+		self._parent = parent
+		if self.slot is not None:
+			self.graph.parents[self.slot] = parent.slot if parent is not None and parent.slot is not None else -1
+
+	@property
+	def depth(self):
+		return int(self.graph.depths[self.slot]) if self.slot is not None else -1
+
+	@depth.setter
+	def depth(self, depth):
+		if self.slot is not None:
+			self.graph.depths[self.slot] = depth
+
+	@property
+	def capacity(self):
+		return int(self.graph.capacities[self.slot]) if self.slot is not None else 0
+
+	@capacity.setter
+	def capacity(self, capacity):
+		if self.slot is not None:
+			self.graph.capacities[self.slot] = capacity
+
+	@property
+	def is_on(self):
+		return self.slot is not None and bool(self.graph.on[self.slot])
+
+	@is_on.setter
+	def is_on(self, is_on):
+		if self.slot is not None:
+			self.graph.on[self.slot] = is_on
+
+	def add_child(self, child):
+		if not super().add_child(child):
+			return False
+		self.graph.child_counts[self.slot] += 1
+		return True
+
+	def remove_child(self, child):
+		if not super().remove_child(child):
+			return False
+		if self.slot is not None:
+			self.graph.child_counts[self.slot] -= 1
+			if not self.children and self.graph.nodes.get(self.address) is not self:
+				# A removed node whose orphans have all found new parents.
+				self.graph.release_slot(self)
+		return True
+
+
+class ArrayGraph(NetworkGraph):
+	# Sub-trees smaller than this are walked node by node; Masking all nodes costs more.
+	SUBTREE_MASK_THRESHOLD = 512
+
+	def __init__(self, root, fan_out=None):
+		"""
+		A NetworkGraph that also keeps its nodes as a struct of NumPy arrays (parent index, depth, capacity, number of
+		children and on/off), indexed by ArrayNode.slot. The sweeps over the whole tree run as vectorized operations:
+		turning big sub-trees on and off and finding the shallowest node with a free slot. The GraphNode API stays the
+		same, so the Peer and RootStore use it like a NetworkGraph.
+
+		Warnings:
+			1. Needs NumPy; Check 'available' first.
+
+		:param root: The root GraphNode; Its address and capacity are copied to a new ArrayNode.
+		:param fan_out: Children of a node that did not say how many it takes; Defaults to the root's capacity.
+
+		:type root: GraphNode
+		:type fan_out: int
+		"""
+		if numpy is None:
+			raise ImportError('ArrayGraph needs NumPy')
+		self.slot_nodes = []  # {slot: ArrayNode}
+		self.free_slots = []
+		self.parents = numpy.full(0, -1, dtype=numpy.int64)
+		self.depths = numpy.full(0, -1, dtype=numpy.int32)
+		self.capacities = numpy.zeros(0, dtype=numpy.int32)
+		self.child_counts = numpy.zeros(0, dtype=numpy.int32)
+		self.on = numpy.zeros(0, dtype=bool)
+		self.nodes = {}
+		root = ArrayNode(self, root.address, root.capacity)
+		root.is_on = True
+		root.depth = 0
+		self.last_new_node = None
+		super().__init__(root, fan_out)
+
+	@staticmethod
+	def available():
+		"""
+
+		:return: Whether this backend can be used, i.e. NumPy is installed.
+		:rtype: bool
+		"""
+		return numpy is not None
+
+	def new_node(self, address, capacity):
+		self.last_new_node = ArrayNode(self, address, capacity)
+		return self.last_new_node
+
+	def add_node(self, address, father_address, capacity=None):
+		self.last_new_node = None
+		added = super().add_node(address, father_address, capacity)
+		if not added and self.last_new_node is not None:
+			# It never made it into the graph.
+			self.release_slot(self.last_new_node)
+		return added
+
+	def allocate_slot(self, node):
+		"""
+
+		:param node: A new ArrayNode.
+		:type node: ArrayNode
+
+		:return: Its index in the columns.
+		:rtype: int
+		"""
+		if self.free_slots:
+			slot = self.free_slots.pop()
+			self.slot_nodes[slot] = node
+		else:
+			slot = len(self.slot_nodes)
+			self.slot_nodes.append(node)
+			if slot == len(self.parents):
+				self.__grow(max(1024, 2 * slot))
+		self.parents[slot] = -1
+		self.depths[slot] = -1
+		self.child_counts[slot] = 0
+		self.on[slot] = False
+		return slot
+
+	def release_slot(self, node):
+		slot = node.slot
+		node.slot = None
+		self.slot_nodes[slot] = None
+		self.parents[slot] = -1
+		self.depths[slot] = -1
+		self.child_counts[slot] = 0
+		self.on[slot] = False
+		self.free_slots.append(slot)
+
+	def __grow(self, size):
+		extra = size - len(self.parents)
+		self.parents = numpy.concatenate((self.parents, numpy.full(extra, -1, dtype=numpy.int64)))
+		self.depths = numpy.concatenate((self.depths, numpy.full(extra, -1, dtype=numpy.int32)))
+		self.capacities = numpy.concatenate((self.capacities, numpy.zeros(extra, dtype=numpy.int32)))
+		self.child_counts = numpy.concatenate((self.child_counts, numpy.zeros(extra, dtype=numpy.int32)))
+		self.on = numpy.concatenate((self.on, numpy.zeros(extra, dtype=bool)))
+
+	def remove_node(self, node_address):
+		removed = super().remove_node(node_address)
+		if removed is not None and not removed.children and removed.slot is not None:
+			self.release_slot(removed)
+		return removed
+
+	def subtree_mask(self, subtree_root):
+		"""
+
+		:param subtree_root: A node of this graph.
+		:type subtree_root: ArrayNode
+
+		:return: A boolean array over the slots; True for the nodes of the sub-tree.
+		:rtype: numpy.ndarray
+		"""
+		count = len(self.slot_nodes)
+		parents = self.parents[:count]
+		has_parent = parents >= 0
+		parents = numpy.where(has_parent, parents, 0)
+		mask = numpy.zeros(count, dtype=bool)
+		mask[subtree_root.slot] = True
+		while True:
+			# One level deeper per round.
+			grown = mask | (has_parent & mask[parents])
+			if numpy.array_equal(grown, mask):
+				return mask
+			mask = grown
+
+	def turn_off_subtree(self, subtree_root):
+		if subtree_root.subtree_size < self.SUBTREE_MASK_THRESHOLD or subtree_root.slot is None:
+			super().turn_off_subtree(subtree_root)
+		else:
+			self.on[:len(self.slot_nodes)][self.subtree_mask(subtree_root)] = False
+
+	def turn_on_subtree(self, subtree_root):
+		if subtree_root.subtree_size < self.SUBTREE_MASK_THRESHOLD or subtree_root.slot is None:
+			super().turn_on_subtree(subtree_root)
+		else:
+			self.on[:len(self.slot_nodes)][self.subtree_mask(subtree_root)] = True
+
+	def free_below(self, excluded=None):
+		"""
+		NetworkGraph.free_below as a few sweeps over the columns: the free slots of every node, the shallowest level
+		that has one, then the counts carried up one level per sweep.
+
+		:param excluded: A node whose sub-tree must not be given (a sender's own); Masked out with subtree_mask.
+		:type excluded: ArrayNode
+
+		:return: (the level, SlotCounts of the free slots); (None, None) if there is no free slot at all.
+		:rtype: tuple
+		"""
+		count = len(self.slot_nodes)
+		depths = self.depths[:count]
+		free = numpy.where(self.on[:count] & (depths >= 0), self.capacities[:count] - self.child_counts[:count], 0)
+		if excluded is not None and excluded.slot is not None:
+			free[self.subtree_mask(excluded)] = 0
+		candidates = numpy.flatnonzero(free > 0)
+		if not len(candidates):
+			return None, None
+		depth = int(depths[candidates].min())
+		slots = candidates[depths[candidates] == depth]
+		below = numpy.zeros(count, dtype=numpy.int64)
+		below[slots] = free[slots]
+		parents = self.parents[:count]
+		for _ in range(depth):
+			# One level up per round; Every slot of a level holds the whole count of its sub-tree by then.
+			up, siblings = numpy.unique(parents[slots], return_inverse=True)
+			below[up] += numpy.bincount(siblings, weights=below[slots]).astype(numpy.int64)
+			slots = up
+		return depth, SlotCounts(below)
+
+
+class SlotCounts:
+	def __init__(self, counts):
+		"""
+		Free slot counts by ArrayNode.slot, read and written by node like the {GraphNode: free slots} of a
+		NetworkGraph (see NetworkGraph.free_below and descend).
+
+		:param counts: A count for every slot.
+		:type counts: numpy.ndarray
+		"""
+		self.counts = counts
+
+	def get(self, node, default=0):
+		if node is None or node.slot is None or node.slot >= len(self.counts):
+			return default
+		return int(self.counts[node.slot])
+
+	def __getitem__(self, node):
+		return self.get(node)
+
+	def __setitem__(self, node, count):
+		self.counts[node.slot] = count
+
+
+class ArrayHelloTimes(HelloTimes):
+	def __init__(self, hello_times=None):
+		"""
+		HelloTimes whose times are kept in a NumPy array too, so finding the nodes that timed out is one vectorized
+		comparison instead of a walk over every registered node.
+
+		:param hello_times: Initial {peer id: last hello}.
+		:type hello_times: dict
+		"""
+		super().__init__()
+		self.slots = {}  # {peer id: index in times}
+		self.slot_addresses = []
+		self.free_slots = []
+		self.times = numpy.full(1024, numpy.inf)
+		for address, last_hello in (hello_times or {}).items():
+			self[address] = last_hello
+
+	def __setitem__(self, address, last_hello):
+		super().__setitem__(address, last_hello)
+		slot = self.slots.get(address)
+		if slot is None:
+			if self.free_slots:
+				slot = self.free_slots.pop()
+				self.slot_addresses[slot] = address
+			else:
+				slot = len(self.slot_addresses)
+				self.slot_addresses.append(address)
+				if slot == len(self.times):
+					self.times = numpy.concatenate((self.times, numpy.full(slot, numpy.inf)))
+			self.slots[address] = slot
+		self.times[slot] = last_hello
+
+	def __delitem__(self, address):
+		super().__delitem__(address)
+		self.__free(address)
+
+	def pop(self, address, *default):
+		if address in self:
+			self.__free(address)
+		return super().pop(address, *default)
+
+	def update(self, other=(), **kwargs):
+		for address, last_hello in dict(other, **kwargs).items():
+			self[address] = last_hello
+
+	def __free(self, address):
+		slot = self.slots.pop(address)
+		self.times[slot] = numpy.inf
+		self.slot_addresses[slot] = None
+		self.free_slots.append(slot)
+
+	def older_than(self, oldest):
+		return [self.slot_addresses[slot] for slot in numpy.flatnonzero(self.times < oldest)]
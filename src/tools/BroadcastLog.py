@@ -0,0 +1,89 @@
+import collections
+
+
+class LogEntry:
+	def __init__(self, origin, sequence, flags, body):
+		"""
+
+		:param origin: Peer ID of the peer that broadcast the Message.
+		:param sequence: Its sequence number at the origin.
+		:param flags: Packet flags of the Message (e.g. Fragment), without the compression flags.
+		:param body: The Message body after the sequence header.
+
+		:type origin: int
+		:type sequence: int
+		:type flags: int
+		:type body: str
+		"""
+		self.origin = origin
+		self.sequence = sequence
+		self.flags = flags
+		self.body = body
+
+
+class BroadcastLog:
+	def __init__(self, capacity=1024):
+		"""
+		A ring of the most recent broadcast Messages and, per origin, the highest sequence number seen.
+		It drops Messages that arrive twice (e.g. from a spool replay after a delta sync) and tells a rejoining child
+		which Messages it has missed.
+
+		Warnings:
+			1. Only the last 'capacity' Messages are kept; A child that has been away for longer misses the older ones.
+			2. A sequence number below the high-watermark is only accepted if it was skipped before, i.e. it is one of
+			   the (at most 'capacity') known gaps of its origin.
+
+		:param capacity: Most Messages kept.
+		:type capacity: int
+		"""
+		self.capacity = capacity
+		self.entries = collections.deque(maxlen=capacity)  # LogEntry, oldest first
+		self.high = {}  # {origin: highest sequence number seen}
+		self.gaps = {}  # {origin: set of skipped sequence numbers below 'high'}
+
+	def add(self, origin, sequence, flags, body):
+		"""
+		Record a Message.
+
+		:type origin: int
+		:type sequence: int
+		:type flags: int
+		:type body: str
+
+		:return: False if it has been recorded before, i.e. it is a duplicate.
+		:rtype: bool
+		"""
+		high = self.high.get(origin)
+		if high is not None and sequence <= high:
+			gaps = self.gaps.get(origin)
+			if not gaps or sequence not in gaps:
+				return False
+			gaps.discard(sequence)
+		else:
+			if high is not None and 1 < sequence - high <= self.capacity:
+				gaps = self.gaps.setdefault(origin, set())
+				gaps.update(range(high + 1, sequence))
+				if len(gaps) > self.capacity:
+					gaps.difference_update(sorted(gaps)[:len(gaps) - self.capacity])
+			self.high[origin] = sequence
+		self.entries.append(LogEntry(origin, sequence, flags, body))
+		return True
+
+	def get_watermarks(self):
+		"""
+
+		:return: {origin: highest sequence number seen}
+		:rtype: dict
+		"""
+		return dict(self.high)
+
+	def get_missing(self, watermarks):
+		"""
+
+		:param watermarks: High-watermarks of a child, as from its get_watermarks.
+		:type watermarks: dict
+
+		:return: The kept Messages above the child's watermark of their origin, oldest first.
+		:rtype: list
+		"""
+		return [entry for entry in self.entries if entry.sequence > watermarks.get(entry.origin, -1)]
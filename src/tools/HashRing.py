@@ -0,0 +1,74 @@
+import bisect
+import hashlib
+
+from src.tools.helpers import peer_hex
+
+
+class HashRing:
+	def __init__(self, members=(), replicas=64):
+		"""
+		Consistent hashing of peer IDs onto a set of members (the sub-roots of a federation): every member has
+		'replicas' points on a ring and a peer belongs to the first member clockwise from its own point. When a member
+		is added or removed only its share of the peers moves.
+
+		:param members: Peer IDs of the members.
+		:param replicas: Points of every member on the ring; More points spread the peers more evenly.
+
+		:type members: list
+		:type replicas: int
+		"""
+		self.replicas = replicas
+		self.members = []
+		self.points = []  # sorted hashes
+		self.owners = []  # member of every point, in the order of 'points'
+		for member in members:
+			self.add(member)
+
+	@staticmethod
+	def hash(key):
+		return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+	def add(self, member):
+		if member in self.members:
+			return
+		self.members.append(member)
+		for replica in range(self.replicas):
+			point = self.hash(f'{peer_hex(member)}-{replica}')
+			index = bisect.bisect(self.points, point)
+			self.points.insert(index, point)
+			self.owners.insert(index, member)
+
+	def remove(self, member):
+		if member not in self.members:
+			return
+		self.members.remove(member)
+		kept = [(point, owner) for point, owner in zip(self.points, self.owners) if owner != member]
+		self.points = [point for point, _ in kept]
+		self.owners = [owner for _, owner in kept]
+
+	def get(self, peer, accept=None):
+		"""
+
+		:param peer: Peer ID to place.
+		:param accept: Members it may get; e.g. only the live ones. All by default.
+
+		:type peer: int
+		:type accept: callable
+
+		:return: The first accepted member clockwise from the peer's point; None if there is none.
+		:rtype: int
+		"""
+		if not self.points:
+			return None
+		start = bisect.bisect(self.points, self.hash(peer_hex(peer)))
+		tried = set()
+		for index in range(start, start + len(self.points)):
+			owner = self.owners[index % len(self.points)]
+			if owner in tried:
+				continue
+			if accept is None or accept(owner):
+				return owner
+			tried.add(owner)
+			if len(tried) == len(self.members):
+				break
+		return None
@@ -0,0 +1,122 @@
+import multiprocessing
+import struct
+import threading
+
+from src.Packet import Packet, PacketFactory
+from src.tools.simpletcp.serverloop import ServerLoop
+from src.tools.simpletcp.tcpserver import TCPServer
+
+
+def run_ingress_worker(ip, port, out_queue, batch_size, batch_delay):
+	"""
+	Body of one worker process: accept connections on the shared port, answer ACKs, decode the packets and pass them
+	to the owner in batches, grouped by type, as compact records (see PacketFactory.encode_records).
+
+	:param ip: Server IP.
+	:param port: Server port; Every worker binds it with SO_REUSEPORT.
+	:param out_queue: multiprocessing queue towards the owner.
+	:param batch_size: Flush a batch when it has this many packets.
+	:param batch_delay: Longest time (seconds) a decoded packet waits for its batch.
+	"""
+	batch = {}  # {packet type: [Packet, ...]}
+	count = 0
+
+	def callback(address, response_queue, data):
+		nonlocal count
+		response_queue.put(bytes('ACK', 'utf8'))
+		try:
+			packet = Packet(data)
+		except (struct.error, UnicodeDecodeError) as e:
+			print('Dropping an undecodable buffer: ' + repr(e))
+			return
+		finally:
+			server.release_buffer(data)
+		batch.setdefault(packet.type, []).append(packet)
+		count += 1
+		if count >= batch_size:
+			flush()
+
+	def flush():
+		nonlocal count
+		if batch:
+			out_queue.put([(packet_type, PacketFactory.encode_records(packets)) for packet_type, packets in batch.items()])
+			batch.clear()
+			count = 0
+
+	server = TCPServer(ip, port, read_callback=callback, reuse_port=True, frame_size=Packet.get_frame_size)
+	loop = ServerLoop()
+	server.attach(loop)
+	# An empty batch tells the owner that this worker is listening.
+	out_queue.put([])
+	while True:
+		loop.run_once(batch_delay)
+		flush()
+
+
+class IngressWorkers:
+	def __init__(self, ip, port, processes, batch_size=256, batch_delay=0.005):
+		"""
+		Worker processes that take socket reads, ACKs, framing and packet decoding off the owner's core.
+
+		All workers listen on the same port (SO_REUSEPORT) so the kernel spreads incoming connections over them;
+		The owner only receives compact records of decoded packets, grouped by type, and stays the single writer of
+		its own state.
+
+		:param ip: Server IP.
+		:param port: Server port.
+		:param processes: Number of worker processes.
+		:param batch_size: Packets per batch at most.
+		:param batch_delay: Seconds a packet may wait in a worker for its batch to fill.
+
+		:type ip: str
+		:type port: int
+		:type processes: int
+		"""
+		context = multiprocessing.get_context('spawn')
+		self.queue = context.Queue()
+		self.on_receive = None
+		self._batches = []
+		self._lock = threading.Lock()
+		self.processes = [context.Process(target=run_ingress_worker, args=(ip, port, self.queue, batch_size,
+																		   batch_delay), daemon=True)
+						  for _ in range(processes)]
+		for process in self.processes:
+			process.start()
+		# Do not return before the port accepts connections.
+		for _ in self.processes:
+			self.queue.get(timeout=30)
+		threading.Thread(target=self.__collect, daemon=True).start()
+
+	def __collect(self):
+		while True:
+			try:
+				batch = self.queue.get()
+			except (EOFError, OSError):
+				return
+			with self._lock:
+				self._batches.append(batch)
+			if self.on_receive:
+				self.on_receive()
+
+	def read_batch(self):
+		"""
+		Take every packet the workers have delivered so far.
+
+		:return: {packet type: [Packet, ...]}; The packets of every type stay in order of arrival (per connection).
+		:rtype: dict
+		"""
+		with self._lock:
+			batches, self._batches = self._batches, []
+		grouped = {}
+		for batch in batches:
+			for packet_type, records in batch:
+				packets = PacketFactory.parse_records(*records)
+				if packet_type in grouped:
+					grouped[packet_type].extend(packets)
+				else:
+					grouped[packet_type] = packets
+		return grouped
+
+	def stop(self):
+		for process in self.processes:
+			process.terminate()
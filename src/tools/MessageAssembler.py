@@ -0,0 +1,106 @@
+import time
+
+
+class PartialMessage:
+	def __init__(self, total):
+		"""
+
+		:param total: Number of fragments of the message.
+		:type total: int
+		"""
+		self.total = total
+		self.parts = {}  # {index: payload}
+		self.size = 0
+		self.last_update = time.time()
+
+
+class MessageAssembler:
+	def __init__(self, max_bytes=64 * 1024 * 1024, timeout=60):
+		"""
+		Reassembles fragmented Message packets as their pieces arrive.
+
+		Warnings:
+			1. The memory for unfinished messages is bounded by 'max_bytes'; When it is exceeded the least recently
+			   updated messages are dropped.
+			2. A message that has not received a fragment for 'timeout' seconds is dropped by 'expire'.
+
+		:param max_bytes: Memory budget (in characters) for all unfinished messages together.
+		:param timeout: Seconds to wait for the next fragment of a message.
+
+		:type max_bytes: int
+		:type timeout: int
+		"""
+		self.max_bytes = max_bytes
+		self.timeout = timeout
+		self.partials = {}  # {message id: PartialMessage}
+		self.size = 0
+		self.dropped = set()
+
+	def add_fragment(self, message_id, index, total, payload):
+		"""
+		Store one fragment.
+
+		:param message_id: Message ID from the fragment header.
+		:param index: Position of this fragment.
+		:param total: Number of fragments of the message.
+		:param payload: Fragment payload.
+
+		:type message_id: str
+		:type index: int
+		:type total: int
+		:type payload: str
+
+		:return: The whole message when this was its last missing fragment, otherwise None.
+		:rtype: str
+		"""
+		if message_id in self.dropped or not 0 <= index < total:
+			return None
+		if len(payload) > self.max_bytes:
+			self.__drop(message_id)
+			return None
+
+		partial = self.partials.get(message_id)
+		if partial is None:
+			partial = self.partials[message_id] = PartialMessage(total)
+		if index in partial.parts:
+			return None
+
+		while self.size + len(payload) > self.max_bytes:
+			oldest = min(self.partials, key=lambda key: self.partials[key].last_update)
+			self.__drop(oldest)
+			if oldest == message_id:
+				return None
+
+		partial.parts[index] = payload
+		partial.size += len(payload)
+		partial.last_update = time.time()
+		self.size += len(payload)
+
+		if len(partial.parts) < partial.total:
+			return None
+		self.partials.pop(message_id)
+		self.size -= partial.size
+		return ''.join(partial.parts[i] for i in range(partial.total))
+
+	def expire(self):
+		"""
+		Drop every unfinished message that has waited more than 'timeout' seconds for its next fragment.
+
+		:return: IDs of the dropped messages.
+		:rtype: list
+		"""
+		now = time.time()
+		expired = [message_id for message_id, partial in self.partials.items()
+				   if now - partial.last_update > self.timeout]
+		for message_id in expired:
+			print('Dropping unfinished message ' + message_id)
+			self.__drop(message_id)
+		return expired
+
+	def __drop(self, message_id):
+		partial = self.partials.pop(message_id, None)
+		if partial is not None:
+			self.size -= partial.size
+		self.dropped.add(message_id)
+		if len(self.dropped) > 10000:
+			self.dropped.clear()
@@ -1,28 +1,32 @@
+from collections import deque
 import time
 
+from src.tools.helpers import peer_address
+
 
 class GraphNode:
-	def __init__(self, address):
+	def __init__(self, address, capacity=2):
 		"""
 
-		:param address: (ip, port)
-		:type address: tuple
+		:param address: Peer ID of the node.
+		:param capacity: Most children the node takes.
+
+		:type address: int
+		:type capacity: int
 
 		"""
 		self.address = address
 		self.parent = None
-		self.left_child = None
-		self.right_child = None
+		self.children = []
+		self.capacity = capacity
+		self.subtree_size = 1
+		self.depth = 0
+		self.last_moved = 0
 		self.is_on = True
 		self.alive = False
 
 	def get_children(self):
-		result = []
-		if self.left_child:
-			result.append(self.left_child)
-		if self.right_child:
-			result.append(self.right_child)
-		return result
+		return self.children
 
 	def set_parent(self, parent):
 		self.parent = parent
@@ -32,69 +36,257 @@ class GraphNode:
 
 	def __reset(self):
 		self.address = None
-		self.left_child = None
-		self.right_child = None
+		self.children = []
 
 	def can_have_child(self):
-		return not (self.left_child and self.right_child)
+		return len(self.children) < self.capacity
 
 	def add_child(self, child):
 		# returns success
-		if not self.left_child:
-			self.left_child = child
-			return True
+		if not self.can_have_child():
+			return False
+		self.children.append(child)
+		return True
 
-		if not self.right_child:
-			self.right_child = child
-			return True
+	def remove_child(self, child):
+		# returns success
+		if child not in self.children:
+			return False
+		self.children.remove(child)
+		return True
 
+	def is_in_subtree_of(self, node):
+		ancestor = self
+		while ancestor is not None:
+			if ancestor is node:
+				return True
+			ancestor = ancestor.parent
 		return False
 
 
+class HelloTimes(dict):
+	"""
+	The root's {peer id: time of its last Reunion Hello} of every registered node (nodes_for_root).
+	"""
+
+	def older_than(self, oldest):
+		"""
+
+		:param oldest: A time.
+		:return: Peer IDs whose last Hello came before 'oldest'.
+		:rtype: list
+		"""
+		return [address for address, last_hello in self.items() if last_hello < oldest]
+
+
 class NetworkGraph:
-	def __init__(self, root):
+	def __init__(self, root, fan_out=None):
+		"""
+
+		:param root: The root GraphNode.
+		:param fan_out: Children of a node that did not say how many it takes; Defaults to the root's capacity.
+
+		:type root: GraphNode
+		:type fan_out: int
+		"""
 		self.root = root
+		self.fan_out = fan_out or root.capacity
 		root.alive = True
 		self.nodes = {root.address: root}
+		# Nodes that hang under the root, by depth; Kept up to date by add_node and remove_node.
+		self.levels = [{root}]
 
 	def find_live_node(self, sender):
 		"""
 		Here we should find a neighbour for the sender.
-		Best neighbour is the node who is nearest the root and has not more than one child.
-
-		Code design suggestion:
-			1. Do a BFS algorithm to find the target.
+		Best neighbour is the node who is nearest the root and has room for another child; Between those, the one in
+		the smallest branches (see descend), so the sub-trees stay balanced.
 
 		Warnings:
 			1. Check whether there is sender node in our NetworkGraph or not; if exist do not return sender node or
 			   any other nodes in it's sub-tree.
 
-		:param sender: The node address we want to find best neighbour for it.
-		:type sender: tuple
+		:param sender: Peer ID of the node we want to find best neighbour for it.
+		:type sender: int
 
 		:return: Best neighbour for sender.
 		:rtype: GraphNode
 		"""
-		# if sender in self.nodes and self.nodes[sender].is_on:
-		# 	return
-		queue = [self.root]
-		while True:
+		sender_node = self.nodes.get(sender)
+		depth, below = self.free_below(sender_node)
+		if depth is None:
+			return None
+		return self.descend(depth, below)
+
+	def find_live_nodes(self, senders, capacities=None):
+		"""
+		find_live_node for a whole batch of senders; The free slots are counted once per level and every placement
+		only updates the counts on the path of its node. Every sender is added to the graph under the node it gets,
+		so the following senders see that slot taken and can be placed under the new node.
+
+		:param senders: Peer IDs that need a neighbour, in order of arrival.
+		:param capacities: {peer id: number of children it takes} for senders that told us.
+
+		:type senders: list
+		:type capacities: dict
+
+		:return: (sender, neighbour GraphNode) for every sender that could be placed.
+		:rtype: list
+		"""
+		capacities = capacities or {}
+		placements = []
+		depth, below = self.free_below()
+		for sender in senders:
+			if depth is not None and below.get(self.root, 0) == 0:
+				# That level is full now; The new nodes may have made room one level deeper.
+				depth, below = self.free_below()
+			if depth is None:
+				break
+			sender_node = self.nodes.get(sender)
+			node = self.descend(depth, below, sender_node)
+			if node is None:
+				# Every free slot of the level is in the sender's own sub-tree.
+				node = self.find_live_node(sender)
+				if node is None:
+					continue
+			if not self.add_node(sender, node.address, capacities.get(sender)):
+				continue
+			placements.append((sender, node))
+			if sender_node is not None:
+				# Its sub-tree has moved, and its free slots with it.
+				depth, below = self.free_below()
+				continue
+			while node is not None:
+				below[node] -= 1
+				node = node.parent
+		return placements
+
+	def free_below(self, excluded=None):
+		"""
+		Find the shallowest level with a free slot and count, for that node and all its ancestors, the free slots of
+		that level in their sub-trees.
+
+		:param excluded: A node whose sub-tree must not be given (a sender's own).
+		:type excluded: GraphNode
+
+		:return: (the level, {GraphNode: free slots}); (None, None) if there is no free slot at all.
+		:rtype: tuple
+		"""
+		for depth, level in enumerate(self.levels):
+			candidates = [node for node in level if node.is_on and node.can_have_child() and
+						  (excluded is None or not node.is_in_subtree_of(excluded))]
+			if candidates:
+				break
+		else:
+			return None, None
+		below = {node: node.capacity - len(node.children) for node in candidates}
+		level = below
+		for _ in range(depth):
+			# One level up per round, so every node is counted once however many free nodes it has under it.
+			parents = {}
+			for node, free in level.items():
+				parents[node.parent] = parents.get(node.parent, 0) + free
+			below.update(parents)
+			level = parents
+		return depth, below
+
+	def descend(self, depth, below, excluded=None):
+		"""
+		Walk from the root down to 'depth', every time into the child with the smallest balance_key among those that
+		still have a free slot there; So the smallest branch under the root first, then the smallest branch under
+		that, and so on.
+
+		:param depth: Level of the free slots (see free_below).
+		:param below: Free slots of that level under every node (see free_below).
+		:param excluded: A node whose sub-tree must not be given; Its free slots are taken off its ancestors.
 
-			head = queue[0]
-			queue = queue[1:]
+		:type depth: int
+		:type below: dict
+		:type excluded: GraphNode
+
+		:return: A node at 'depth' with a free slot; None if there is none outside 'excluded'.
+		:rtype: GraphNode
+		"""
+		excluded_free = below.get(excluded, 0)
+		path = set()
+		while excluded is not None:
+			path.add(excluded)
+			excluded = excluded.parent
+		node = self.root
+		if below.get(node, 0) - (excluded_free if node in path else 0) <= 0:
+			return None
+		while node.depth < depth:
+			children = [child for child in node.children
+						if below.get(child, 0) - (excluded_free if child in path else 0) > 0]
+			if not children:
+				return None
+			node = min(children, key=self.balance_key)
+		return node
+
+	@staticmethod
+	def balance_key(node):
+		"""
+		Order of preference between sibling branches: The smaller sub-tree first, then the node with fewer children.
 
-			if head.can_have_child() and head.is_on:
-				return head
-			queue = queue + head.get_children()
+		:type node: GraphNode
+		:rtype: tuple
+		"""
+		return node.subtree_size, len(node.children)
 
-	def find_node(self, ip, port):
+	def find_node(self, address):
 		"""
 		returns None if node is not in the graph
-		:param ip:
-		:param port:
+		:param address: Peer ID of the node.
 		:return:
 		"""
-		return self.nodes.get((ip, port), None)
+		return self.nodes.get(address, None)
+
+	def get_path(self, address):
+		"""
+		The tree path from the root down to a node.
+
+		:param address: Peer ID of the node.
+		:type address: int
+
+		:return: [peer id of a root child, ..., address]; None if the node is not under the root.
+		:rtype: list
+		"""
+		node = self.nodes.get(address, None)
+		path = []
+		while node is not None and node is not self.root:
+			path.append(node.address)
+			node = node.parent
+		if node is None:
+			return None
+		path.reverse()
+		return path
+
+	def find_backup_parents(self, address, count=2):
+		"""
+		Nodes the node can join on its own if its parent dies: its grandparent (the dead parent frees one slot there)
+		and siblings of the parent that have a free slot. The children of a parent get them in different orders, so
+		they do not all go to the grandparent.
+
+		:param address: Peer ID of the node.
+		:param count: Most backups.
+
+		:type address: int
+		:type count: int
+
+		:return: Peer IDs of the backups; Empty for a child of the root.
+		:rtype: list
+		"""
+		node = self.nodes.get(address, None)
+		if node is None or node.parent is None or node.parent.parent is None:
+			return []
+		grandparent = node.parent.parent
+		uncles = [uncle for uncle in grandparent.children
+				  if uncle is not node.parent and uncle.is_on and uncle.can_have_child()]
+		uncles.sort(key=self.balance_key)
+		backups = [grandparent] + uncles
+		shift = node.parent.children.index(node) % len(backups)
+		backups = backups[shift:] + backups[:shift]
+		return [backup.address for backup in backups][:count]
 
 	def turn_on_node(self, node_address):
 		the_node = self.nodes.get(node_address, None)
@@ -107,67 +299,168 @@ class NetworkGraph:
 			the_node.is_on = False
 
 	def turn_off_subtree(self, subtree_root):
-		queue = [subtree_root]
+		queue = deque([subtree_root])
 		while len(queue) > 0:
-			head = queue[0]
-			queue = queue[1:]
-			self.turn_off_node(head)
-			queue = queue + head.get_children()
+			head = queue.popleft()
+			head.is_on = False
+			queue.extend(head.get_children())
 
 	def turn_on_subtree(self, subtree_root):
-		queue = [subtree_root]
+		queue = deque([subtree_root])
 		while len(queue) > 0:
-			head = queue[0]
-			queue = queue[1:]
-			self.turn_on_node(head)
-			queue = queue + head.get_children()
+			head = queue.popleft()
+			head.is_on = True
+			queue.extend(head.get_children())
 
 	def remove_node(self, node_address):
 		# returns the removed node
 		# returns None if hasn't find anything
-		print('gonna remove ' + str(node_address))
+		print('gonna remove ' + str(peer_address(node_address)))
 		removed = self.nodes.pop(node_address, None)
 		if not removed is None:
-			if removed.parent.left_child:
-				if removed.parent.left_child.address == node_address:
-					removed.parent.left_child = None
-			if removed.parent.right_child:
-				if removed.parent.right_child.address == node_address:
-					removed.parent.right_child = None
-
+			self.__detach(removed)
 			self.turn_off_subtree(removed)
+			# Its sub-tree stays attached to it (turned off) until the nodes advertise again.
 
 		return removed
 
-	def add_node(self, ip, port, father_address):
+	def add_node(self, address, father_address, capacity=None):
 		"""
 		Add a new node with node_address if it does not exist in our NetworkGraph and set its father.
+		A node that is already in the graph is moved under father_address, together with its sub-tree.
 
 		Warnings:
 			1. Don't forget to set the new node as one of the father_address children.
 			2. Before using this function make sure that there is a node which has father_address.
 
-		:param ip: IP address of the new node.
-		:param port: Port of the new node.
-		:param father_address: Father address of the new node
+		:param address: Peer ID of the new node.
+		:param father_address: Peer ID of the father of the new node
+		:param capacity: Most children the node takes; Default is the graph fan_out.
 
-		:type ip: str
-		:type port: int
-		:type father_address: tuple
+		:type address: int
+		:type father_address: int
+		:type capacity: int
 
 
 		:return:
 		"""
 		# return success
-		new_node = self.nodes.get((ip, port), GraphNode((ip, port)))
+		new_node = self.nodes.get(address, None) or self.new_node(address, self.fan_out)
+		if capacity:
+			new_node.capacity = capacity
 
 		new_node.alive = True
 		parent = self.nodes.get(father_address, None)
-		if parent == None:
+		if parent == None or parent.is_in_subtree_of(new_node):
+			return False
+		if new_node.parent is not parent and not parent.can_have_child():
 			return False
 
+		self.__detach(new_node)
 		new_node.set_parent(parent)
 		parent.add_child(new_node)
+		self.__update_subtree_sizes(parent, new_node.subtree_size)
+		if self.__is_indexed(parent):
+			self.__index_subtree(new_node, parent.depth + 1)
 		self.nodes.update({new_node.address: new_node})
 		self.turn_on_subtree(new_node)
 		return True
+
+	def new_node(self, address, capacity):
+		"""
+		Make the GraphNode of a node that add_node adds; Other graph backends (see ArrayGraph) make their own kind.
+
+		:type address: int
+		:type capacity: int
+
+		:rtype: GraphNode
+		"""
+		return GraphNode(address, capacity)
+
+	def __detach(self, node):
+		if self.__is_indexed(node):
+			self.__unindex_subtree(node)
+		if node.parent is not None and node.parent.remove_child(node):
+			self.__update_subtree_sizes(node.parent, -node.subtree_size)
+		node.parent = None
+
+	def __is_indexed(self, node):
+		return 0 <= node.depth < len(self.levels) and node in self.levels[node.depth]
+
+	def __index_subtree(self, subtree_root, depth):
+		queue = deque([(subtree_root, depth)])
+		while queue:
+			node, depth = queue.popleft()
+			node.depth = depth
+			if depth == len(self.levels):
+				self.levels.append(set())
+			self.levels[depth].add(node)
+			queue.extend((child, depth + 1) for child in node.children)
+
+	def __unindex_subtree(self, subtree_root):
+		queue = deque([subtree_root])
+		while queue:
+			node = queue.popleft()
+			self.levels[node.depth].discard(node)
+			# No longer under the root; A stale depth would make it look like a node of that level.
+			node.depth = -1
+			queue.extend(node.children)
+		while len(self.levels) > 1 and not self.levels[-1]:
+			self.levels.pop()
+
+	def get_depth(self):
+		"""
+
+		:return: Depth of the deepest node under the root.
+		:rtype: int
+		"""
+		return len(self.levels) - 1
+
+	def rebalance(self, max_moves=2, threshold=2, cooldown=60):
+		"""
+		Move sub-trees from the deepest part of the tree closer to the root, when there is room near the root.
+
+		A move takes the ancestor of a deepest node that sits 'threshold' levels lower than a free slot would put it
+		and moves it (with its sub-tree) under the free node; The whole sub-tree gets 'threshold' levels closer.
+
+		Warnings:
+			1. At most 'max_moves' moves per call and no node is moved twice in 'cooldown' seconds, so the tree
+			   (and the network) does not oscillate.
+			2. A balanced tree has no free slot 'threshold' levels above its deepest node, so it is never touched.
+
+		:param max_moves: Most moves in this call.
+		:param threshold: Least number of levels a move must gain.
+		:param cooldown: Seconds before a moved node may be moved again.
+
+		:return: [(moved GraphNode, its new parent GraphNode), ...]; The moves are already applied to the graph.
+		:rtype: list
+		"""
+		moves = []
+		now = time.time()
+		while len(moves) < max_moves:
+			depth = self.get_depth()
+			free_depth, below = self.free_below()
+			if free_depth is None or free_depth >= depth - threshold:
+				return moves
+			free = self.descend(free_depth, below)
+
+			target_depth = free.depth + 1 + threshold
+			moving = None
+			for deepest in self.levels[depth]:
+				node = deepest
+				while node.depth > target_depth:
+					node = node.parent
+				if node.is_on and now - node.last_moved >= cooldown:
+					moving = node
+					break
+			if moving is None or not self.add_node(moving.address, free.address):
+				return moves
+			moving.last_moved = now
+			moves.append((moving, free))
+		return moves
+
+	@staticmethod
+	def __update_subtree_sizes(node, change):
+		while node is not None:
+			node.subtree_size += change
+			node = node.parent
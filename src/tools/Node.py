@@ -1,8 +1,11 @@
+import time
+
 from src.tools.simpletcp.clientsocket import ClientSocket
+from src.tools.helpers import peer_address, to_peer_id
 
 
 class Node:
-	def __init__(self, server_address, set_register=False):
+	def __init__(self, server_address, set_register=False, unix_path=None):
 		"""
 		The Node object constructor.
 
@@ -14,16 +17,20 @@ class Node:
 			when a socket is closed here we will face
 			   an exception and we should detach this Node and clear its output buffer.
 
-		:param server_address:
+		:param server_address: Peer ID (or IP/Port address) of the node TCPServer.
 		:param set_root:
 		:param set_register:
+		:param unix_path: The node's Unix domain socket, for a node on our host; TCP is used if it does not answer.
 		"""
-		self.server_ip = Node.parse_ip(server_address[0])
-		self.server_port = Node.parse_port(server_address[1])
+		self.peer_id = to_peer_id(server_address)
+		self.server_ip, self.server_port = peer_address(self.peer_id)
 		self.register = set_register
-		self.client_socket = ClientSocket(self.server_ip, int(self.server_port), single_use=False)
+		self.unix_path = unix_path
+		self.client_socket = self.__connect()
 
 		self.out_buff = []
+		# When the node last ACKed a message of ours.
+		self.last_acked = 0
 
 	def send_message(self):
 		"""
@@ -31,15 +38,45 @@ class Node:
 
 		:return:
 		"""
-		for message in self.out_buff:
+		for index, message in enumerate(self.out_buff):
 			try:
-				self.client_socket.send(message)
+				self.__send_or_reconnect(message)
 			except Exception as e:
 				print("Seems like the socket is closed for " + str(self.get_server_address()))
-				self.out_buff.clear()
+				# The unsent messages stay; Stream spools them.
+				del self.out_buff[:index]
 				raise e
+		if self.out_buff:
+			self.last_acked = time.time()
 		self.out_buff.clear()
 
+	def __send_or_reconnect(self, message):
+		"""
+		Send one message; If the connection has been closed by the other side (e.g. a restarted root) connect again
+		once and resend it.
+
+		:param message: The message buffer.
+		:return:
+		"""
+		try:
+			if self.client_socket.send(message):
+				return
+		except OSError:
+			pass
+		self.client_socket.close()
+		self.client_socket = self.__connect()
+		if not self.client_socket.send(message):
+			raise ConnectionError('No ACK from ' + str(self.get_server_address()))
+
+	def __connect(self):
+		if self.unix_path is not None:
+			try:
+				return ClientSocket(self.server_ip, int(self.server_port), single_use=False, unix_path=self.unix_path)
+			except OSError:
+				# Maybe an old socket file of a peer that is gone or does not listen there; TCP from now on.
+				self.unix_path = None
+		return ClientSocket(self.server_ip, int(self.server_port), single_use=False)
+
 	def add_message_to_out_buff(self, message):
 		"""
 		Here we will add a new message to the server out_buff, then in 'send_message' will send them.
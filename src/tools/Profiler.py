@@ -0,0 +1,260 @@
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+
+
+class _NullSection:
+	"""
+	Returned by Profiler.section while the profiler is off; Entering and leaving it costs nothing.
+	"""
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		return False
+
+
+_NULL_SECTION = _NullSection()
+
+
+class _Section:
+	def __init__(self, profiler, name, cprofile_owner=None):
+		self.profiler = profiler
+		self.name = name
+		self.cprofile_owner = cprofile_owner
+		self.start = 0
+		self.stack = None
+		self.cprofile = None
+
+	def __enter__(self):
+		self.stack = self.profiler._stack()
+		self.stack.append(self.name)
+		if self.cprofile_owner is not None:
+			self.cprofile = self.profiler._cprofile_for(self.cprofile_owner)
+			if self.cprofile is not None:
+				self.cprofile.enable()
+		self.start = time.perf_counter_ns()
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		elapsed = time.perf_counter_ns() - self.start
+		if self.cprofile is not None:
+			self.cprofile.disable()
+		self.profiler._record(';'.join(self.stack), elapsed)
+		self.stack.pop()
+		return False
+
+
+class Profiler:
+	"""
+	Cheap per-section wall clock timers for the Peer hot paths, with optional cProfile and a sampling profiler.
+
+	Timed sections nest per thread, so every measurement is keyed by its whole section stack like
+	'Peer.run;handle_packet.REUNION;change_header'. 'dump' writes those stacks in the collapsed format that
+	flamegraph.pl and speedscope read.
+
+	Modes are chosen with the P2P_PROFILE environment variable (a comma separated list of 'timers', 'cprofile' and
+	'sample'; '1' means 'timers') or at runtime with the 'Profile' user interface command.
+	"""
+	ENV_VARIABLE = 'P2P_PROFILE'
+
+	def __init__(self, timers=False, cprofile=False, sample=False, sample_interval=0.005):
+		"""
+
+		:param timers: Record the timed sections.
+		:param cprofile: Run cProfile inside loop sections (implies timers).
+		:param sample: Start the sampling profiler right away.
+		:param sample_interval: Seconds between two samples of all thread stacks.
+
+		:type timers: bool
+		:type cprofile: bool
+		:type sample: bool
+		:type sample_interval: float
+		"""
+		self.enabled = timers or cprofile
+		self.cprofile_enabled = cprofile
+		self.sample_interval = sample_interval
+		self._lock = threading.Lock()
+		self._local = threading.local()
+		self._sections = {}  # {stack: [calls, total_ns, max_ns]}
+		self._cprofiles = {}  # {owner: cProfile.Profile}; A Profile object must only be used by one thread.
+		self._samples = {}  # {stack: count}
+		self._sampler = None
+		if sample:
+			self.start_sampling()
+
+	@staticmethod
+	def from_environment():
+		"""
+
+		:return: A profiler configured by the P2P_PROFILE environment variable.
+		:rtype: Profiler
+		"""
+		modes = [mode.strip() for mode in os.environ.get(Profiler.ENV_VARIABLE, '').lower().split(',')]
+		return Profiler(timers='timers' in modes or '1' in modes, cprofile='cprofile' in modes,
+						sample='sample' in modes)
+
+	def section(self, name):
+		"""
+		Time the body of a 'with' statement as 'name', nested under the sections that are open in this thread.
+
+		:type name: str
+		"""
+		if not self.enabled:
+			return _NULL_SECTION
+		return _Section(self, name)
+
+	def loop(self, name):
+		"""
+		Like 'section', for the top of a thread's main loop; It also runs this thread's cProfile when enabled.
+
+		:type name: str
+		"""
+		if not self.enabled:
+			return _NULL_SECTION
+		return _Section(self, name, cprofile_owner=name if self.cprofile_enabled else None)
+
+	def enable(self, cprofile=False):
+		self.cprofile_enabled = self.cprofile_enabled or cprofile
+		self.enabled = True
+
+	def disable(self):
+		self.enabled = False
+		self.cprofile_enabled = False
+		self.stop_sampling()
+
+	def reset(self):
+		with self._lock:
+			self._sections.clear()
+			self._cprofiles.clear()
+			self._samples.clear()
+
+	def start_sampling(self, interval=None):
+		"""
+		Start a background thread that records the stack of every other thread each 'interval' seconds.
+		"""
+		if interval is not None:
+			self.sample_interval = interval
+		if self._sampler is not None:
+			return
+		self._sampler = threading.Thread(target=self.__run_sampler, daemon=True)
+		self._sampler.start()
+
+	def stop_sampling(self):
+		self._sampler = None
+
+	def __run_sampler(self):
+		me = threading.current_thread()
+		names = {}
+		while self._sampler is me:
+			for thread in threading.enumerate():
+				names[thread.ident] = thread.name
+			for ident, frame in sys._current_frames().items():
+				if ident == me.ident:
+					continue
+				stack = []
+				while frame is not None:
+					code = frame.f_code
+					stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+					frame = frame.f_back
+				stack.append(names.get(ident, str(ident)))
+				key = ';'.join(reversed(stack))
+				with self._lock:
+					self._samples[key] = self._samples.get(key, 0) + 1
+			time.sleep(self.sample_interval)
+
+	def _stack(self):
+		stack = getattr(self._local, 'stack', None)
+		if stack is None:
+			stack = self._local.stack = []
+		return stack
+
+	def _cprofile_for(self, owner):
+		if not self.cprofile_enabled:
+			return None
+		with self._lock:
+			profile = self._cprofiles.get(owner)
+			if profile is None:
+				profile = self._cprofiles[owner] = cProfile.Profile()
+		return profile
+
+	def _record(self, stack, elapsed):
+		with self._lock:
+			entry = self._sections.get(stack)
+			if entry is None:
+				self._sections[stack] = [1, elapsed, elapsed]
+			else:
+				entry[0] += 1
+				entry[1] += elapsed
+				if elapsed > entry[2]:
+					entry[2] = elapsed
+
+	def summary(self):
+		"""
+
+		:return: One line per timed section, the most expensive first.
+		:rtype: list
+		"""
+		with self._lock:
+			sections = sorted(self._sections.items(), key=lambda item: item[1][1], reverse=True)
+		lines = []
+		for stack, (calls, total, longest) in sections:
+			lines.append(f'{total / 1e6:10.1f} ms {calls:8d} calls {total / calls / 1e3:10.1f} us/call '
+						 f'{longest / 1e3:10.1f} us max  {stack}')
+		return lines
+
+	def collapsed_stacks(self):
+		"""
+		Self time of every timed section in microseconds, in the collapsed stack format ('a;b;c 123').
+
+		:rtype: list
+		"""
+		with self._lock:
+			totals = {stack: entry[1] for stack, entry in self._sections.items()}
+		self_times = dict(totals)
+		for stack, total in totals.items():
+			parent = stack.rpartition(';')[0]
+			if parent in self_times:
+				self_times[parent] -= total
+		return [f'{stack} {max(0, ns // 1000)}' for stack, ns in sorted(self_times.items())]
+
+	def dump(self, prefix):
+		"""
+		Write everything that was collected next to 'prefix':
+			<prefix>.folded          timed sections (flame graph input, weights in microseconds)
+			<prefix>.samples.folded  sampling profiler stacks (flame graph input, weights in samples)
+			<prefix>.prof            cProfile statistics (pstats / snakeviz input)
+
+		:param prefix: Path prefix of the output files.
+		:type prefix: str
+
+		:return: The written file paths.
+		:rtype: list
+		"""
+		written = []
+		stacks = self.collapsed_stacks()
+		if stacks:
+			with open(prefix + '.folded', 'w') as f:
+				f.write('\n'.join(stacks) + '\n')
+			written.append(prefix + '.folded')
+
+		with self._lock:
+			samples = sorted(self._samples.items())
+			profiles = list(self._cprofiles.values())
+		if samples:
+			with open(prefix + '.samples.folded', 'w') as f:
+				f.write(''.join(f'{stack} {count}\n' for stack, count in samples))
+			written.append(prefix + '.samples.folded')
+
+		profiles = [profile for profile in profiles if profile.getstats()]
+		if profiles:
+			stats = pstats.Stats(profiles[0])
+			for profile in profiles[1:]:
+				stats.add(profile)
+			stats.dump_stats(prefix + '.prof')
+			written.append(prefix + '.prof')
+		return written
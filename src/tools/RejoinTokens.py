@@ -0,0 +1,69 @@
+import hashlib
+import hmac
+import os
+
+from src.tools.helpers import peer_hex
+
+
+class RejoinTokens:
+	ENV_VARIABLE = 'P2P_ROOT_SECRET'
+	# Hex characters of a token, i.e. the first 16 bytes of the HMAC.
+	TOKEN_SIZE = 32
+
+	def __init__(self, secret):
+		"""
+		The root gives every node a rejoin token when it registers: an HMAC of its peer ID under the root's secret.
+		A node that the root has evicted meanwhile (e.g. after a Reunion failure) shows it in its next Advertise
+		Request and is registered again on the spot, without another Register round trip.
+
+		Warnings:
+			1. A token is valid as long as the secret is; A standby root needs its primary's secret
+			   (P2P_ROOT_SECRET) to take the primary's tokens.
+
+		:param secret: Key of the HMAC.
+		:type secret: bytes
+		"""
+		self.secret = secret
+
+	@staticmethod
+	def from_environment(root_store=None):
+		"""
+
+		:param root_store: Where the secret is kept when P2P_ROOT_SECRET is not set, so that a restarted root takes
+						   its old tokens.
+		:type root_store: RootStore
+
+		:return: RejoinTokens with the secret of P2P_ROOT_SECRET (hex), of the RootStore or a random one.
+		:rtype: RejoinTokens
+		"""
+		secret = os.environ.get(RejoinTokens.ENV_VARIABLE)
+		if secret:
+			return RejoinTokens(bytes.fromhex(secret))
+		if root_store is not None:
+			return RejoinTokens(root_store.get_secret())
+		return RejoinTokens(os.urandom(16))
+
+	def issue(self, peer):
+		"""
+
+		:param peer: Peer ID of a registered node.
+		:type peer: int
+
+		:return: Its rejoin token.
+		:rtype: str
+		"""
+		return hmac.new(self.secret, peer_hex(peer).encode(), hashlib.sha256).hexdigest()[:self.TOKEN_SIZE]
+
+	def is_valid(self, peer, token):
+		"""
+
+		:param peer: Peer ID of the sender.
+		:param token: The token it showed, or None.
+
+		:type peer: int
+		:type token: str
+
+		:return: Whether it is the token we have issued to that peer.
+		:rtype: bool
+		"""
+		return token is not None and hmac.compare_digest(self.issue(peer), token)
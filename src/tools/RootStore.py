@@ -0,0 +1,284 @@
+from collections import deque
+import os
+import struct
+import threading
+import time
+
+from src.tools.NetworkGraph import NetworkGraph, GraphNode
+
+
+class RootStore:
+	"""
+	Keeps the root's state (the NetworkGraph and nodes_for_root) on disk so that a restarted root can continue
+	without the whole network rejoining.
+
+	The state is a snapshot file plus an append-only log of the changes made after it:
+		snapshot: header (magic, version, write time, record count), then one record per node in BFS order so that
+				  every parent comes before its children.
+		log:      one fixed size record per change; It is emptied whenever a new snapshot has been written.
+
+	The same records replicate the state to a standby root (see Peer): a snapshot first, then every change.
+
+	Warnings:
+		1. A snapshot is written to a temporary file and renamed over the old one, so a crash never leaves a half
+		   written snapshot behind; Replaying a log over a newer snapshot is harmless because every change is
+		   idempotent.
+		2. Last hello times are shifted by the downtime on load; Otherwise every node would time out right away.
+	"""
+	MAGIC = b'P2PS'
+	VERSION = 3
+	SNAPSHOT_HEADER = struct.Struct('<4s H d I')
+	# peer id, parent peer id, flags, capacity, last hello
+	NODE_RECORD = struct.Struct('<Q Q B B d')
+	# operation, peer id, parent peer id, capacity, time
+	LOG_RECORD = struct.Struct('<B Q Q B d')
+
+	IN_GRAPH = 0x01
+	IS_ON = 0x02
+	REGISTERED = 0x04
+
+	REGISTER = 1
+	ADD = 2
+	REMOVE = 3
+
+	ENV_VARIABLE = 'P2P_STATE_DIR'
+
+	def __init__(self, directory, snapshot_interval=30):
+		"""
+
+		:param directory: Directory of the snapshot and log files; Created if it does not exist.
+		:param snapshot_interval: Seconds between two snapshots.
+
+		:type directory: str
+		:type snapshot_interval: int
+		"""
+		os.makedirs(directory, exist_ok=True)
+		self.snapshot_path = os.path.join(directory, 'root.snapshot')
+		self.log_path = os.path.join(directory, 'root.log')
+		self.secret_path = os.path.join(directory, 'root.secret')
+		self.snapshot_interval = snapshot_interval
+		self.last_snapshot_time = 0
+		self.log = None
+		# The main loop appends while the reunion daemon writes snapshots.
+		self.lock = threading.Lock()
+
+	@staticmethod
+	def from_environment():
+		"""
+
+		:return: A RootStore in the P2P_STATE_DIR directory, or None when it is not set.
+		:rtype: RootStore
+		"""
+		directory = os.environ.get(RootStore.ENV_VARIABLE)
+		return RootStore(directory) if directory else None
+
+	def load(self, root_address, fan_out=2, graph_class=NetworkGraph):
+		"""
+		Rebuild the root state from the snapshot and the log.
+
+		:param root_address: Our own peer ID; The root of the restored graph.
+		:param fan_out: Capacity of the root.
+		:param graph_class: NetworkGraph or another graph backend like ArrayGraph.
+
+		:type root_address: int
+		:type fan_out: int
+		:type graph_class: type
+
+		:return: (network_graph, nodes_for_root); A graph with only the root when nothing was saved.
+		:rtype: tuple
+		"""
+		network_graph = graph_class(GraphNode(root_address, fan_out))
+		nodes_for_root = {}
+		last_write = 0
+
+		if os.path.exists(self.snapshot_path):
+			with open(self.snapshot_path, 'rb') as f:
+				data = f.read()
+			magic, version, last_write, count = self.SNAPSHOT_HEADER.unpack_from(data)
+			if magic != self.MAGIC or version != self.VERSION:
+				print('Ignoring an unknown root snapshot ' + self.snapshot_path)
+				count = 0
+			start = self.SNAPSHOT_HEADER.size
+			self.apply_state(data[start:start + count * self.NODE_RECORD.size], network_graph, nodes_for_root)
+
+		if os.path.exists(self.log_path):
+			with open(self.log_path, 'rb') as f:
+				last_write = max(last_write, self.apply_changes(f.read(), network_graph, nodes_for_root))
+
+		downtime = max(0.0, time.time() - last_write) if last_write else 0.0
+		for address in nodes_for_root:
+			nodes_for_root[address] += downtime
+		print(f'Restored {len(nodes_for_root)} nodes of the root state')
+		return network_graph, nodes_for_root
+
+	@staticmethod
+	def apply_state(data, network_graph, nodes_for_root, root_alias=None):
+		"""
+		Add the nodes of snapshot records to a graph and nodes_for_root.
+
+		:param data: Snapshot records, without the header.
+		:param root_alias: Peer ID of another root whose children become children of our graph's root; For a standby
+						   root that takes over.
+
+		:type data: bytes
+		:type network_graph: NetworkGraph
+		:type nodes_for_root: dict
+		:type root_alias: int
+
+		:return:
+		"""
+		for address, parent_address, flags, capacity, last_hello in RootStore.NODE_RECORD.iter_unpack(data):
+			if parent_address == root_alias:
+				parent_address = network_graph.root.address
+			if flags & RootStore.IN_GRAPH:
+				network_graph.add_node(address, parent_address, capacity)
+				if not flags & RootStore.IS_ON:
+					network_graph.turn_off_node(address)
+			if flags & RootStore.REGISTERED:
+				nodes_for_root[address] = last_hello
+
+	@staticmethod
+	def apply_changes(data, network_graph, nodes_for_root):
+		"""
+		Replay log records over a graph and nodes_for_root.
+
+		:param data: Log records; A cut short last record (e.g. after a crash) is ignored.
+
+		:type data: bytes
+		:type network_graph: NetworkGraph
+		:type nodes_for_root: dict
+
+		:return: Time of the last change; 0 if there is none.
+		:rtype: float
+		"""
+		last_write = 0
+		for offset in range(0, len(data) - RootStore.LOG_RECORD.size + 1, RootStore.LOG_RECORD.size):
+			operation, address, parent_address, capacity, when = RootStore.LOG_RECORD.unpack_from(data, offset)
+			if operation == RootStore.REGISTER:
+				nodes_for_root[address] = when
+			elif operation == RootStore.ADD:
+				network_graph.add_node(address, parent_address, capacity)
+			elif operation == RootStore.REMOVE:
+				nodes_for_root.pop(address, None)
+				network_graph.remove_node(address)
+			last_write = max(last_write, when)
+		return last_write
+
+	@staticmethod
+	def encode_change(operation, address, parent_address=0, capacity=0):
+		"""
+
+		:param operation: REGISTER, ADD or REMOVE.
+		:return: The log record of a change made now.
+		:rtype: bytes
+		"""
+		return RootStore.LOG_RECORD.pack(operation, address, parent_address, capacity, time.time())
+
+	def get_secret(self):
+		"""
+		The root's secret for rejoin tokens (see RejoinTokens); Created the first time.
+
+		:return: 16 random bytes, the same after every restart.
+		:rtype: bytes
+		"""
+		if os.path.exists(self.secret_path):
+			with open(self.secret_path, 'rb') as f:
+				return f.read()
+		secret = os.urandom(16)
+		with open(os.open(self.secret_path, os.O_WRONLY | os.O_CREAT, 0o600), 'wb') as f:
+			f.write(secret)
+		return secret
+
+	def log_register(self, address):
+		self.log_change(self.REGISTER, address)
+
+	def log_add(self, address, parent_address, capacity=0):
+		self.log_change(self.ADD, address, parent_address, capacity)
+
+	def log_remove(self, address):
+		self.log_change(self.REMOVE, address)
+
+	def log_change(self, operation, address, parent_address=0, capacity=0):
+		record = self.encode_change(operation, address, parent_address, capacity)
+		with self.lock:
+			if self.log is None:
+				self.log = open(self.log_path, 'ab')
+			self.log.write(record)
+			self.log.flush()
+
+	def maybe_snapshot(self, network_graph, nodes_for_root):
+		"""
+		Write a snapshot when snapshot_interval seconds have passed since the last one.
+
+		:type network_graph: NetworkGraph
+		:type nodes_for_root: dict
+
+		:return:
+		"""
+		if time.time() - self.last_snapshot_time >= self.snapshot_interval:
+			self.snapshot(network_graph, nodes_for_root)
+
+	def snapshot(self, network_graph, nodes_for_root):
+		"""
+		Write the whole state to the snapshot file and empty the log.
+
+		Warnings:
+			1. The state is captured under the same lock as log_change takes; A change logged between the capture
+			   and the rotation of the log would be in neither file.
+
+		:type network_graph: NetworkGraph
+		:type nodes_for_root: dict
+
+		:return:
+		"""
+		now = time.time()
+		temporary_path = self.snapshot_path + '.tmp'
+		with self.lock:
+			records = self.encode_state(network_graph, dict(nodes_for_root))
+			with open(temporary_path, 'wb') as f:
+				f.write(self.SNAPSHOT_HEADER.pack(self.MAGIC, self.VERSION, now, len(records) // self.NODE_RECORD.size))
+				f.write(records)
+				f.flush()
+				os.fsync(f.fileno())
+			os.replace(temporary_path, self.snapshot_path)
+
+			if self.log is not None:
+				self.log.close()
+			self.log = open(self.log_path, 'wb')
+		self.last_snapshot_time = now
+
+	@staticmethod
+	def encode_state(network_graph, nodes_for_root):
+		"""
+
+		:type network_graph: NetworkGraph
+		:type nodes_for_root: dict
+
+		:return: Snapshot records of the whole state (without the header); Parents come before their children.
+		:rtype: bytes
+		"""
+		records = []
+		written = set()
+		queue = deque(network_graph.root.get_children())
+		while queue:
+			node = queue.popleft()
+			# A node that advertised again may still hang under its old parent too.
+			if node.address in written or node.address not in network_graph.nodes:
+				continue
+			queue.extend(node.get_children())
+			flags = RootStore.IN_GRAPH | (RootStore.IS_ON if node.is_on else 0)
+			if node.address in nodes_for_root:
+				flags |= RootStore.REGISTERED
+			records.append(RootStore.NODE_RECORD.pack(node.address, node.parent.address, flags, node.capacity,
+													  nodes_for_root.get(node.address, 0)))
+			written.add(node.address)
+		for address, last_hello in nodes_for_root.items():
+			if address not in written:
+				records.append(RootStore.NODE_RECORD.pack(address, 0, RootStore.REGISTERED, 0, last_hello))
+		return b''.join(records)
+
+	def close(self):
+		with self.lock:
+			if self.log is not None:
+				self.log.close()
+				self.log = None
@@ -0,0 +1,185 @@
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from src.tools.helpers import peer_hex
+
+
+class SpoolSegment:
+	# write time, length
+	RECORD = struct.Struct('<d I')
+	CHUNK = 64 * 1024
+
+	def __init__(self, path):
+		"""
+		One append-only, memory-mapped file of buffers; It grows in doubling chunks.
+
+		:param path: Path of the segment file; Created (or emptied) here.
+		:type path: str
+		"""
+		self.path = path
+		self.file = open(path, 'w+b')
+		self.map = None
+		self.size = 0
+		self.used = 0
+		self.count = 0
+		self.opened = time.time()
+
+	def append(self, buf, now):
+		need = self.RECORD.size + len(buf)
+		if self.used + need > self.size:
+			self.__grow(self.used + need)
+		self.RECORD.pack_into(self.map, self.used, now, len(buf))
+		self.map[self.used + self.RECORD.size:self.used + need] = buf
+		self.used += need
+		self.count += 1
+
+	def __grow(self, size):
+		new_size = max(self.CHUNK, self.size * 2)
+		while new_size < size:
+			new_size *= 2
+		if self.map is not None:
+			self.map.close()
+		self.file.truncate(new_size)
+		self.map = mmap.mmap(self.file.fileno(), new_size)
+		self.size = new_size
+
+	def read(self, oldest):
+		"""
+
+		:param oldest: Buffers written before this time are skipped.
+		:return: The buffers in order of writing.
+		:rtype: list
+		"""
+		buffers = []
+		offset = 0
+		while offset < self.used:
+			written, length = self.RECORD.unpack_from(self.map, offset)
+			offset += self.RECORD.size
+			if written >= oldest:
+				buffers.append(self.map[offset:offset + length])
+			offset += length
+		return buffers
+
+	def close(self):
+		if self.map is not None:
+			self.map.close()
+		self.file.close()
+		os.unlink(self.path)
+
+
+class Spool:
+	def __init__(self, directory=None, max_bytes=4 << 20, max_total=64 << 20, retention=120):
+		"""
+		Store-and-forward for the messages of neighbours we can't reach right now: one memory-mapped segment file per
+		neighbour, so that the waiting messages are on disk instead of in RAM. They are replayed when the neighbour
+		is back (see Stream.add_node).
+
+		Warnings:
+			1. Messages past 'max_bytes' for one neighbour or 'max_total' for all are dropped.
+			2. Messages older than 'retention' seconds are not replayed, and a neighbour that has not come back
+			   for that long is forgotten with its file.
+
+		:param directory: Where the segment files are kept; A new temporary directory by default (P2P_SPOOL_DIR
+						  is its parent if set). It is only created when the first neighbour is spooled.
+		:param max_bytes: Most bytes kept for one neighbour.
+		:param max_total: Most bytes kept for all neighbours.
+		:param retention: Seconds a message is kept.
+
+		:type directory: str
+		:type max_bytes: int
+		:type max_total: int
+		:type retention: int
+		"""
+		self.directory = directory
+		self.max_bytes = max_bytes
+		self.max_total = max_total
+		self.retention = retention
+		self.segments = {}  # {peer id: SpoolSegment}
+		self.dropped = 0
+		# The main loop and the reunion daemon both send.
+		self.lock = threading.Lock()
+
+	def open(self, peer):
+		"""
+		Start spooling for an unreachable neighbour; Messages for it are kept from now on.
+
+		:param peer: Peer ID of the neighbour.
+		:type peer: int
+		"""
+		with self.lock:
+			if peer not in self.segments:
+				if self.directory is None:
+					self.directory = tempfile.mkdtemp(prefix='p2p-spool-', dir=os.environ.get('P2P_SPOOL_DIR'))
+				self.segments[peer] = SpoolSegment(os.path.join(self.directory, peer_hex(peer) + '.spool'))
+
+	def has(self, peer):
+		return peer in self.segments
+
+	def get_peers(self):
+		"""
+
+		:return: Peer IDs of the neighbours that are spooled now.
+		:rtype: list
+		"""
+		return list(self.segments)
+
+	def append(self, peer, buf):
+		"""
+		Keep a buffer for a spooled neighbour.
+
+		:param peer: Peer ID of the neighbour.
+		:param buf: The buffer, as it would have been sent.
+
+		:type peer: int
+		:type buf: bytes
+
+		:return: Whether it was kept.
+		:rtype: bool
+		"""
+		with self.lock:
+			segment = self.segments.get(peer)
+			if segment is None:
+				return False
+			size = SpoolSegment.RECORD.size + len(buf)
+			total = sum(segment.used for segment in self.segments.values())
+			if segment.used + size > self.max_bytes or total + size > self.max_total:
+				self.dropped += 1
+				return False
+			segment.append(buf, time.time())
+			return True
+
+	def take(self, peer):
+		"""
+		Stop spooling for a neighbour.
+
+		:param peer: Peer ID of the neighbour.
+		:type peer: int
+
+		:return: Its buffers that are still within the retention, in order.
+		:rtype: list
+		"""
+		with self.lock:
+			segment = self.segments.pop(peer, None)
+			if segment is None:
+				return []
+			buffers = segment.read(time.time() - self.retention)
+			segment.close()
+		return buffers
+
+	def expire(self):
+		"""
+		Forget the neighbours that have not come back within the retention.
+
+		:return: Their peer IDs.
+		:rtype: list
+		"""
+		oldest = time.time() - self.retention
+		with self.lock:
+			expired = [peer for peer, segment in self.segments.items() if segment.opened < oldest]
+			for peer in expired:
+				self.segments.pop(peer).close()
+		return expired
@@ -10,3 +10,119 @@ def ip_int_parts_to_15byte(ip_1,ip_2,ip_3,ip_4):
 	ip_4 = str(ip_4).zfill(3)
 	list = [ip_1, ip_2, ip_3, ip_4]
 	return '.'.join(list)
+
+
+# Peer IDs
+#
+# A peer is identified by its server address packed in one integer: the four IP octets and the port as
+# ip_1 << 40 | ip_2 << 32 | ip_3 << 24 | ip_4 << 16 | port. They are cheap to hash and compare and there is only one
+# of them for an address, however it was written ('127.0.0.1', 5000 or '127.000.000.001', '05000').
+#
+# The string forms are only needed at the edges (packet bodies, sockets and prints); They are made once per peer
+# and kept in the tables below, up to _PEER_CACHE_SIZE peers each: peer IDs also come from the network and a stream of
+# made-up ones must not grow them without bound.
+_PEER_CACHE_SIZE = 1 << 16
+_peer_addresses = {}  # {peer id: ('192.168.001.001', '05335')}
+_peer_strings = {}  # {peer id: '192.168.001.00105335'}
+_peer_ids = {}  # {'192.168.001.00105335': peer id}
+
+
+def peer_id(ip, port):
+	"""
+
+	:param ip: Like '192.168.1.1' or '192.168.001.001'.
+	:param port: Like 5335 or '05335'.
+
+	:return: The packed peer ID.
+	:rtype: int
+	"""
+	ip_1, ip_2, ip_3, ip_4 = ip_parts_integer(ip)
+	return ip_1 << 40 | ip_2 << 32 | ip_3 << 24 | ip_4 << 16 | int(port)
+
+
+def peer_id_from_parts(ip_1, ip_2, ip_3, ip_4, port):
+	return ip_1 << 40 | ip_2 << 32 | ip_3 << 24 | ip_4 << 16 | port
+
+
+def peer_id_parts(peer):
+	"""
+
+	:return: (ip_1, ip_2, ip_3, ip_4, port) of a peer ID.
+	:rtype: tuple
+	"""
+	return peer >> 40 & 0xff, peer >> 32 & 0xff, peer >> 24 & 0xff, peer >> 16 & 0xff, peer & 0xffff
+
+
+def to_peer_id(address):
+	"""
+
+	:param address: A peer ID or an (ip, port) tuple.
+	:return: The peer ID.
+	:rtype: int
+	"""
+	if isinstance(address, int):
+		return address
+	return peer_id(address[0], address[1])
+
+
+def parse_peer_list(string):
+	"""
+
+	:param string: Addresses like '127.0.0.1:5001,127.0.0.1:5002' (e.g. from an environment variable).
+	:return: Their peer IDs.
+	:rtype: list
+	"""
+	return [peer_id(*item.strip().rsplit(':', 1)) for item in string.split(',') if item.strip()]
+
+
+def peer_address(peer):
+	"""
+
+	:return: The address of a peer ID in its pretty format, like ('192.168.001.001', '05335').
+	:rtype: tuple
+	"""
+	address = _peer_addresses.get(peer)
+	if address is None:
+		ip_1, ip_2, ip_3, ip_4, port = peer_id_parts(peer)
+		address = (ip_int_parts_to_15byte(ip_1, ip_2, ip_3, ip_4), str(port).zfill(5))
+		if len(_peer_addresses) < _PEER_CACHE_SIZE:
+			_peer_addresses[peer] = address
+	return address
+
+
+def peer_string(peer):
+	"""
+
+	:return: The 20 character form of a peer ID that packet bodies carry, like '192.168.001.00105335'.
+	:rtype: str
+	"""
+	string = _peer_strings.get(peer)
+	if string is None:
+		string = ''.join(peer_address(peer))
+		if len(_peer_strings) < _PEER_CACHE_SIZE:
+			_peer_strings[peer] = string
+	return string
+
+
+def peer_hex(peer):
+	"""
+
+	:return: The 12 character hex form of a peer ID, used where packet bodies only need the ID itself.
+	:rtype: str
+	"""
+	return '%012x' % peer
+
+
+def parse_peer_string(string):
+	"""
+
+	:param string: The 20 character form of an address from a packet body.
+	:return: Its peer ID.
+	:rtype: int
+	"""
+	peer = _peer_ids.get(string)
+	if peer is None:
+		peer = peer_id(string[:15], string[15:20])
+		if len(_peer_ids) < _PEER_CACHE_SIZE:
+			_peer_ids[string] = peer
+	return peer
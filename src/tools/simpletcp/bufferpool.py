@@ -0,0 +1,41 @@
+import threading
+
+
+class BufferPool:
+
+    def __init__(self, buffer_size, max_free=256):
+        """
+        Reusable receive buffers, so that reading a frame does not allocate a new bytes object.
+
+        A buffer is taken with acquire() and given back with release() once nobody reads its frame anymore;
+        Buffers of another size (grown for a large frame) are not kept.
+
+        :param buffer_size: Size of every pooled bytearray.
+        :param max_free: Most free buffers kept; The rest are left to the garbage collector.
+        """
+        self.buffer_size = buffer_size
+        self.max_free = max_free
+        self._free = []
+        # Buffers are taken on the I/O thread and given back on the thread that handles the packets.
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return bytearray(self.buffer_size)
+
+    def release(self, buffer):
+        """
+        Give a buffer back; A memoryview of it is released first, so it must not be used afterwards.
+
+        :param buffer: A bytearray from acquire(), or a memoryview of one.
+        """
+        if isinstance(buffer, memoryview):
+            view, buffer = buffer, buffer.obj
+            view.release()
+        if len(buffer) != self.buffer_size:
+            return
+        with self._lock:
+            if len(self._free) < self.max_free:
+                self._free.append(buffer)
@@ -3,7 +3,7 @@ import socket
 
 
 class ClientSocket:
-    def __init__(self, mode, port, received_bytes=2048, single_use=True):
+    def __init__(self, mode, port, received_bytes=2048, single_use=True, unix_path=None):
         """
 
         Handle the socket's mode.
@@ -12,6 +12,7 @@ class ClientSocket:
         localhost -> (127.0.0.1)
         public ->    (0.0.0.0)
         otherwise, mode is interpreted as an IP address.
+        With unix_path, connect to the Unix domain socket at that path instead; mode and port are only kept.
         """
 
         if mode == "localhost":
@@ -25,15 +26,20 @@ class ClientSocket:
         if type(self.connect_port) != int:
             print("port must be an integer", file=sys.stderr)
             raise ValueError
-        # Actually create an INET, STREAMing socket.socket.
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Actually create an INET (or UNIX), STREAMing socket.socket.
+        if unix_path is not None:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.connect_address = unix_path
+        else:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.connect_address = (self.connect_ip, self.connect_port)
         # Save the number of bytes to be read in response
         self.received_bytes = received_bytes
         # Save whether this socket is single-use or not.
         self.single_use = single_use
         # If this isn't a single-use socket, connect right away.
         if not self.single_use:
-            self._socket.connect((self.connect_ip, self.connect_port))
+            self._socket.connect(self.connect_address)
             # Keep track of whether this socket has been closed.
             self.closed = False
         # Keep track of whether this socket has been used, so we can
@@ -73,7 +79,7 @@ class ClientSocket:
                 print("You cannot use a single-use socket twice", file=sys.stderr)
                 raise RuntimeError
             # Otherwise, connect
-            self._socket.connect((self.connect_ip, self.connect_port))
+            self._socket.connect(self.connect_address)
             # Keep track of whether this socket has been closed.
             self.closed = False
         # If data is a string, rather than bytes.
@@ -0,0 +1,197 @@
+import errno
+import queue
+import selectors
+import socket
+import threading
+
+
+class _Connection:
+    def __init__(self, server, sock, ip):
+        self.server = server
+        self.sock = sock
+        self.ip = ip
+        self.queue = queue.Queue()
+        self.writing = False
+        # Framed servers only: the pooled buffer being filled and the number of bytes in it.
+        self.buffer = None
+        self.filled = 0
+
+
+class ServerLoop:
+
+    def __init__(self):
+        """
+        One select loop that serves any number of ServerSockets.
+
+        A single ServerSocket runs its own ServerLoop; Hosting many servers (e.g. many Peers in one process)
+        in one ServerLoop needs only one I/O thread for all of them.
+        """
+        self._selector = selectors.DefaultSelector()
+        self._pending = []
+        self._lock = threading.Lock()
+        # A socket pair to interrupt select() when servers are added from another thread.
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._selector.register(self._wakeup_reader, selectors.EVENT_READ, None)
+
+    def add_server(self, server_socket):
+        """
+        Start listening on 'server_socket' and serve it from this loop; Safe to call from any thread.
+
+        :param server_socket: The server to serve.
+        :type server_socket: ServerSocket
+        """
+        server_socket._socket.listen(server_socket._max_connections)
+        with self._lock:
+            self._pending.append(server_socket)
+        try:
+            self._wakeup_writer.send(b'\0')
+        except BlockingIOError:
+            pass
+
+    def add_datagram_server(self, datagram_server):
+        """
+        Serve a UDPServer from this loop; Safe to call from any thread.
+
+        :type datagram_server: UDPServer
+        """
+        with self._lock:
+            self._pending.append(datagram_server)
+        try:
+            self._wakeup_writer.send(b'\0')
+        except BlockingIOError:
+            pass
+
+    def run(self):
+        while True:
+            self.run_once()
+
+    def run_once(self, timeout=None):
+        """
+        Wait until at least one socket is ready (or 'timeout' seconds passed) and serve every ready socket.
+        """
+        self.__register_pending()
+        for key, events in self._selector.select(timeout):
+            if key.data is None:
+                self.__drain_wakeup()
+            elif isinstance(key.data, _Connection):
+                if events & selectors.EVENT_READ:
+                    self.__read(key.data)
+                if events & selectors.EVENT_WRITE and key.data.sock.fileno() != -1:
+                    self.__write(key.data)
+            elif getattr(key.data, 'is_datagram', False):
+                key.data.receive()
+            else:
+                self.__accept(key.data)
+
+    def __register_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for server_socket in pending:
+            self._selector.register(server_socket._socket, selectors.EVENT_READ, server_socket)
+
+    def __drain_wakeup(self):
+        try:
+            while self._wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def __accept(self, server_socket):
+        # We have a viable connection!
+        client_socket, client_ip = server_socket._socket.accept()
+        # Make it a non-blocking connection.
+        client_socket.setblocking(0)
+        connection = _Connection(server_socket, client_socket, client_ip)
+        self._selector.register(client_socket, selectors.EVENT_READ, connection)
+
+    def __read(self, connection):
+        if connection.server.frame_size is not None:
+            data = self.__read_frames(connection)
+        else:
+            # Someone sent us something! Let's receive it.
+            try:
+                data = connection.sock.recv(connection.server.received_bytes)
+            except socket.error as e:
+                if e.errno == errno.ECONNRESET:
+                    # Consider 'Connection reset by peer'
+                    # the same as reading zero bytes
+                    data = None
+                else:
+                    raise e
+            if data:
+                # Call the callback
+                connection.server.callback(connection.ip, connection.queue, data)
+        if data:
+            # Wait until the socket is writable to send the response.
+            if not connection.writing:
+                connection.writing = True
+                self._selector.modify(connection.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, connection)
+        else:
+            # We received zero bytes, so we should close the stream
+            self.__close(connection)
+
+    def __read_frames(self, connection):
+        """
+        Read into the connection's pooled buffer and call the callback once for every complete frame.
+
+        :return: Number of bytes read; 0 when the other side has closed the connection.
+        """
+        server = connection.server
+        pool = server.buffer_pool
+        if connection.buffer is None:
+            connection.buffer = pool.acquire()
+        try:
+            with memoryview(connection.buffer) as view:
+                count = connection.sock.recv_into(view[connection.filled:])
+        except socket.error as e:
+            if e.errno == errno.ECONNRESET:
+                count = 0
+            else:
+                raise e
+        if not count:
+            return 0
+        connection.filled += count
+
+        while True:
+            size = server.frame_size(connection.buffer, connection.filled)
+            if size is None or size > connection.filled:
+                if size is not None and size > len(connection.buffer):
+                    # A frame larger than the pooled buffers gets a buffer of its own.
+                    larger = bytearray(size)
+                    larger[:connection.filled] = connection.buffer[:connection.filled]
+                    pool.release(connection.buffer)
+                    connection.buffer = larger
+                return count
+            # The frame keeps its buffer until it is released; Following bytes go on in a new one.
+            frame, connection.buffer = connection.buffer, pool.acquire()
+            rest = connection.filled - size
+            if rest:
+                if rest > len(connection.buffer):
+                    connection.buffer = bytearray(rest)
+                connection.buffer[:rest] = frame[size:connection.filled]
+            connection.filled = rest
+            server.callback(connection.ip, connection.queue, memoryview(frame)[:size])
+
+    def __write(self, connection):
+        try:
+            # Get the next chunk of data in the queue, but don't wait.
+            data = connection.queue.get_nowait()
+        except queue.Empty:
+            # The queue is empty -> nothing needs to be written.
+            connection.writing = False
+            self._selector.modify(connection.sock, selectors.EVENT_READ, connection)
+        else:
+            # The queue wasn't empty; we did, in fact, get something.
+            # So send it.
+            try:
+                connection.sock.send(data)
+            except socket.error:
+                self.__close(connection)
+
+    def __close(self, connection):
+        self._selector.unregister(connection.sock)
+        connection.sock.close()
+        if connection.buffer is not None:
+            connection.server.buffer_pool.release(connection.buffer)
+            connection.buffer = None
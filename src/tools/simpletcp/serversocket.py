@@ -1,13 +1,16 @@
-import errno
-import queue
-import select
+import atexit
+import os
 import socket
 import sys
 
+from src.tools.simpletcp.bufferpool import BufferPool
+from src.tools.simpletcp.serverloop import ServerLoop
+
 
 class ServerSocket:
 
-    def __init__(self, mode, port, read_callback, max_connections, received_bytes):
+    def __init__(self, mode, port, read_callback, max_connections, received_bytes, reuse_port=False,
+                 frame_size=None, unix_path=None, buffer_pool=None):
         """
         Handle the socket's mode.
         The socket's mode determines the IP address it binds to.
@@ -15,6 +18,13 @@ class ServerSocket:
         localhost -> (127.0.0.1)
         public ->    (0.0.0.0)
         otherwise, mode is interpreted as an IP address.
+        With reuse_port, several processes can bind the same port and the kernel spreads the connections.
+        With frame_size (a function that takes the buffer and the number of bytes read into it and returns the size
+        of the first frame, or None if that is not known yet), data is read with recv_into into pooled buffers and the callback gets one
+        memoryview per complete frame; Give it back with buffer_pool.release when done. A buffer_pool can be shared
+        with other servers whose frames go to the same consumer.
+        With unix_path, listen on a Unix domain socket at that path instead of mode/port; A stale socket file
+        left there is removed first, and ours is removed on close (at the latest when the process exits).
         """
 
         if mode == "localhost":
@@ -29,12 +39,26 @@ class ServerSocket:
         if type(self.port) != int:
             print("port must be an int", file=sys.stderr)
             raise ValueError
-        # Actually create an INET, STREAMing socket.socket.
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # Make it non-blocking.
-        self._socket.setblocking(0)
-        # Bind the socket, so it can listen.
-        self._socket.bind((self.ip, self.port))
+        self.unix_path = unix_path
+        if unix_path is not None:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.setblocking(0)
+            if os.path.exists(unix_path):
+                os.unlink(unix_path)
+            self._socket.bind(unix_path)
+            self._unix_inode = os.stat(unix_path).st_ino
+            atexit.register(self.close)
+        else:
+            # Actually create an INET, STREAMing socket.socket.
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Make it non-blocking.
+            self._socket.setblocking(0)
+            # Let a restarted server bind its port again while old connections are in TIME_WAIT.
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            # Bind the socket, so it can listen.
+            self._socket.bind((self.ip, self.port))
         # Save the callback
         self.callback = read_callback
         # Save the number of maximum connections.
@@ -45,85 +69,22 @@ class ServerSocket:
         # Save the number of bytes to be received each time we read from
         # a socket
         self.received_bytes = received_bytes
+        self.frame_size = frame_size
+        self.buffer_pool = (buffer_pool or BufferPool(received_bytes)) if frame_size else None
 
     def run(self):
-        # Start listening
-        self._socket.listen(self._max_connections)
-        # Create a list of readers (sockets that will be read from) and a list
-        # of writers (sockets that will be written to).
-        readers = [self._socket]
-        writers = []
-        # Create a dictionary of queue.Queues for data to be sent.
-        # This dictionary maps sockets to queue.Queue objects
-        queues = dict()
-        # Create a similar dictionary that stores IP addresses.
-        # This dictionary maps sockets to IP addresses
-        IPs = dict()
-        # Now, the main loop.
-        while readers:
-            # Block until a socket is ready for processing.
-            read, write, err = select.select(readers, writers, readers)
-            # Deal with sockets that need to be read from.
-            for sock in read:
-                if sock is self._socket:
-                    # We have a viable connection!
-                    client_socket, client_ip = self._socket.accept()
-                    # Make it a non-blocking connection.
-                    client_socket.setblocking(0)
-                    # Add it to our readers.
-                    readers.append(client_socket)
-                    # Make a queue for it.
-                    queues[client_socket] = queue.Queue()
-                    # Store its IP address.
-                    IPs[client_socket] = client_ip
-                else:
-                    # Someone sent us something! Let's receive it.
-                    try:
-                        data = sock.recv(self.received_bytes)
-                    except socket.error as e:
-                        if e.errno is errno.ECONNRESET:
-                            # Consider 'Connection reset by peer'
-                            # the same as reading zero bytes
-                            data = None
-                        else:
-                            raise e
-                    if data:
-                        # Call the callback
-                        self.callback(IPs[sock], queues[sock], data)
-                        # Put the client socket in writers so we can write to it
-                        # later.
-                        if sock not in writers:
-                            writers.append(sock)
-                    else:
-                        # We received zero bytes, so we should close the stream
-                        # Stop writing to it.
-                        if sock in writers:
-                            writers.remove(sock)
-                        # Stop reading from it.
-                        readers.remove(sock)
-                        # Close the connection.
-                        sock.close()
-                        # Destroy is queue
-                        del queues[sock]
-            # Deal with sockets that need to be written to.
-            for sock in write:
-                try:
-                    # Get the next chunk of data in the queue, but don't wait.
-                    data = queues[sock].get_nowait()
-                except queue.Empty:
-                    # The queue is empty -> nothing needs to be written.
-                    writers.remove(sock)
-                else:
-                    # The queue wasn't empty; we did, in fact, get something.
-                    # So send it.
-                    sock.send(data)
-            # Deal with errors in sockets.
-            for sock in err:
-                # Remove the socket from every list.
-                readers.remove(sock)
-                if sock in writers:
-                    writers.remove(sock)
-                # Close the connection.
-                sock.close()
-                # Destroy its queue.
-                del queues[sock]
+        # Serve this socket alone from its own select loop.
+        loop = ServerLoop()
+        loop.add_server(self)
+        loop.run()
+
+    def close(self):
+        # Stop listening; A Unix domain socket file is removed too, unless another server has bound the path since.
+        self._socket.close()
+        if self.unix_path is not None:
+            atexit.unregister(self.close)
+            try:
+                if os.stat(self.unix_path).st_ino == self._unix_inode:
+                    os.unlink(self.unix_path)
+            except OSError:
+                pass
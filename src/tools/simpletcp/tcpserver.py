@@ -17,17 +17,43 @@ class TCPServer:
      is a tunnel of data to send to the socket that it received from.
      The third argument must be data, which is a string of bytes
      that the server received.
+     With frame_size, data is a memoryview of one complete frame in a pooled buffer;
+     Pass it to release_buffer once it has been decoded.
+     With unix_path, the server listens on a Unix domain socket at that path instead of the IP/port; close()
+     removes the socket file.
+     buffer_pool shares the frame buffers of another server, so that every frame goes back to the pool it came from.
     """
 
     def __init__(self, mode, port, read_callback,
-                 maximum_connections=5, receive_bytes=2048):
+                 maximum_connections=5, receive_bytes=2048, reuse_port=False, frame_size=None, unix_path=None,
+                 buffer_pool=None):
         self.server_socket = ServerSocket(
-            mode, port, read_callback, maximum_connections, receive_bytes
+            mode, port, read_callback, maximum_connections, receive_bytes, reuse_port, frame_size, unix_path,
+            buffer_pool
         )
 
     def run(self):
         self.server_socket.run()
 
+    def close(self):
+        self.server_socket.close()
+
+    def attach(self, server_loop):
+        """
+        Serve this server from a shared ServerLoop instead of running a loop of its own.
+
+        :type server_loop: ServerLoop
+        """
+        server_loop.add_server(self.server_socket)
+
+    def release_buffer(self, data):
+        """
+        Give the buffer of a frame back to the pool.
+
+        :type data: memoryview
+        """
+        self.server_socket.buffer_pool.release(data)
+
     @property
     def ip(self):
         return self.server_socket.ip
@@ -0,0 +1,78 @@
+import socket
+import sys
+
+from src.tools.simpletcp.bufferpool import BufferPool
+from src.tools.simpletcp.serverloop import ServerLoop
+
+
+class UDPServer:
+    """
+     A datagram socket next to a TCPServer, for small messages that must not wait behind a TCP stream.
+     Nothing is acknowledged or resent; A lost datagram is simply lost.
+     mode and port are the same as TCPServer's.
+     read_callback is called for every datagram with two arguments: the (IP, port) address it came from and
+     a memoryview of the datagram in a pooled buffer; Give it back with release_buffer when done.
+    """
+    is_datagram = True
+
+    def __init__(self, mode, port, read_callback, receive_bytes=2048, buffer_pool=None):
+        if mode == "localhost":
+            self.ip = mode
+        elif mode == "public":
+            self.ip = socket.gethostname()
+        else:
+            self.ip = mode
+        self.port = port
+        if type(self.port) != int:
+            print("port must be an int", file=sys.stderr)
+            raise ValueError
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(0)
+        self._socket.bind((self.ip, self.port))
+        self.callback = read_callback
+        self.buffer_pool = buffer_pool or BufferPool(receive_bytes)
+
+    def run(self):
+        # Serve this socket alone from its own select loop.
+        loop = ServerLoop()
+        self.attach(loop)
+        loop.run()
+
+    def attach(self, server_loop):
+        """
+        Serve this server from a shared ServerLoop.
+
+        :type server_loop: ServerLoop
+        """
+        server_loop.add_datagram_server(self)
+
+    def receive(self):
+        # Called by the ServerLoop when the socket is readable; Take every waiting datagram.
+        while True:
+            buffer = self.buffer_pool.acquire()
+            try:
+                count, address = self._socket.recvfrom_into(buffer)
+            except OSError:
+                # Nothing left (or an ICMP error of an earlier send); Either way there is nothing to read.
+                self.buffer_pool.release(buffer)
+                return
+            self.callback(address, memoryview(buffer)[:count])
+
+    def sendto(self, data, address):
+        """
+        Send one datagram.
+
+        :param data: The datagram.
+        :param address: (IP, port) of the receiver.
+
+        :return: Whether the datagram was handed to the kernel.
+        :rtype: bool
+        """
+        try:
+            self._socket.sendto(data, address)
+            return True
+        except OSError:
+            return False
+
+    def release_buffer(self, data):
+        self.buffer_pool.release(data)
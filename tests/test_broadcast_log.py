@@ -0,0 +1,61 @@
+from src.tools.BroadcastLog import BroadcastLog
+
+ORIGIN = 1
+OTHER_ORIGIN = 2
+
+
+def test_a_message_is_recorded_once():
+	log = BroadcastLog()
+	assert log.add(ORIGIN, 1, 0, 'a')
+	assert not log.add(ORIGIN, 1, 0, 'a')
+	assert log.add(OTHER_ORIGIN, 1, 0, 'b')
+	assert [entry.body for entry in log.entries] == ['a', 'b']
+
+
+def test_an_old_sequence_number_is_a_duplicate():
+	log = BroadcastLog()
+	for sequence in (1, 2, 3):
+		log.add(ORIGIN, sequence, 0, str(sequence))
+	assert not log.add(ORIGIN, 2, 0, '2')
+	assert log.get_watermarks() == {ORIGIN: 3}
+
+
+def test_a_skipped_sequence_number_is_taken_once_later():
+	log = BroadcastLog()
+	log.add(ORIGIN, 1, 0, '1')
+	assert log.add(ORIGIN, 4, 0, '4')
+	assert log.gaps[ORIGIN] == {2, 3}
+	assert log.add(ORIGIN, 3, 0, '3')
+	assert not log.add(ORIGIN, 3, 0, '3')
+	assert log.gaps[ORIGIN] == {2}
+	assert log.get_watermarks() == {ORIGIN: 4}
+
+
+def test_gaps_are_bounded_by_the_capacity():
+	log = BroadcastLog(capacity=4)
+	log.add(ORIGIN, 1, 0, '1')
+	log.add(ORIGIN, 4, 0, '4')
+	log.add(ORIGIN, 8, 0, '8')
+	# The oldest gaps are forgotten first.
+	assert log.gaps[ORIGIN] == {5, 6, 7, 3}
+	assert not log.add(ORIGIN, 2, 0, '2')
+	# A jump past the capacity does not remember its gaps at all.
+	log.add(ORIGIN, 100, 0, '100')
+	assert not log.add(ORIGIN, 50, 0, '50')
+
+
+def test_the_log_keeps_only_the_latest_messages():
+	log = BroadcastLog(capacity=3)
+	for sequence in range(1, 6):
+		log.add(ORIGIN, sequence, 0, str(sequence))
+	assert [entry.sequence for entry in log.entries] == [3, 4, 5]
+
+
+def test_a_rejoining_child_gets_what_it_has_missed():
+	log = BroadcastLog()
+	for sequence in (1, 2, 3):
+		log.add(ORIGIN, sequence, 0, f'o{sequence}')
+	log.add(OTHER_ORIGIN, 7, 0, 'x7')
+	missing = log.get_missing({ORIGIN: 1})
+	assert [(entry.origin, entry.body) for entry in missing] == [(ORIGIN, 'o2'), (ORIGIN, 'o3'), (OTHER_ORIGIN, 'x7')]
+	assert log.get_missing(log.get_watermarks()) == []
@@ -0,0 +1,134 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from src.PeerHost import PeerHost
+from src.tools.helpers import peer_address
+
+LOCALHOST = '127.000.000.001'
+TIMEOUT = 45
+
+
+def free_port():
+	with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+		sock.bind(('127.0.0.1', 0))
+		return sock.getsockname()[1]
+
+
+def wait_until(condition, timeout=TIMEOUT):
+	deadline = time.time() + timeout
+	while not condition():
+		if time.time() > deadline:
+			return False
+		time.sleep(0.1)
+	return True
+
+
+class LoopbackNetwork:
+	def __init__(self):
+		"""
+		Peers of one PeerHost in this process, over loopback TCP; Every client records the Messages it delivers.
+		"""
+		self.host = PeerHost()
+		self.delivered = {}  # {peer id: [message, ...]}
+		threading.Thread(target=self.host.run, daemon=True).start()
+
+	def add_root(self, fan_out=None):
+		root = self.host.add_peer(LOCALHOST, free_port(), is_root=True, fan_out=fan_out)
+		root.rebalance_interval = 1e9
+		return root
+
+	def join(self, root, fan_out=None):
+		"""
+		Start a client and wait until the root has placed it.
+
+		:rtype: Peer
+		"""
+		client = self.host.add_peer(LOCALHOST, free_port(), root_address=root.address, fan_out=fan_out)
+		self.delivered[client.address] = []
+		client.deliver_message = self.delivered[client.address].append
+		client.user_interface.put('Register')
+		client.user_interface.put('Advertise')
+		assert wait_until(lambda: client.is_client_connected and
+						  root.network_graph.find_node(client.address) is not None)
+		return client
+
+	def kill(self, peer):
+		"""
+		Stop a peer as if its process had died: it runs no more and all its sockets are closed.
+		"""
+		peer.run_once = lambda: None
+		peer.run_reunion_once = lambda: None
+		stream = peer.stream
+		servers = [server.server_socket for server in (stream.tcp_server, stream.unix_server) if server is not None]
+		if stream.udp_server is not None:
+			servers.append(stream.udp_server)
+		selector = self.host.server_loop._selector
+		for key in list(selector.get_map().values()):
+			if key.data in servers or getattr(key.data, 'server', None) in servers:
+				selector.unregister(key.fileobj)
+				key.fileobj.close()
+
+	def is_placed(self, root, client):
+		"""
+		Whether the client has joined the parent the root's graph gives it, so that Messages reach it.
+		"""
+		node = root.network_graph.find_node(client.address)
+		if node is None or node.parent is None or node.parent.address != client.client_predecessor_address:
+			return False
+		parent = root if node.parent.address == root.address else self.host.peers[peer_address(node.parent.address)[1]]
+		return client.address in parent.successors_address
+
+	def all_delivered(self, clients, message):
+		return all(message in self.delivered[client.address] for client in clients)
+
+
+@pytest.fixture
+def network():
+	return LoopbackNetwork()
+
+
+def test_orphans_join_a_backup_parent(network):
+	root = network.add_root(fan_out=1)
+	first = network.join(root, fan_out=2)
+	victim = network.join(root, fan_out=2)
+	others = [network.join(root, fan_out=2) for _ in range(3)]
+	graph = root.network_graph
+	orphans = [node.address for node in graph.find_node(victim.address).children]
+	assert graph.find_node(victim.address).parent.address == first.address and orphans
+
+	network.kill(victim)
+	assert wait_until(lambda: all(graph.find_node(orphan) is not None and graph.find_node(orphan).parent is not None
+								  and graph.find_node(orphan).parent.address != victim.address
+								  for orphan in orphans))
+
+	alive = [first] + others
+	root.user_interface.put('SendMessage after the failover')
+	assert wait_until(lambda: network.all_delivered(alive, 'after the failover'), timeout=20)
+
+
+def test_a_standby_root_takes_over(network, monkeypatch):
+	primary_port, standby_port = free_port(), free_port()
+	monkeypatch.setenv('P2P_STANDBYS', f'127.0.0.1:{standby_port}')
+	primary = network.host.add_peer(LOCALHOST, primary_port, is_root=True)
+	monkeypatch.delenv('P2P_STANDBYS')
+	monkeypatch.setenv('P2P_STANDBY_FOR', f'127.0.0.1:{primary_port}')
+	standby = network.host.add_peer(LOCALHOST, standby_port, is_root=True)
+	monkeypatch.delenv('P2P_STANDBY_FOR')
+	for root in (primary, standby):
+		root.rebalance_interval = 1e9
+	clients = [network.join(primary) for _ in range(4)]
+	# The standby mirrors the primary's graph before the primary dies.
+	assert wait_until(lambda: set(standby.network_graph.nodes) == set(primary.network_graph.nodes))
+
+	network.kill(primary)
+	assert wait_until(lambda: standby.standby_for is None)
+	assert wait_until(lambda: all(client.root_address == standby.address and client.is_client_connected
+								  for client in clients))
+	assert wait_until(lambda: all(network.is_placed(standby, client) for client in clients))
+
+	clients[-1].user_interface.put('SendMessage after the take over')
+	assert wait_until(lambda: network.all_delivered(clients[:-1], 'after the take over'), timeout=20)
+	assert set(standby.nodes_for_root) == {client.address for client in clients}
@@ -0,0 +1,184 @@
+import random
+
+import pytest
+
+from src.tools.ArrayGraph import ArrayGraph
+from src.tools.NetworkGraph import GraphNode, NetworkGraph
+
+ROOT = 1
+BACKENDS = [NetworkGraph, pytest.param(ArrayGraph, marks=pytest.mark.skipif(not ArrayGraph.available(),
+																			   reason='ArrayGraph needs NumPy'))]
+
+
+def subtree_size(node):
+	return 1 + sum(subtree_size(child) for child in node.children)
+
+
+def check_invariants(graph):
+	for node in graph.nodes.values():
+		assert node.subtree_size == subtree_size(node)
+		for child in node.children:
+			assert child.parent is node
+	for depth, level in enumerate(graph.levels):
+		for node in level:
+			assert node.depth == depth
+			assert graph.get_path(node.address) is not None
+
+
+def random_operations(graph, rng, steps):
+	"""
+	Place batches of new (and now and then re-advertising) senders, remove nodes and turn them off and on.
+
+	:return: The placements of every batch.
+	:rtype: list
+	"""
+	placements = []
+	next_sender = 1000
+	for _ in range(steps):
+		addresses = sorted(address for address in graph.nodes if address != ROOT)
+		operation = rng.random()
+		if operation < 0.5 or not addresses:
+			senders = list(range(next_sender, next_sender + rng.randint(1, 8)))
+			next_sender += 8
+			if addresses and rng.random() < 0.3:
+				senders.insert(rng.randrange(len(senders)), rng.choice(addresses))
+			capacities = {sender: rng.randint(1, 3) for sender in senders}
+			placements.append([(sender, node.address) for sender, node in graph.find_live_nodes(senders, capacities)])
+		elif operation < 0.7:
+			graph.remove_node(rng.choice(addresses))
+		elif operation < 0.85:
+			graph.turn_on_node(rng.choice(addresses))
+		else:
+			graph.turn_off_node(rng.choice(addresses))
+	return placements
+
+
+@pytest.mark.parametrize('graph_class', BACKENDS)
+def test_a_batch_fills_the_tree_level_by_level(graph_class):
+	graph = graph_class(GraphNode(ROOT, 2))
+	placements = graph.find_live_nodes(list(range(2, 2 + 62)))
+	assert len(placements) == 62
+	assert graph.get_depth() == 5
+	assert [len(level) for level in graph.levels] == [1, 2, 4, 8, 16, 32]
+	check_invariants(graph)
+
+
+@pytest.mark.parametrize('graph_class', BACKENDS)
+def test_the_root_branches_stay_balanced(graph_class):
+	graph = graph_class(GraphNode(ROOT, 3))
+	for start in range(2, 500, 7):
+		graph.find_live_nodes(list(range(start, start + 7)))
+		sizes = [child.subtree_size for child in graph.root.children]
+		assert max(sizes) - min(sizes) <= 1
+
+
+@pytest.mark.parametrize('graph_class', BACKENDS)
+def test_a_sender_never_gets_a_node_of_its_own_subtree(graph_class):
+	graph = graph_class(GraphNode(ROOT, 2), fan_out=1)
+	graph.find_live_nodes([2, 3, 4, 5])
+	# 2 and 3 under the root, 4 under 2 and 5 under 3; 2 advertises again and only 5 is outside its sub-tree.
+	# Its move frees a slot of the root for the next sender.
+	assert graph.find_live_node(2) is graph.find_node(5)
+	assert [(sender, node.address) for sender, node in graph.find_live_nodes([2, 6])] == [(2, 5), (6, ROOT)]
+	assert graph.find_node(4).is_in_subtree_of(graph.find_node(2))
+	check_invariants(graph)
+
+
+@pytest.mark.parametrize('graph_class', BACKENDS)
+def test_nothing_is_placed_under_a_turned_off_node(graph_class):
+	graph = graph_class(GraphNode(ROOT, 2))
+	graph.find_live_nodes([2, 3])
+	graph.turn_off_node(2)
+	assert [node.address for _, node in graph.find_live_nodes([4, 5])] == [3, 3]
+	assert graph.find_live_node(6).address in (4, 5)
+
+
+@pytest.mark.parametrize('graph_class', BACKENDS)
+@pytest.mark.parametrize('seed', range(20))
+def test_a_batch_places_like_one_sender_at_a_time(graph_class, seed):
+	rng = random.Random(seed)
+	fan_out = rng.randint(1, 3)
+	batched, one_by_one = graph_class(GraphNode(ROOT, fan_out)), graph_class(GraphNode(ROOT, fan_out))
+	next_sender = 1000
+	for _ in range(40):
+		addresses = sorted(address for address in batched.nodes if address != ROOT)
+		if rng.random() < 0.6 or not addresses:
+			senders = list(range(next_sender, next_sender + rng.randint(1, 8)))
+			next_sender += 8
+			if addresses and rng.random() < 0.3:
+				senders.insert(rng.randrange(len(senders)), rng.choice(addresses))
+			expected = []
+			for sender in senders:
+				node = one_by_one.find_live_node(sender)
+				if node is not None and one_by_one.add_node(sender, node.address):
+					expected.append((sender, node.address))
+			assert [(sender, node.address) for sender, node in batched.find_live_nodes(senders)] == expected
+		else:
+			address = rng.choice(addresses)
+			for graph in (batched, one_by_one):
+				graph.remove_node(address)
+		check_invariants(batched)
+
+
+@pytest.mark.parametrize('graph_class', BACKENDS)
+@pytest.mark.parametrize('seed', range(10))
+def test_a_sender_gets_the_shallowest_free_node(graph_class, seed):
+	rng = random.Random(seed)
+	graph = graph_class(GraphNode(ROOT, 2))
+	random_operations(graph, rng, 40)
+	addresses = sorted(address for address in graph.nodes if address != ROOT)
+	# A new sender and, if there are any, two that advertise again.
+	senders = [10 ** 6] + ([addresses[0], rng.choice(addresses)] if addresses else [])
+	for sender in senders:
+		sender_node = graph.find_node(sender)
+		free = [node for level in graph.levels for node in level if node.is_on and node.can_have_child() and
+				(sender_node is None or not node.is_in_subtree_of(sender_node))]
+		node = graph.find_live_node(sender)
+		if not free:
+			assert node is None
+			continue
+		assert node in free
+		assert node.depth == min(node.depth for node in free)
+
+
+@pytest.mark.skipif(not ArrayGraph.available(), reason='ArrayGraph needs NumPy')
+@pytest.mark.parametrize('seed', range(30))
+def test_array_graph_places_like_network_graph(seed):
+	network_graph = NetworkGraph(GraphNode(ROOT, 2))
+	array_graph = ArrayGraph(GraphNode(ROOT, 2))
+	assert random_operations(array_graph, random.Random(seed), 60) == \
+		random_operations(network_graph, random.Random(seed), 60)
+	check_invariants(array_graph)
+	assert sorted(array_graph.nodes) == sorted(network_graph.nodes)
+
+
+@pytest.mark.skipif(not ArrayGraph.available(), reason='ArrayGraph needs NumPy')
+def test_array_graph_columns_follow_the_nodes():
+	graph = ArrayGraph(GraphNode(ROOT, 2))
+	graph.find_live_nodes(list(range(2, 40)))
+	graph.remove_node(2)
+	graph.find_live_nodes([2])
+	for node in graph.nodes.values():
+		assert graph.depths[node.slot] == node.depth
+		assert graph.child_counts[node.slot] == len(node.children)
+		assert graph.on[node.slot] == node.is_on
+		parent_slot = node.parent.slot if node.parent is not None else -1
+		assert graph.parents[node.slot] == parent_slot
+
+
+@pytest.mark.parametrize('graph_class', BACKENDS)
+def test_rebalance_moves_a_deep_subtree_up(graph_class):
+	graph = graph_class(GraphNode(ROOT, 2))
+	graph.find_live_nodes(list(range(2, 16)))
+	# Free two slots near the root and hang a long chain deep down.
+	graph.remove_node(3)
+	leaf = next(iter(graph.levels[-1]))
+	chain = [leaf.address]
+	for address in range(100, 104):
+		graph.add_node(address, chain[-1], capacity=1)
+		chain.append(address)
+	depth = graph.get_depth()
+	moves = graph.rebalance(max_moves=1, threshold=2, cooldown=0)
+	assert len(moves) == 1
+	assert graph.get_depth() < depth
+	check_invariants(graph)
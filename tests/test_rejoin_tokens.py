@@ -0,0 +1,33 @@
+from src.tools.RejoinTokens import RejoinTokens
+from src.tools.helpers import peer_id
+
+PEER = peer_id('127.0.0.1', 5001)
+OTHER_PEER = peer_id('127.0.0.1', 5002)
+
+
+def test_an_issued_token_is_valid_for_its_peer_only():
+	tokens = RejoinTokens(b'secret')
+	token = tokens.issue(PEER)
+	assert len(token) == RejoinTokens.TOKEN_SIZE
+	assert tokens.is_valid(PEER, token)
+	assert not tokens.is_valid(OTHER_PEER, token)
+
+
+def test_a_missing_or_forged_token_is_invalid():
+	tokens = RejoinTokens(b'secret')
+	assert not tokens.is_valid(PEER, None)
+	assert not tokens.is_valid(PEER, '')
+	assert not tokens.is_valid(PEER, '0' * RejoinTokens.TOKEN_SIZE)
+	assert not tokens.is_valid(PEER, RejoinTokens(b'other secret').issue(PEER))
+
+
+def test_roots_with_the_same_secret_take_each_others_tokens(monkeypatch):
+	monkeypatch.setenv(RejoinTokens.ENV_VARIABLE, 'ab' * 16)
+	primary, standby = RejoinTokens.from_environment(), RejoinTokens.from_environment()
+	assert standby.is_valid(PEER, primary.issue(PEER))
+
+
+def test_without_a_secret_every_root_makes_its_own(monkeypatch):
+	monkeypatch.delenv(RejoinTokens.ENV_VARIABLE, raising=False)
+	first, second = RejoinTokens.from_environment(), RejoinTokens.from_environment()
+	assert not second.is_valid(PEER, first.issue(PEER))
@@ -0,0 +1,95 @@
+import os
+
+import pytest
+
+from src.tools import Spool as spool_module
+from src.tools.Spool import Spool, SpoolSegment
+
+PEER = 1
+OTHER_PEER = 2
+
+
+class Clock:
+	def __init__(self):
+		self.now = 1000.0
+
+	def time(self):
+		return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+	clock = Clock()
+	monkeypatch.setattr(spool_module, 'time', clock)
+	return clock
+
+
+def test_buffers_come_back_in_order(tmp_path):
+	spool = Spool(str(tmp_path))
+	spool.open(PEER)
+	for i in range(100):
+		assert spool.append(PEER, b'message %d' % i)
+	assert spool.get_peers() == [PEER]
+	assert [bytes(buf) for buf in spool.take(PEER)] == [b'message %d' % i for i in range(100)]
+	assert not spool.has(PEER)
+	assert os.listdir(tmp_path) == []
+
+
+def test_only_spooled_neighbours_are_kept(tmp_path):
+	spool = Spool(str(tmp_path))
+	assert not spool.append(PEER, b'lost')
+	assert spool.take(PEER) == []
+
+
+def test_a_segment_grows_past_its_first_chunk(tmp_path):
+	spool = Spool(str(tmp_path))
+	spool.open(PEER)
+	buf = b'x' * 1000
+	count = 3 * SpoolSegment.CHUNK // len(buf)
+	for _ in range(count):
+		assert spool.append(PEER, buf)
+	assert len(spool.take(PEER)) == count
+
+
+def test_one_neighbour_is_capped(tmp_path):
+	record = SpoolSegment.RECORD.size + 10
+	spool = Spool(str(tmp_path), max_bytes=3 * record)
+	spool.open(PEER)
+	assert [spool.append(PEER, b'0123456789') for _ in range(4)] == [True, True, True, False]
+	assert spool.dropped == 1
+	assert len(spool.take(PEER)) == 3
+
+
+def test_all_neighbours_together_are_capped(tmp_path):
+	record = SpoolSegment.RECORD.size + 10
+	spool = Spool(str(tmp_path), max_bytes=10 * record, max_total=3 * record)
+	spool.open(PEER)
+	spool.open(OTHER_PEER)
+	assert spool.append(PEER, b'0123456789')
+	assert spool.append(OTHER_PEER, b'0123456789')
+	assert spool.append(PEER, b'0123456789')
+	assert not spool.append(OTHER_PEER, b'0123456789')
+	assert spool.dropped == 1
+
+
+def test_old_buffers_are_not_replayed(tmp_path, clock):
+	spool = Spool(str(tmp_path), retention=60)
+	spool.open(PEER)
+	spool.append(PEER, b'old')
+	clock.now += 50
+	spool.append(PEER, b'new')
+	clock.now += 20
+	assert [bytes(buf) for buf in spool.take(PEER)] == [b'new']
+
+
+def test_a_neighbour_that_stays_away_is_forgotten(tmp_path, clock):
+	spool = Spool(str(tmp_path), retention=60)
+	spool.open(PEER)
+	spool.append(PEER, b'kept on disk')
+	clock.now += 30
+	spool.open(OTHER_PEER)
+	assert spool.expire() == []
+	clock.now += 40
+	assert spool.expire() == [PEER]
+	assert spool.get_peers() == [OTHER_PEER]
+	assert len(os.listdir(tmp_path)) == 1